@@ -0,0 +1,162 @@
+import heapq
+
+class Allocator(object):
+    """A buddy allocator over the memories of a SoC.
+
+    Every block is a power of two bytes, at least ``2**min_order``, and is
+    aligned to its size; freeing one merges it with its buddy while that is
+    free too and in the same region.  Each region is cut into the largest
+    aligned blocks it holds, so regions needn't be powers of two, and no
+    block spans two of them even when they are adjacent.  Allocations are named, the way
+    :class:`OperatingSystem` hands them out.
+
+    Free blocks of each size are a heap of addresses, lowest first.  The
+    fixed size rings of DSP nets come and go in the same few sizes, so they
+    are mostly a pop off one of those.
+
+    :param regions: ``[(base, size)]`` of the memory to hand out.
+    """
+
+    min_order = 4
+
+    def __init__(self, regions, min_order=None):
+        if min_order is not None:
+            self.min_order = min_order
+        self.regions = list(regions)
+        self.free_lists = {}
+        self.free_blocks = {}
+        # The region of every block there has been, by address.
+        self.block_regions = {}
+        self.allocations = {}
+        self.requested = 0
+        self.allocated = 0
+        self.high_water = 0
+        self.size = 0
+        for region, (base, size) in enumerate(self.regions):
+            self.size += size
+            end = base + size
+            # Align the start to the minimum block; what's left over at
+            # either end is too small to hand out.
+            addr = -(-base >> self.min_order) << self.min_order
+            while end - addr >= 1 << self.min_order:
+                order = (end - addr).bit_length() - 1
+                if addr:
+                    order = min(order, (addr & -addr).bit_length() - 1)
+                self._release(addr, order, region)
+                addr += 1 << order
+
+    def _release(self, addr, order, region):
+        self.free_blocks[addr] = order
+        self.block_regions[addr] = region
+        heapq.heappush(self.free_lists.setdefault(order, []), addr)
+
+    def _take(self, order):
+        # The lowest free block of order; stale entries of blocks merged
+        # or taken since are skipped.
+        heap = self.free_lists.get(order)
+        while heap:
+            addr = heapq.heappop(heap)
+            if self.free_blocks.get(addr) == order:
+                del self.free_blocks[addr]
+                return addr
+        return None
+
+    def alloc(self, name, size, align=None):
+        """Allocate ``size`` bytes aligned to ``align``, a power of two, and
+        remember them as ``name``.
+
+        :returns: The address.
+        :raises ValueError: If ``name`` is already allocated, or no free
+                            block is big enough.
+        """
+        if name in self.allocations:
+            raise ValueError, '%r is already allocated at %#x' % (name,
+                self.allocations[name][0])
+        order = max(self.min_order, (max(size, 1) - 1).bit_length())
+        if align:
+            order = max(order, (align - 1).bit_length())
+        for k in sorted(o for o in self.free_lists if o >= order):
+            addr = self._take(k)
+            if addr is not None:
+                break
+        else:
+            raise ValueError, 'No %d bytes free for %r; %s' % (size, name,
+                self.summary())
+        # Split it down to size, keeping the upper halves free.
+        region = self.block_regions[addr]
+        while k > order:
+            k -= 1
+            self._release(addr + (1 << k), k, region)
+        self.allocations[name] = (addr, size, order)
+        self.requested += size
+        self.allocated += 1 << order
+        self.high_water = max(self.high_water, self.allocated)
+        return addr
+
+    def free(self, name):
+        """Free what ``name`` was allocated.
+
+        :raises KeyError: If it wasn't.
+        """
+        addr, size, order = self.allocations.pop(name)
+        self.requested -= size
+        self.allocated -= 1 << order
+        region = self.block_regions[addr]
+        while True:
+            buddy = addr ^ (1 << order)
+            if self.free_blocks.get(buddy) != order or \
+                    self.block_regions[buddy] != region:
+                break
+            del self.free_blocks[buddy]
+            addr = min(addr, buddy)
+            order += 1
+        self._release(addr, order, region)
+
+    def lookup(self, name):
+        """The address of ``name``, or None."""
+        allocation = self.allocations.get(name)
+        return allocation[0] if allocation else None
+
+    @property
+    def largest_free(self):
+        return max([1 << order for order in self.free_blocks.itervalues()]
+            or [0])
+
+    def stats(self):
+        """What's allocated and how fragmented the rest is, as a dict.
+
+        ``internal`` is the part of the allocated bytes that was rounded up,
+        ``external`` the part of the free bytes outside the largest free
+        block.
+        """
+        free = sum(1 << order for order in self.free_blocks.itervalues())
+        return {
+            'allocations': len(self.allocations),
+            'requested': self.requested,
+            'allocated': self.allocated,
+            'free': free,
+            'largest free': self.largest_free,
+            'high water': self.high_water,
+            'internal': 1.0 - float(self.requested) / self.allocated
+                if self.allocated else 0.0,
+            'external': 1.0 - float(self.largest_free) / free if free else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return '%d bytes in %d allocations, %d free, largest %d' % (
+            stats['allocated'], stats['allocations'], stats['free'],
+            stats['largest free'])
+
+    def report(self, f):
+        """Write the allocations by address and :meth:`stats` to ``f``."""
+        f.write('%-32s %10s %10s %10s\n' % ('name', 'address', 'size',
+            'block'))
+        for name, (addr, size, order) in sorted(self.allocations.iteritems(),
+                key=lambda item: item[1]):
+            f.write('%-32s %#10x %10d %10d\n' % (name, addr, size, 1 << order))
+        for key, value in sorted(self.stats().iteritems()):
+            if type(value) == float:
+                f.write('%-32s %9.1f%%\n' % (key, 100 * value))
+            else:
+                f.write('%-32s %10d\n' % (key, value))
@@ -0,0 +1,491 @@
+import heapq
+import os
+from collections import deque
+
+from myhdl import Signal, delay, join, now
+
+from system import system
+from bus import AddressMap, BusMatrix, Idle, block_receive, block_transmit, \
+    words
+
+class AxiTransaction(object):
+    """A read or a write issued on an :class:`AxiBus`.
+
+    :attr accepted: The simulated time the bus took it, or None while it
+                    waits for a master or slave slot.
+    :attr done: The simulated time its response came back, or None until
+                then.
+    :attr rdata: The words read, an array of unsigned words, once done.
+    """
+    __slots__ = ('port', 'id', 'write', 'addr', 'beats', 'incr', 'data',
+        'slave', 'issued', 'accepted', 'done', 'access', 'generation',
+        'rdata')
+
+    def __init__(self, port, id, write, addr, beats, incr, data, slave):
+        self.port = port
+        self.id = id
+        self.write = write
+        self.addr = addr
+        self.beats = beats
+        self.incr = incr
+        self.data = data
+        self.slave = slave
+        self.issued = now()
+        self.accepted = None
+        self.done = None
+        self.access = None
+        self.generation = None
+        self.rdata = None
+
+    def wait(self):
+        """What to yield to wait for the response; None once it is back."""
+        if self.done is None:
+            return self.port.bus._wait(self)
+        return None
+
+class AxiPort(object):
+    """One master's connection to an :class:`AxiBus`.
+
+    :meth:`read` and :meth:`write` issue a transaction and return at once,
+    so a master can have up to ``max_outstanding`` of them in flight.  Past
+    that they return transactions the bus has yet to accept; it takes them
+    in order as those in flight finish.  The blocking accesses, the same as
+    a :class:`BusMatrix` has, issue one and wait for it.
+    """
+
+    def __init__(self, bus, master, max_outstanding):
+        self.bus = bus
+        self.master = master
+        self.max_outstanding = max_outstanding
+        # Transactions issued and not accepted yet, and how many of those
+        # accepted are not done.
+        self.queue = deque()
+        self.outstanding = 0
+        self.rdata = None
+
+        # What the master got out of the bus.
+        self.transactions = 0
+        self.bytes = 0
+        self.latency = 0
+
+    @property
+    def locked(self):
+        return False
+
+    def read(self, addr, n=1, incr=4, id=0):
+        """Issue a read of ``n`` words ``incr`` bytes apart.
+
+        :param id: Responses to reads with the same ID come back in order.
+        :returns: An :class:`AxiTransaction`.
+        """
+        return self.bus._issue(self, id, False, addr, n, incr, None)
+
+    def write(self, addr, data, incr=4, id=0):
+        """Issue a write of ``data``, anything :func:`words` takes, like
+        :meth:`read`."""
+        data = words(data)
+        return self.bus._issue(self, id, True, addr, len(data), incr, data)
+
+    def transmit(self, addr, data):
+        return self.write(addr, [data]).wait()
+
+    def receive(self, addr):
+        return self._receive(self.read(addr), True)
+
+    def transmit_block(self, addr, data, incr=4):
+        return self.write(addr, data, incr).wait()
+
+    def receive_block(self, addr, n, incr=4):
+        return self._receive(self.read(addr, n, incr), False)
+
+    def _receive(self, txn, single):
+        yield txn.wait()
+        self.rdata = txn.rdata[0] if single else txn.rdata
+
+    def delay(self, n):
+        return self.bus.delay(n)
+
+    def reset(self):
+        return self.bus.reset()
+
+class AxiMasters(object):
+    """Runs the masters of an :class:`AxiBus` side by side.
+
+    Nothing is granted; masters wait on the channels and the slaves they
+    use instead.  A master that yields :class:`Idle` is checked again every
+    cycle, or when one of its events changes if it has them, and one whose
+    step took no simulated time waits a cycle, the same as a lap of an
+    :class:`Arbiter`.
+
+    :param masters: ``[(path, generator)]``.
+    """
+
+    def __init__(self, bus, masters):
+        self.bus = bus
+        self.paths = [path for path, master in masters]
+        self.masters = [master for path, master in masters]
+
+    def run(self):
+        yield join(*(self.bus.processes() +
+            [self._drive(master) for master in self.masters]))
+
+    def _drive(self, master):
+        cycle = self.bus.cycle
+        while True:
+            start = now()
+            request = master.next()
+            if isinstance(request, Idle):
+                wait = delay(cycle)
+                if request.events:
+                    wait = tuple(request.events)
+                while not request.ready():
+                    yield wait
+                continue
+            yield request
+            if now() == start:
+                yield delay(cycle)
+
+@system.model
+class AxiBus(object):
+    """An AXI4 style interconnect at transaction level.
+
+    Reads and writes have channels of their own, so they overlap, and a
+    master can have several transactions outstanding.  A transaction takes
+    a cycle on its address channel; the slave's latency, in cycles, later
+    a read returns its words a cycle each on the read data channel, while
+    a write sends its words on the write data channel first and gets its
+    response the slave's latency after the last of them.  A channel carries
+    one address or word a cycle for all the masters, and a slave takes up
+    to its ``max_outstanding`` transactions at once; the others wait.
+
+    Behavioral slaves such as :class:`Mem` or :class:`Dma` are accessed
+    when a transaction is done: a write lands, and a read takes its words,
+    at the time its response is back.  Slaves that keep time themselves,
+    those with a true ``keeps_time`` like an :class:`Apb3Bus`, take one
+    transaction at a time, a cycle after it is accepted, and it is done
+    when they are.  Processes of the bus, run with the masters by
+    :meth:`arbiter`, do both, whether or not a master waits.
+
+    Masters connect to ``masters`` like they do to a :class:`BusMatrix`
+    and get an :class:`AxiPort` of their own from ``interface``.
+
+    :param latency: ``{slave path: cycles}``.
+    :param max_outstanding: ``{slave path: transactions}``.
+    """
+
+    def __init__(self, resetn, clk, masters, slaves, address_mask,
+            address_map=None, cycle=100, latency=None, default_latency=1,
+            max_outstanding=None, default_outstanding=4,
+            master_outstanding=4):
+        self.resetn = resetn
+        self.clk = clk
+        self.masters = masters
+        self.slaves = slaves
+        self.address_mask = address_mask
+        self.address_map = AddressMap(slaves, address_mask, address_map)
+        self.cycle = cycle
+        self.master_outstanding = master_outstanding
+        paths = self.address_map.paths
+        latency = latency or {}
+        max_outstanding = max_outstanding or {}
+        self.latencies = [latency.get(p, default_latency) for p in paths]
+        self.limits = [max_outstanding.get(p, default_outstanding)
+            for p in paths]
+        self.ports = {}
+        self.locked = False
+        self.rdata = None
+        # Whether each slave keeps time, once it has been looked up.
+        self.keeps_time = [None] * len(paths)
+        # (done, order, transaction) for the behavioral slaves, soonest
+        # first, and the transactions waiting for each slave that keeps
+        # time.  The bus processes hold on to these, so they are emptied
+        # rather than replaced.
+        self.scheduled = []
+        self.waiting = [deque() for p in paths]
+        # Toggled to wake the process that should take a transaction, and
+        # the masters waiting for one when it is done.
+        self.scheduled_event = Signal(bool(False))
+        self.waiting_events = [Signal(bool(False)) for p in paths]
+        self.done_event = Signal(bool(False))
+        self.generation = 0
+        self.order = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the transactions so far, and free the channels."""
+        # Those in flight are dropped; when they finish they count no more.
+        self.generation += 1
+        del self.scheduled[:]
+        for queue in self.waiting:
+            queue.clear()
+        self.pending = [0] * len(self.address_map.paths)
+        self.free = dict(ar=0, r=0, aw=0, w=0)
+        self.beats = dict(r=0, w=0)
+        self.last = {}
+        for port in self.ports.itervalues():
+            port.queue.clear()
+            port.outstanding = 0
+            port.transactions = port.bytes = port.latency = 0
+
+    def port(self, master=None):
+        """The :class:`AxiPort` of ``master``, a path."""
+        port = self.ports.get(master)
+        if port is None:
+            port = self.ports[master] = AxiPort(self, master,
+                self.master_outstanding)
+        return port
+
+    def interface(self, master=None):
+        return self.port(master)
+
+    def arbiter(self):
+        """An :class:`AxiMasters` for the masters of the bus, which also
+        runs its :meth:`processes`."""
+        masters = self.masters
+        if type(masters) != list:
+            masters = [masters]
+        return AxiMasters(self,
+            [(m.from_node.path, iter(m()())) for m in masters])
+
+    def reset(self):
+        self.reset_stats()
+        for slave in self.address_map.slaves():
+            yield slave.reset()
+
+    def delay(self, n):
+        return delay(n * self.cycle)
+
+    def processes(self):
+        """The generators that complete the transactions: one for the
+        behavioral slaves and one for each slave."""
+        return [self._respond()] + [self._serve(i)
+            for i in xrange(len(self.waiting))]
+
+    def _issue(self, port, id, write, addr, n, incr, data):
+        txn = AxiTransaction(port, id, write, addr, n, incr, data,
+            self.address_map.find(addr))
+        port.transactions += 1
+        port.bytes += 4 * n
+        port.queue.append(txn)
+        self._accept(port)
+        return txn
+
+    def _accept(self, port):
+        # Start the transactions of port that have slots, in order.
+        queue = port.queue
+        pending = self.pending
+        limits = self.limits
+        while queue and port.outstanding < port.max_outstanding:
+            i = queue[0].slave
+            if pending[i] >= limits[i]:
+                break
+            port.outstanding += 1
+            pending[i] += 1
+            self._start(queue.popleft())
+
+    def _start(self, txn):
+        txn.accepted = t = now()
+        txn.generation = self.generation
+        i = txn.slave
+        keeps_time = self.keeps_time[i]
+        if keeps_time is None:
+            keeps_time = self.keeps_time[i] = bool(getattr(
+                self._slave(txn), 'keeps_time', False))
+        if keeps_time:
+            self._wake(i, txn)
+            return
+
+        cycle = self.cycle
+        free = self.free
+        n = txn.beats
+        latency = self.latencies[i] * cycle
+        if txn.write:
+            t = free['aw'] = max(t, free['aw']) + cycle
+            t = free['w'] = max(t, free['w']) + n * cycle
+            done = t + latency
+            self.beats['w'] += n
+        else:
+            t = free['ar'] = max(t, free['ar']) + cycle
+            done = free['r'] = max(t + latency, free['r']) + n * cycle
+            self.beats['r'] += n
+
+        # Responses with the same ID come back in order.
+        key = (txn.port.master, txn.id, txn.write)
+        done = max(done, self.last.get(key, 0))
+        self.last[key] = done
+        self.order += 1
+        heapq.heappush(self.scheduled, (done, self.order, txn))
+        self.scheduled_event.next = not self.scheduled_event
+
+    def _slave(self, txn):
+        address_map = self.address_map
+        return address_map.containers[txn.slave] or \
+            address_map.lookup(txn.addr)
+
+    def _access(self, txn):
+        slave = self._slave(txn)
+        if txn.write:
+            return block_transmit(slave, txn.addr, txn.data, txn.incr)
+        return block_receive(txn, slave, txn.addr, txn.beats, txn.incr)
+
+    def _wake(self, i, txn):
+        event = self.waiting_events[i]
+        self.waiting[i].append(txn)
+        event.next = not event
+
+    def _done(self, txn):
+        txn.done = now()
+        self.done_event.next = not self.done_event
+        if txn.generation != self.generation:
+            return
+        port = txn.port
+        port.latency += txn.done - txn.issued
+        port.outstanding -= 1
+        self.pending[txn.slave] -= 1
+        # The slots freed may be the ones any master waits for.
+        for other in self.ports.itervalues():
+            if other.queue:
+                self._accept(other)
+
+    def _respond(self):
+        # The behavioral slaves' transactions, each when it is done.
+        scheduled = self.scheduled
+        event = self.scheduled_event
+        while True:
+            if not scheduled:
+                yield event
+                continue
+            remaining = scheduled[0][0] - now()
+            if remaining > 0:
+                yield event, delay(remaining)
+                continue
+            done, order, txn = heapq.heappop(scheduled)
+            access = self._access(txn)
+            if access is None:
+                self._done(txn)
+            else:
+                # The slave keeps time after all; it takes it from here.
+                txn.access = access
+                self.keeps_time[txn.slave] = True
+                self._wake(txn.slave, txn)
+
+    def _serve(self, i):
+        # A slave keeping time takes one transaction after the other.
+        waiting = self.waiting[i]
+        event = self.waiting_events[i]
+        while True:
+            if not waiting:
+                yield event
+                continue
+            txn = waiting.popleft()
+            yield delay(self.cycle)
+            yield txn.access or self._access(txn)
+            self._done(txn)
+
+    def _wait(self, txn):
+        while txn.done is None:
+            yield self.done_event
+
+    # The blocking accesses of the bus itself are the firmware's, as on a
+    # BusMatrix.
+    def transmit(self, addr, data):
+        return self.port().transmit(addr, data)
+
+    def receive(self, addr):
+        port = self.port()
+        access = port.receive(addr)
+        return self._complete_receive(access, port)
+
+    def _complete_receive(self, access, port):
+        yield access
+        self.rdata = port.rdata
+
+    def transmit_block(self, addr, data, incr=4):
+        return self.port().transmit_block(addr, data, incr)
+
+    def receive_block(self, addr, n, incr=4):
+        port = self.port()
+        return self._complete_receive(port.receive_block(addr, n, incr), port)
+
+    def stats(self, f):
+        """Write how busy the data channels were and what each master got
+        out of the bus to ``f``.
+
+        Outstanding is the mean number of transactions in flight, of each
+        master and of all of them; a :class:`BusMatrix` never has more than
+        one.
+        """
+        elapsed = now()
+        if not elapsed:
+            return
+        f.write('%-24s %8s %10s %12s %12s\n' % ('master', 'count', 'bytes',
+            'latency ns', 'outstanding'))
+        total = 0
+        for master in sorted(self.ports, key=str):
+            port = self.ports[master]
+            if not port.transactions:
+                continue
+            total += port.latency
+            f.write('%-24s %8d %10d %12.1f %12.2f\n' % (master or '(firmware)',
+                port.transactions, port.bytes,
+                float(port.latency) / port.transactions,
+                float(port.latency) / elapsed))
+        f.write('%-24s %45.2f\n' % ('all masters', float(total) / elapsed))
+        for channel in ('r', 'w'):
+            f.write('%-24s %7.1f%%\n' % ('%s channel busy' % channel.upper(),
+                100.0 * self.beats[channel] * self.cycle / elapsed))
+
+    @classmethod
+    def create(cls, parent_path, name, resetn, clk, address_mask, cycle=100,
+            latency=None, max_outstanding=None, master_outstanding=4):
+        """Create an AXI interconnect.
+
+        :param cycle: The clock period in ns.
+        :param latency: ``{slave path: cycles}``; other slaves take one.
+        :param max_outstanding: ``{slave path: transactions}``; other
+                                slaves take four.
+        :param master_outstanding: How many transactions each master can
+                                   have in flight.
+        """
+        path = lambda node, name: '%s#%s' % (node.path, name)
+        kwargs = { 'address_mask': address_mask, 'cycle': cycle,
+            'master_outstanding': master_outstanding }
+        if latency:
+            kwargs['latency'] = latency
+        if max_outstanding:
+            kwargs['max_outstanding'] = max_outstanding
+        self = system.add_node(parent_path, name, 'AxiBus', kwargs)
+        system.add_edge('CallAttrEdge',
+            path(resetn, 'signals_dict'),
+            path(self, 'resetn'),
+            dict(name='resetn'))
+        system.add_edge('CallAttrEdge',
+            path(clk, 'out'),
+            path(self, 'clk'),
+            dict(name='clk'))
+        return self
+
+    @classmethod
+    def set_latency(cls, bus, slave, cycles, max_outstanding=None):
+        """Give ``slave`` of ``bus`` a latency and outstanding limit."""
+        latency = dict(bus.kwargs.get('latency') or {})
+        latency[slave.path] = cycles
+        system.update_kwargs(bus.path, latency=latency)
+        if max_outstanding is not None:
+            limits = dict(bus.kwargs.get('max_outstanding') or {})
+            limits[slave.path] = max_outstanding
+            system.update_kwargs(bus.path, max_outstanding=limits)
+
+def create_interconnect(parent_path, name, resetn, clk, duration,
+        address_mask):
+    """The interconnect of a SoC: a :class:`BusMatrix`, or an :class:`AxiBus`
+    if ``$DCC_BUS`` is ``axi``.  Either takes the same slaves and masters,
+    and runs at the 100 ns cycle the other buses do.
+    """
+    kind = os.environ.get('DCC_BUS', 'matrix')
+    if kind == 'axi':
+        return AxiBus.create(parent_path, name, resetn, clk, address_mask)
+    if kind != 'matrix':
+        raise ValueError, 'Unknown interconnect %r in $DCC_BUS' % (kind,)
+    return BusMatrix.create(parent_path, name, resetn, clk, duration,
+        address_mask)
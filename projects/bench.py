@@ -0,0 +1,983 @@
+"""Benchmarks for the system database and the models that hang off of it.
+
+Run every benchmark with ``python bench.py``, or name the ones you want::
+
+    python bench.py elaboration
+"""
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+from system import *
+s = System('bench')
+from soc import *
+
+benchmarks = []
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+def build_tree(parent_path, n, fanout=8):
+    """Add ``n`` Flag nodes below ``parent_path`` as a balanced tree; every
+    node gets an edge to its parent so both paths are resolved per node."""
+    path = lambda node, name: '%s#%s' % (node.path, name)
+    top = system.add_node(parent_path, 'top', 'Flag', {'default': False})
+    queue = deque([top])
+    count = 1
+    while count < n:
+        parent = queue.popleft()
+        for i in xrange(min(fanout, n - count)):
+            node = system.add_node(parent.path, 'n%d' % i, 'Flag',
+                    {'default': False})
+            system.add_edge('CallAttrEdge',
+                path(parent, 'signals_dict'),
+                path(node, 'parent'))
+            queue.append(node)
+            count += 1
+    return top
+
+@benchmark
+def elaboration():
+    """Time to add nodes and edges should grow linearly with node count.
+
+    The collector is off while building, the same as in ``System.load``.
+    """
+    print '%10s %10s %12s' % ('nodes', 'seconds', 'us/node')
+    for n in (1000, 2000, 4000, 8000, 16000, 32000):
+        system.add_node('/', 'elaboration%d' % n, 'Flag', {'default': False})
+        gc.disable()
+        start = time.time()
+        build_tree('/elaboration%d' % n, n)
+        elapsed = time.time() - start
+        gc.enable()
+        print '%10d %10.3f %12.2f' % (n, elapsed, 1e6 * elapsed / n)
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print '%-24s %8.3f s' % (label, time.time() - start)
+    return result
+
+@benchmark
+def snapshot():
+    """Restoring a 100k node design from a dump or snapshot should take
+    a fraction of the time it took to elaborate it."""
+    system.clear()
+    system.add_node('/', 'snapshot', 'Flag', {'default': False})
+    with system._elaborating():
+        timed('elaborate', build_tree, '/snapshot', 100000)
+
+    fd, dump_path = tempfile.mkstemp(suffix='.jsonl')
+    with os.fdopen(fd, 'w') as f:
+        timed('dump', system.dump, f)
+    fd, snapshot_path = tempfile.mkstemp(suffix='.snap')
+    os.close(fd)
+    timed('save_snapshot', system.save_snapshot, snapshot_path)
+    print '%-24s %8d bytes' % ('dump size', os.path.getsize(dump_path))
+    print '%-24s %8d bytes' % ('snapshot size', os.path.getsize(snapshot_path))
+
+    system.clear()
+    gc.collect()
+    timed('load_dump', system.load_dump, dump_path)
+    system.clear()
+    gc.collect()
+    timed('load_snapshot', system.load_snapshot, snapshot_path)
+    system.clear()
+    gc.collect()
+    os.remove(dump_path)
+    os.remove(snapshot_path)
+
+@benchmark
+def walk():
+    """Walking, dumping and drawing trees far deeper than the recursion
+    limit, and a wide 100k node tree."""
+    system.clear()
+    depth = 4 * sys.getrecursionlimit()
+    def chain():
+        node = system.add_node('/', 'deep', 'Flag', {'default': False})
+        for i in xrange(depth):
+            node = system._add_child(node, 'n', 'Flag', {'default': False})
+    with system._elaborating():
+        timed('build /deep', chain)
+        system.add_node('/', 'wide', 'Flag', {'default': False})
+        build_tree('/wide', 100000)
+    gc.collect()
+
+    for root in ('/deep', '/wide'):
+        print root
+        for order in ('pre', 'post', 'bfs'):
+            timed('  walk %s' % order, lambda: sum(1 for n in
+                system.walk(root, order)))
+        timed('  first leaf', lambda: next(n for n in system.walk(root)
+            if not n.children))
+        timed('  resource-tree', system.dispatch, root + '/resource-tree.latex')
+        timed('  nodes_of_class', system.nodes_of_class, 'Flag', root)
+    with open(os.devnull, 'w') as f:
+        timed('dump', system.dump, f)
+    system.clear()
+
+def rss():
+    """Resident set size of this process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+@benchmark
+def memory():
+    """Resident memory of a synthetic 1M node graph with one edge per
+    node."""
+    n = 1000000
+    system.clear()
+    gc.collect()
+    before = rss()
+    system.add_node('/', 'memory', 'Flag', {'default': False})
+    with system._elaborating():
+        timed('elaborate', build_tree, '/memory', n)
+    used = rss() - before
+    print '%-24s %8.1f MB' % ('rss', used / 2.0**20)
+    print '%-24s %8.1f' % ('bytes/node', float(used) / n)
+    system.clear()
+    gc.collect()
+
+@benchmark
+def startup():
+    """Time to import each project in a fresh interpreter, best of five,
+    and which of the heavy optional packages that pulled in.  project1
+    should stay under 200 ms."""
+    script = ';'.join([
+        'import sys, time',
+        't = time.time()',
+        'import %s',
+        't = time.time() - t',
+        'heavy = [m for m in (\'numpy\', \'scipy\', \'matplotlib\') '
+            'if m in sys.modules]',
+        'sys.stderr.write(\'%%f %%s\\n\' %% (t, \' \'.join(heavy)))',
+    ])
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull, 'w') as devnull:
+        for project in ('project1', 'project2', 'project3'):
+            best = None
+            for i in xrange(5):
+                p = subprocess.Popen([sys.executable, '-c', script % project],
+                    cwd=here, stdout=devnull, stderr=subprocess.PIPE)
+                t, heavy = p.communicate()[1].splitlines()[-1].split(' ', 1)
+                best = min(best or float(t), float(t))
+            print '%-24s %8.3f s  %s' % (project, best, heavy)
+
+@benchmark
+def bus():
+    """Firmware writing and reading back words of a Mem behind an APB bus,
+    a word per call and as one block, at pin level and at transaction
+    level, traced like the projects are.  Pin and transaction level should
+    take the same simulated time, transaction level at least 10x less wall
+    time."""
+    from myhdl import Simulation, StopSimulation, now, traceSignals
+    from root import simulation
+    words = 1000
+    trace_dir = tempfile.mkdtemp()
+
+    def firmware():
+        root = system.root.container
+        yield root.reset()
+        for i in xrange(words):
+            yield root.transmit(4 * i, i)
+        for i in xrange(words):
+            yield root.receive(4 * i)
+            assert root.rdata == i
+        raise StopSimulation
+
+    def block_firmware():
+        root = system.root.container
+        yield root.reset()
+        yield root.transmit_block(0, range(words))
+        yield root.receive_block(0, words)
+        assert list(root.rdata) == range(words)
+        raise StopSimulation
+
+    print '%-18s %10s %12s' % ('mode', 'seconds', 'simulated us')
+    times = {}
+    for mode in ('pin', 'transaction'):
+        for label, func in (('word', firmware), ('block', block_firmware)):
+            system.clear()
+            resetn = Reset.create_and_connect('/', 'resetn', async=False)
+            clk = Clock.create_and_connect('/', 'clk', int(10e6))
+            soc = BusMatrix.create('/', 'soc', resetn, clk,
+                duration=int(10e6), address_mask=0xffff)
+            pbus = Apb3Bus.create('/soc', 'pbus', soc, mode=mode)
+            Mem.create_and_connect('/soc/pbus', 'mem', pbus, width=32,
+                depth=words)
+            cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
+
+            # Building containers and the simulation prints a lot.
+            name = '%s %s' % (mode, label)
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    # Elaborated first, as run() does, so that building the
+                    # containers isn't timed.
+                    system.elaborate()
+                    cpu.container.program(func)
+                    traceSignals.name = os.path.join(trace_dir, label)
+                    sim = Simulation(traceSignals(simulation, soc.container,
+                        []))
+                    start = time.time()
+                    sim.run()
+                    times[name] = time.time() - start
+                finally:
+                    sys.stdout = stdout
+            print '%-18s %10.3f %12.1f' % (name, times[name], now() / 1e3)
+    print '%-18s %10.1fx' % ('transaction speedup',
+        times['pin word'] / times['transaction word'])
+    shutil.rmtree(trace_dir)
+    system.clear()
+
+@benchmark
+def decode():
+    """BusMatrix address decode; the cost of an access should not grow
+    with the number of slaves.  Slaves of a page or more are found in the
+    page table, smaller ones by bisecting the ranges."""
+    import random
+    accesses = 100000
+    print '%10s %14s %14s' % ('slaves', '64 B ns/access', '4 KiB ns/access')
+    for n in (16, 256, 1024):
+        row = []
+        for depth in (16, 1024):
+            system.clear()
+            resetn = Reset.create_and_connect('/', 'resetn', async=False)
+            clk = Clock.create_and_connect('/', 'clk', int(10e6))
+            soc = BusMatrix.create('/', 'soc', resetn, clk,
+                duration=int(10e6), address_mask=0xffff)
+            Cpu.create_and_connect('/soc', 'cpu', soc)
+            for i in xrange(n):
+                Mem.create_and_connect('/soc', 'mem%d' % i, soc, width=32,
+                    depth=depth, base=0x10000000 + i * 0x1000)
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    lookup = soc.container._lookup_slave
+                finally:
+                    sys.stdout = stdout
+
+            random.seed(n)
+            addrs = [0x10000000 + random.randrange(n) * 0x1000 +
+                4 * random.randrange(depth) for j in xrange(accesses)]
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    # The first pass builds the containers and page table.
+                    for addr in addrs:
+                        lookup(addr)
+                finally:
+                    sys.stdout = stdout
+            start = time.time()
+            for addr in addrs:
+                lookup(addr)
+            row.append(1e9 * (time.time() - start) / accesses)
+        print '%10d %14.0f %14.0f' % (n, row[0], row[1])
+    system.clear()
+
+@benchmark
+def arbiter():
+    """Firmware writing to a Mem while idle DMA masters share the bus.
+    Idle masters are parked, so neither wall nor simulated time should
+    grow with how many there are."""
+    from myhdl import Simulation, StopSimulation, now
+    from root import simulation
+    words = 500
+
+    def firmware():
+        root = system.root.container
+        yield root.reset()
+        for i in xrange(words):
+            yield root.transmit(4 * i, i)
+        raise StopSimulation
+
+    print '%10s %10s %12s' % ('idle dmas', 'seconds', 'simulated us')
+    for n in (0, 4, 16, 64):
+        system.clear()
+        resetn = Reset.create_and_connect('/', 'resetn', async=False)
+        clk = Clock.create_and_connect('/', 'clk', int(10e6))
+        soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+            address_mask=0xffff)
+        pbus = Apb3Bus.create('/soc', 'pbus', soc, mode='transaction',
+            base=0x10000, size=0x10000)
+        Mem.create_and_connect('/soc', 'mem', soc, width=32, depth=words,
+            base=0)
+        ready = Flag.create_and_connect('/soc', 'ready', True)
+        for i in xrange(n):
+            Dma.create_and_connect('/soc', 'dma%d' % i, soc, ready,
+                base=0x20000 + Dma.stride * i, channels=1)
+        cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
+
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cpu.container.program(firmware)
+                bus = soc.container
+                start = time.time()
+                Simulation(simulation(bus, [])).run()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+        print '%10d %10.3f %12.1f' % (n, elapsed, now() / 1e3)
+    system.clear()
+
+@benchmark
+def recorder():
+    """Firmware writing to a Mem with and without a BusRecorder on the
+    BusMatrix; recording should cost little next to the simulation."""
+    from myhdl import Simulation, StopSimulation
+    from root import simulation
+    words = 5000
+
+    def firmware():
+        root = system.root.container
+        yield root.reset()
+        for i in xrange(words):
+            yield root.transmit(4 * i, i)
+        raise StopSimulation
+
+    print '%-10s %10s %10s' % ('recording', 'seconds', 'records')
+    for record in (False, True):
+        system.clear()
+        resetn = Reset.create_and_connect('/', 'resetn', async=False)
+        clk = Clock.create_and_connect('/', 'clk', int(10e6))
+        soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+            address_mask=0xffff)
+        Mem.create_and_connect('/soc', 'mem', soc, width=32, depth=words,
+            base=0)
+        cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
+
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cpu.container.program(firmware)
+                bus = soc.container
+                recorder = bus.record(chunk=1024) if record else None
+                start = time.time()
+                Simulation(simulation(bus, [])).run()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+        print '%-10s %10.3f %10d' % (record, elapsed,
+            len(recorder.records) if recorder else 0)
+    system.clear()
+
+@benchmark
+def ram():
+    """Building a Ram and simulating a thousand writes and reads through
+    its ports, as HDL and with the behavioral model.  The model should
+    cost the same at any depth; the HDL, whose reader wakes on every word,
+    is only run while that takes seconds."""
+    # Imported up front so it isn't counted in the model's memory.
+    import numpy
+    from myhdl import Simulation, StopSimulation, delay, instance
+    writes = 1000
+
+    def test(ram):
+        @instance
+        def driver():
+            clk = ram.port_a()['clk']
+            for i in xrange(writes):
+                ram.addra.next = i
+                ram.dina.next = i
+                ram.blka.next = False
+                ram.wena.next = False
+                yield delay(50)
+                clk.next = True
+                yield delay(50)
+                clk.next = False
+            ram.wena.next = True
+            for i in xrange(writes):
+                ram.addra.next = i
+                yield delay(50)
+                clk.next = True
+                yield delay(50)
+                clk.next = False
+                assert ram.douta == i
+            raise StopSimulation
+        return driver
+
+    print '%10s %-6s %10s %10s %10s' % ('depth', 'model', 'build s',
+        'run s', 'rss MB')
+    for depth in (1024, 4096, 65536):
+        for behavioral in (False, True):
+            if depth > 4096 and not behavioral:
+                continue
+            system.clear()
+            gc.collect()
+            resetn = Reset.create_and_connect('/', 'resetn', async=False)
+            clk = Clock.create_and_connect('/', 'clk', int(10e6))
+            node = Ram.create_and_connect('/', 'ram', resetn, clk, clk,
+                width=32, depth=depth, behavioral=behavioral)
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    ram = node.container
+                    signals = ram.signals_dict()
+                finally:
+                    sys.stdout = stdout
+            before = rss()
+            start = time.time()
+            instances = ram.instance(**signals)
+            built = time.time() - start
+            used = rss() - before
+            start = time.time()
+            Simulation(instances, test(ram)).run()
+            print '%10d %-6s %10.3f %10.3f %10.1f' % (depth,
+                'numpy' if behavioral else 'hdl', built, time.time() - start,
+                used / 2.0**20)
+            del instances
+    system.clear()
+
+@benchmark
+def image():
+    """Preloading a 4 MiB image into a Ram and a Mem, against filling the
+    Mem a word at a time as firmware would.  Loading a whole Ram maps the
+    file, so it should take no time at all."""
+    import numpy as np
+    from mem import write_image
+    words = 1 << 20
+    image_dir = tempfile.mkdtemp()
+    data = np.arange(words, dtype='<u4')
+
+    system.clear()
+    resetn = Reset.create_and_connect('/', 'resetn', async=False)
+    clk = Clock.create_and_connect('/', 'clk', int(10e6))
+    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+        address_mask=0xffff)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            ram = Ram.create_and_connect('/', 'ram', resetn, clk, clk,
+                width=32, depth=words).container
+            mem = Mem.create_and_connect('/soc', 'mem', soc, width=32,
+                depth=words).container
+        finally:
+            sys.stdout = stdout
+
+    for fmt in ('bin', 'npy', 'hex'):
+        path = os.path.join(image_dir, 'image.' + fmt)
+        timed('write %s' % fmt, write_image, path, data, 32, fmt)
+        ram.mem = None
+        timed('  Ram.load_image', ram.load_image, path, fmt)
+        timed('  Mem.load_image', mem.load_image, path, fmt)
+    def transmit():
+        for i in xrange(words):
+            mem.transmit(4 * i, i)
+    timed('Mem.transmit per word', transmit)
+    shutil.rmtree(image_dir)
+    system.clear()
+
+@benchmark
+def mem():
+    """A 1 GiB Mem mapped at 0x40000000 should only allocate the pages
+    written, and block accesses should cost a fraction of a word each."""
+    import resource
+    system.clear()
+    resetn = Reset.create_and_connect('/', 'resetn', async=False)
+    clk = Clock.create_and_connect('/', 'clk', int(10e6))
+    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+        address_mask=0xffffffff)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            ddr = Mem.create_and_connect('/soc', 'ddr', soc, width=32,
+                depth=1 << 28, base=0x40000000).container
+        finally:
+            sys.stdout = stdout
+
+    words = 1 << 18
+    block = range(words)
+    def scattered():
+        for i in xrange(words):
+            ddr.transmit(0x40000000 + (i * 0x10004 & 0x3ffffffc), i)
+    def blocks():
+        for addr in xrange(0x40000000, 0x40000000 + 64 * 4 * words,
+                64 * 4 * words // 16):
+            ddr.transmit_block(addr, block[:words // 16])
+            ddr.receive_block(addr, words // 16)
+    timed('words scattered', scattered)
+    timed('blocks', blocks)
+    print '%-24s %8d' % ('pages', len(ddr.pages))
+    print '%-24s %8.1f MiB' % ('max resident',
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    system.clear()
+
+@benchmark
+def axi():
+    """Firmware writing words to one Mem while a DMA copies another, on a
+    BusMatrix with the Mems behind a transaction level APB bus and on an
+    AxiBus, then on an AxiBus with the firmware issuing four writes, and
+    reading four words back, before waiting for any of them.  The AXI
+    masters overlap, so it should take less simulated time; its stats
+    show by how much, and pipelined firmware should have more than one
+    transaction outstanding."""
+    from myhdl import Simulation, StopSimulation, now
+    from root import simulation
+    words = 500
+    depth = 4
+
+    def start_dma(root):
+        return root.transmit_block(0x40000, [0x10000, 4, 0x20000, 4, words])
+
+    def wait_dma(root):
+        while True:
+            yield root.receive(0x40010)
+            if not root.rdata:
+                break
+
+    def firmware():
+        root = system.root.container
+        yield root.reset()
+        yield start_dma(root)
+        for i in xrange(words):
+            yield root.transmit(4 * i, i)
+        yield wait_dma(root)
+        raise StopSimulation
+
+    def pipelined_firmware():
+        root = system.root.container
+        yield root.reset()
+        yield start_dma(root)
+        port = root.soc.port()
+        for i in xrange(0, words, depth):
+            writes = [port.write(4 * j, [j]) for j in xrange(i, i + depth)]
+            for txn in writes:
+                yield txn.wait()
+        for i in xrange(0, words, depth):
+            reads = [port.read(4 * j) for j in xrange(i, i + depth)]
+            for j, txn in enumerate(reads, i):
+                yield txn.wait()
+                assert txn.rdata[0] == j
+        yield wait_dma(root)
+        raise StopSimulation
+
+    print '%-14s %10s %12s' % ('bus', 'seconds', 'simulated us')
+    for kind, program in (('matrix', firmware), ('axi', firmware),
+            ('axi pipelined', pipelined_firmware)):
+        system.clear()
+        resetn = Reset.create_and_connect('/', 'resetn', async=False)
+        clk = Clock.create_and_connect('/', 'clk', int(10e6))
+        if kind == 'matrix':
+            soc = BusMatrix.create('/', 'soc', resetn, clk,
+                duration=int(10e6), address_mask=0xffff)
+            mems = Apb3Bus.create('/soc', 'pbus', soc, mode='transaction',
+                base=0, size=0x40000)
+        else:
+            soc = mems = AxiBus.create('/', 'soc', resetn, clk,
+                address_mask=0xffff)
+        for i, base in enumerate((0, 0x10000, 0x20000)):
+            Mem.create_and_connect(mems.path, 'mem%d' % i, mems, width=32,
+                depth=words, base=base)
+        ready = Flag.create_and_connect('/soc', 'ready', True)
+        Dma.create_and_connect('/soc', 'dma', soc, ready, base=0x40000)
+        cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
+
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cpu.container.program(program)
+                bus = soc.container
+                start = time.time()
+                Simulation(simulation(bus, [])).run()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+        print '%-14s %10.3f %12.1f' % (kind, elapsed, now() / 1e3)
+        if kind != 'matrix':
+            bus.stats(sys.stdout)
+    system.clear()
+
+@benchmark
+def dma():
+    """Throughput of Dma copies between two Mems behind a transaction level
+    APB bus, in words per simulated microsecond: a word a grant as before,
+    bursts, a descriptor chain and four channels at once."""
+    from myhdl import Simulation, StopSimulation, now
+    from root import simulation
+    words = 4096
+    src, dest, descriptors, dma = 0, 0x10000, 0x20000, 0x40000
+    burst = lambda n: n << 16
+
+    def single(root, ctrl):
+        yield root.transmit_block(dma, [src, 4, dest, 4, words, ctrl])
+    def chain(root):
+        n = 16
+        size = words // n
+        for i in xrange(n):
+            next_ = descriptors + 28 * (i + 1) if i < n - 1 else 0
+            yield root.transmit_block(descriptors + 28 * i, [
+                src + 4 * size * i, 4, dest + 4 * size * i, 4, size,
+                burst(16), next_])
+        yield root.transmit(dma + 0x18, descriptors)
+    def channels(root):
+        size = words // 4
+        for c in xrange(4):
+            yield root.transmit_block(dma + 0x40 * c, [src + 4 * size * c, 4,
+                dest + 4 * size * c, 4, size, burst(16)])
+    cases = [
+        ('word a grant', lambda root: single(root, 0)),
+        ('burst 16', lambda root: single(root, burst(16))),
+        ('burst 64', lambda root: single(root, burst(64))),
+        ('16 descriptors', chain),
+        ('4 channels', channels),
+    ]
+
+    print '%-16s %10s %14s' % ('transfer', 'seconds', 'words per us')
+    for label, program in cases:
+        def firmware():
+            root = system.root.container
+            yield root.reset()
+            start = now()
+            yield program(root)
+            busy = True
+            while busy:
+                yield root.delay(50)
+                busy = False
+                for c in xrange(4):
+                    for register in (0x10, 0x18):
+                        yield root.receive(dma + 0x40 * c + register)
+                        busy = busy or bool(root.rdata)
+            result.append(words * 1e3 / (now() - start))
+            raise StopSimulation
+
+        system.clear()
+        resetn = Reset.create_and_connect('/', 'resetn', async=False)
+        clk = Clock.create_and_connect('/', 'clk', int(10e6))
+        soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+            address_mask=0xffff)
+        mems = Apb3Bus.create('/soc', 'pbus', soc, mode='transaction',
+            base=0, size=0x40000)
+        for i, base in enumerate((src, dest, descriptors)):
+            Mem.create_and_connect(mems.path, 'mem%d' % i, mems, width=32,
+                depth=words, base=base)
+        Dma.create_and_connect('/soc', 'dma', soc, base=dma)
+        cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
+
+        result = []
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cpu.container.program(firmware)
+                start = time.time()
+                Simulation(simulation(soc.container, [])).run()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+        print '%-16s %10.3f %14.2f' % (label, elapsed, result[0])
+    system.clear()
+
+@benchmark
+def irq():
+    """project3 with its DmaSink polling the DMA and waiting on the DMA's
+    interrupt: the CPU's bus accesses, how busy they kept the bus and how
+    busy it was in all.  With the interrupt the CPU should hardly use the
+    bus; the DMA keeps it busy either way."""
+    script = '\n'.join([
+        'import os, sys',
+        'sys.path.insert(0, %r)',
+        'os.environ[\'MPLBACKEND\'] = \'Agg\'',
+        'import project3',
+        'from myhdl import now',
+        'from system import system',
+        'system.load()',
+        'system.elaborate()',
+        'if %r:',
+        '    system.update_kwargs(\'/soc/cpu/daemon/dsp/dma_sink\', irq=None)',
+        'system.dispatch(\'/test_project3.vcd\')',
+        'sys.stderr.write(\'%%d\\n\' %% now())',
+    ])
+    here = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp()
+    record = os.path.join(work, 'bus.txt')
+    env = dict(os.environ, DCC_RECORD_BUS=record)
+    print '%-10s %10s %10s %10s %10s %12s' % ('daemon', 'seconds',
+        'cpu count', 'cpu busy', 'bus busy', 'simulated us')
+    with open(os.devnull, 'w') as devnull:
+        for label, polled in (('polled', True), ('interrupt', False)):
+            start = time.time()
+            p = subprocess.Popen([sys.executable, '-c', script % (here, polled)],
+                cwd=work, env=env, stdout=devnull, stderr=subprocess.PIPE)
+            simulated = int(p.communicate()[1].splitlines()[-1])
+            elapsed = time.time() - start
+            count = cycles = 0
+            busy = []
+            with open(record) as f:
+                for line in f:
+                    if line.startswith('/soc/cpu '):
+                        # A cycle an access, and its wait states.
+                        count = int(line.split()[1])
+                        cycles = count + int(line.split()[-1])
+                    elif line.rstrip().endswith('%'):
+                        busy.append(float(line.split()[-1][:-1]))
+            print '%-10s %10.3f %10d %9.1f%% %9.1f%% %12.1f' % (label,
+                elapsed, count, 100 * cycles * 100. / simulated,
+                sum(busy) / len(busy), simulated / 1e3)
+    shutil.rmtree(work)
+
+@benchmark
+def interconnect():
+    """project1 and project3 with their SoC on a BusMatrix and on an
+    AxiBus, chosen by $DCC_BUS.  Both should pass their tests, and
+    project3 should capture the same samples on either."""
+    script = '\n'.join([
+        'import os, sys',
+        'sys.path.insert(0, %r)',
+        'os.environ[\'MPLBACKEND\'] = \'Agg\'',
+        'import %s as project',
+        'from myhdl import now',
+        'from system import system',
+        'system.load()',
+        'system.elaborate()',
+        'system.dispatch(%r)',
+        'soc = system.node_at_path(\'/soc\')',
+        'scope = %r and system.node_at_path(%r).container',
+        'sys.stderr.write(\'%%s %%d %%r\\n\' %% (soc.cls, now(),',
+        '    scope and [int(y) for y in scope.samples]))',
+    ])
+    # The test stops once it has enough samples, so one bus may get a few
+    # more than the other; those it both got must agree.
+    same = lambda a, b: a is None and b is None or \
+        a is not None and b is not None and a[:len(b)] == b[:len(a)]
+    here = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp()
+    print '%-10s %-10s %10s %12s %10s %8s' % ('project', 'bus', 'seconds',
+        'simulated us', 'samples', 'same')
+    with open(os.devnull, 'w') as devnull:
+        for project, view, scope in (
+                ('project1', '/soc/test_project1.vcd', None),
+                ('project3', '/test_project3.vcd',
+                    '/soc/pbus/project3/dsp/scope')):
+            samples = {}
+            for kind in ('matrix', 'axi'):
+                start = time.time()
+                p = subprocess.Popen([sys.executable, '-c', script % (here,
+                    project, view, scope, scope)], cwd=work,
+                    env=dict(os.environ, DCC_BUS=kind), stdout=devnull,
+                    stderr=subprocess.PIPE)
+                err = p.communicate()[1]
+                elapsed = time.time() - start
+                if p.returncode:
+                    print '%-10s %-10s failed' % (project, kind)
+                    sys.stdout.write(err)
+                    continue
+                cls, simulated, rest = err.splitlines()[-1].split(' ', 2)
+                samples[kind] = eval(rest)
+                print '%-10s %-10s %10.3f %12.1f %10d %8s' % (project, cls,
+                    elapsed, int(simulated) / 1e3, len(samples[kind] or []),
+                    same(samples[kind], samples.get('matrix')))
+    shutil.rmtree(work)
+
+@benchmark
+def alloc():
+    """Laying out a flowgraph of 48 nets of mixed depths in a Mem, then
+    100k allocations and frees of ring sized blocks; each should take a
+    few microseconds."""
+    import random
+    from alloc import Allocator
+    from cpu import DspFlowController
+    from dsp import DspFlow
+    system.clear()
+    resetn = Reset.create_and_connect('/', 'resetn', async=False)
+    clk = Clock.create_and_connect('/', 'clk', int(10e6))
+    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+        address_mask=0xffffff)
+    Mem.create_and_connect('/soc', 'ddr', soc, width=32, depth=1 << 20,
+        base=0)
+    Cpu.create_and_connect('/soc', 'cpu', soc)
+    dsp = DspFlowController.create_and_connect('/soc/cpu', 'daemon')
+    nets = [DspFlow.create_net(dsp, 'net%d' % i, width=32,
+        depth=256 << (i % 6)) for i in xrange(48)]
+
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            nets = [net.container for net in nets]
+            start = time.time()
+            spans = sorted((net.mem(), net.depth) for net in nets)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+    overlaps = sum(1 for a, b in zip(spans, spans[1:]) if a[0] + a[1] > b[0])
+    print '%-24s %8.3f s' % ('48 nets', elapsed)
+    print '%-24s %8d' % ('overlaps', overlaps)
+    heap = system.root.container.heap
+    print '%-24s %8d' % ('high water', heap.high_water)
+
+    heap = Allocator([(0, 1 << 24)])
+    rnd = random.Random(0)
+    sizes = [rnd.choice((512, 1024, 4096, 16384)) for i in xrange(100000)]
+    def churn():
+        live = []
+        for i, size in enumerate(sizes):
+            if len(live) > 64:
+                heap.free(live.pop(rnd.randrange(len(live))))
+            heap.alloc(i, size)
+            live.append(i)
+    timed('100k alloc and free', churn)
+    stats = heap.stats()
+    print '%-24s %7.1f%%' % ('external fragmentation', 100 * stats['external'])
+    system.clear()
+
+@benchmark
+def signal():
+    """SignalSource samples per second for each waveform, generated and
+    quantized in 4096 sample blocks, against a Python loop quantizing a
+    sample at a time; and how far blocks of 64 stray from one long block,
+    which continuous phase keeps at rounding error."""
+    import numpy as np
+    from cpu import SignalSource, quantize
+    n = 1 << 20
+    def source(**kwargs):
+        return SignalSource(None, lambda: 1e3, lambda: 48e3, seed=1, **kwargs)
+    cases = [
+        ('sine', dict()),
+        ('tones', dict(waveform='tones',
+            tones=[(1e3, 0.3), (3.1e3, 0.3), (7.7e3, 0.3)])),
+        ('chirp', dict(waveform='chirp', chirp_to=20e3, chirp_time=0.01)),
+        ('noise', dict(waveform='noise', noise=0.25)),
+    ]
+    print '%-10s %14s %14s' % ('waveform', 'samples/s', 'block error')
+    for label, kwargs in cases:
+        src = source(**kwargs)
+        start = time.time()
+        for i in xrange(n // 4096):
+            quantize(src.generate(4096))
+        rate = n / (time.time() - start)
+        whole = source(**kwargs).generate(4096)
+        src = source(**kwargs)
+        blocks = np.concatenate([src.generate(64) for i in xrange(64)])
+        print '%-10s %14.0f %14.2e' % (label, rate,
+            abs(whole - blocks).max())
+    samples = source().generate(n // 16)
+    start = time.time()
+    for x in samples:
+        int(max(-2**31, min(2**31 - 1, round(x * 2**31))))
+    print '%-10s %14.0f' % ('per sample', len(samples) / (time.time() - start))
+
+@benchmark
+def ring():
+    """1M words written to and read from a 4 KiB MemFifoDspNet in blocks
+    of 64, in place through acquire and commit and with the Mem's block
+    accesses; and a check that what went in came out across the wraps."""
+    import numpy as np
+    from cpu import DspFlowController
+    from dsp import DspFlow
+    system.clear()
+    resetn = Reset.create_and_connect('/', 'resetn', async=False)
+    clk = Clock.create_and_connect('/', 'clk', int(10e6))
+    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+        address_mask=0xffff)
+    mem = Mem.create_and_connect('/soc', 'mem', soc, width=32, depth=4096,
+        base=0)
+    Cpu.create_and_connect('/soc', 'cpu', soc)
+    dsp = DspFlowController.create_and_connect('/soc/cpu', 'daemon')
+    net = DspFlow.create_net(dsp, 'ring', width=32, depth=4096)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            net = net.container
+            mem = mem.container
+            net.mem()
+        finally:
+            sys.stdout = stdout
+
+    words = 1 << 20
+    block = np.arange(64, dtype=np.int32)
+    def write_in_place():
+        for i in xrange(words // 64):
+            n = 0
+            for part in net.acquire_write(64):
+                part[:] = block[n:n + len(part)]
+                n += len(part)
+            net.commit_write(64)
+            net.release_read(64)
+    def read_in_place():
+        total = 0
+        for i in xrange(words // 64):
+            net.commit_write(64)
+            for part in net.acquire_read(64):
+                total += int(part.sum())
+            net.release_read(64)
+        return total
+    def write_bus():
+        for i in xrange(words // 64):
+            mem.transmit_block((i * 256) & 0xfff, block)
+    def read_bus():
+        total = 0
+        for i in xrange(words // 64):
+            mem.receive_block((i * 256) & 0xfff, 64)
+            total += sum(mem.rdata)
+        return total
+    timed('write in place', write_in_place)
+    timed('transmit_block', write_bus)
+    total = timed('read in place', read_in_place)
+    timed('receive_block', read_bus)
+    print '%-24s %8s' % ('data intact', total == words // 64 * int(block.sum()))
+    system.clear()
+
+@benchmark
+def scope():
+    """1M samples into a ScopeSink's Capture, as its sampler adds them,
+    against the list it used to append to and print: kept whole, triggered
+    with pretrigger, decimated, and spilled to a .npy file; then how long
+    getting at the samples takes."""
+    import numpy as np
+    from dsp import Capture
+    n = 1 << 20
+    samples = [int(x) for x in
+        (np.sin(np.arange(n) * 0.001) * 2**30).astype(int)]
+    def run(capture):
+        # What the sampler does.
+        raw = capture.raw
+        cursor = capture.cursor
+        size = len(raw)
+        for x in samples:
+            n = cursor[0]
+            raw[n] = x
+            cursor[0] = n = n + 1
+            if n == size:
+                capture.flush()
+        return capture
+    def old():
+        kept = []
+        for x in samples:
+            kept.append(x)
+        with open(os.devnull, 'w') as f:
+            f.write(str(kept))
+        return kept
+    timed('list and print', old)
+    capture = timed('capture', run, Capture())
+    print '%-24s %8s' % ('capture intact', bool((capture.data == samples).all()))
+    timed('ring', run, Capture(capacity=n))
+    capture = timed('rising, pretrigger 1k', run, Capture(capacity=4096,
+        pretrigger=1024, trigger='rising', level=2**29))
+    print '%-24s %8d' % ('captured', len(capture))
+    timed('decimation 16', run, Capture(capacity=n, decimation=16))
+    tmp = tempfile.mkdtemp()
+    try:
+        spill = os.path.join(tmp, 'scope.npy')
+        capture = timed('spill', run, Capture(spill=spill))
+        data = timed('map spill', lambda: capture.data)
+        print '%-24s %8s' % ('spill intact', bool((data == samples).all()))
+        del data
+        capture.file.close()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for func in benchmarks:
+        if names and func.__name__ not in names:
+            continue
+        print
+        print '-----------------'
+        print func.__name__
+        print
+        func()
@@ -1,19 +1,460 @@
-from math import log, ceil
+import array
+import bisect
 from myhdl import *
 
 from system import system
 
+class AddressMap(object):
+    """Decodes addresses to the slaves of a bus.
+
+    Slaves get the ranges :func:`map_slave` gave them.  The others get the
+    window ``address_mask + 1`` bytes wide at their position among the
+    slaves, or every address when they are the only one.
+
+    :param slaves: The slave edges, one or a list of them, as models get
+                   them.
+    :param ranges: ``{slave path: [base, size]}``.
+    :raises ValueError: If ranges overlap, are empty, or name something
+                        that isn't a slave of the bus.
+    """
+
+    # Decoded pages are remembered, so lookups after the first one in a page
+    # are a dict hit.  Pages are at most 4 KiB, and small enough that every
+    # range boundary falls between two of them: no page straddles slaves.
+    page_bits = 12
+
+    def __init__(self, slaves, address_mask=None, ranges=None):
+        if slaves is None:
+            slaves = []
+        elif type(slaves) != list:
+            slaves = [slaves]
+        ranges = dict(ranges or {})
+        entries = []
+        for i, edge in enumerate(slaves):
+            path = edge.from_node.path
+            if path in ranges:
+                base, size = ranges.pop(path)
+            elif len(slaves) == 1:
+                base, size = 0, 2**32
+            elif address_mask is not None:
+                base, size = i * (address_mask + 1), address_mask + 1
+            else:
+                raise ValueError, 'No address range for slave %s' % path
+            if size <= 0:
+                raise ValueError, 'Empty address range for slave %s' % path
+            entries.append((base, base + size, path, edge))
+        if ranges:
+            raise ValueError, 'Address ranges for %s, which are not slaves' % (
+                ', '.join(sorted(ranges)))
+
+        entries.sort()
+        for a, b in zip(entries, entries[1:]):
+            if b[0] < a[1]:
+                raise ValueError, '%s at [%#x, %#x) overlaps %s at [%#x, %#x)' % (
+                    b[2], b[0], b[1], a[2], a[0], a[1])
+        self.bases = [e[0] for e in entries]
+        self.ends = [e[1] for e in entries]
+        self.paths = [e[2] for e in entries]
+        self.edges = [e[3] for e in entries]
+        self.containers = [None] * len(entries)
+        self.pages = {}
+        for boundary in self.bases + self.ends:
+            if boundary:
+                alignment = (boundary & -boundary).bit_length() - 1
+                self.page_bits = min(self.page_bits, alignment)
+
+    def __iter__(self):
+        """(base, size, slave path) for every slave by address."""
+        for base, end, path in zip(self.bases, self.ends, self.paths):
+            yield base, end - base, path
+
+    def slaves(self):
+        """The slave containers by address."""
+        for i, slave in enumerate(self.containers):
+            if slave is None:
+                slave = self.containers[i] = self.edges[i]()
+            yield slave
+
+    def lookup(self, addr):
+        """The slave container at ``addr``.
+
+        :raises ValueError: If no slave is mapped there.
+        """
+        i = self.pages.get(addr >> self.page_bits)
+        if i is None:
+            i = self.find(addr)
+        slave = self.containers[i]
+        if slave is None:
+            slave = self.containers[i] = self.edges[i]()
+        return slave
+
+    def find(self, addr):
+        """The index of the slave at ``addr`` in :attr:`paths`, like
+        :meth:`lookup`."""
+        page = addr >> self.page_bits
+        i = self.pages.get(page)
+        if i is None:
+            i = bisect.bisect_right(self.bases, addr) - 1
+            if i < 0 or addr >= self.ends[i]:
+                raise ValueError, 'No slave at %#x' % addr
+            self.pages[page] = i
+        return i
+
+def map_slave(bus, slave, base, size):
+    """Give ``slave`` the addresses ``[base, base + size)`` on ``bus``; a
+    :class:`BusMatrix`, an :class:`AxiBus` or an :class:`Apb3Bus` with
+    behavioral slaves."""
+    address_map = dict(bus.kwargs.get('address_map') or {})
+    address_map[slave.path] = [base, size]
+    system.update_kwargs(bus.path, address_map=address_map)
+
+def words(data):
+    """``data`` as an array of unsigned 32-bit words.
+
+    :param data: A sequence of ints or intbvs, a numpy array, or any other
+                 object with the buffer interface holding native words.
+    """
+    if isinstance(data, array.array) and data.typecode == 'I':
+        return data
+    if hasattr(data, 'astype'):
+        # A numpy array; signed samples wrap to their two's complement.
+        return array.array('I', data.astype('=u4').tostring())
+    if isinstance(data, buffer):
+        data = str(data)
+    if isinstance(data, (str, bytearray, memoryview)):
+        return array.array('I', memoryview(data).tobytes())
+    return array.array('I', [int(w) & 0xffffffff for w in data])
+
+def transmit_words(slave, addr, data, incr):
+    for word in data:
+        yield slave.transmit(addr, word)
+        addr += incr
+
+def receive_words(slave, addr, n, incr):
+    rdata = array.array('I')
+    for i in xrange(n):
+        yield slave.receive(addr)
+        rdata.append(int(slave.rdata) & 0xffffffff)
+        addr += incr
+    slave.rdata = rdata
+
+def block_transmit(slave, addr, data, incr):
+    """Start a block transmit on ``slave``; slaves without a
+    ``transmit_block`` get one word at a time."""
+    if hasattr(slave, 'transmit_block'):
+        return slave.transmit_block(addr, data, incr)
+    return transmit_words(slave, addr, data, incr)
+
+def block_receive(master, slave, addr, n, incr):
+    """Start a block receive on ``slave`` that leaves the words in
+    ``master.rdata``, like :func:`block_transmit`."""
+    if hasattr(slave, 'receive_block'):
+        access = slave.receive_block(addr, n, incr)
+    else:
+        access = receive_words(slave, addr, n, incr)
+    if access is None:
+        master.rdata = slave.rdata
+        return None
+    return _complete_block_receive(master, slave, access)
+
+def _complete_block_receive(master, slave, access):
+    yield access
+    master.rdata = slave.rdata
+
+class Idle(object):
+    """Yielded by a bus master with nothing to do.
+
+    The arbiter passes the master over, without running it, until
+    ``ready()`` is true.  That is checked after every transaction of the
+    other masters and every idle bus cycle, since those are all that can
+    change it.  A master waiting on signals, an interrupt line say, gives
+    them as ``events``; it sleeps instead, and ``ready()`` is only checked
+    when one of them changes.
+    """
+    __slots__ = ('ready', 'events')
+
+    def __init__(self, ready, events=None):
+        self.ready = ready
+        self.events = events
+
+class Arbiter(object):
+    """Grants a bus to its masters.
+
+    Masters are generators; everything a master yields other than
+    :class:`Idle` is one transaction, run to completion before any other
+    master is granted the bus.  A master that needs several transfers done
+    atomically yields them together as one generator.  A lap grants the
+    masters that aren't idle according to ``policy``:
+
+    ``'round-robin'``
+        Each master once, in order.
+    ``'fixed'``
+        Only the master with the highest weight, or the first one on a
+        tie, that has something to do; one that goes idle passes the lap
+        on to the next.
+    ``'weighted'``
+        Each master as many times in a row as its weight.
+
+    If a lap took no simulated time the bus idles a cycle, which is what
+    keeps its clock running while the masters are idle or polling.  The
+    path of the master last granted is left in the bus's ``granted``.
+    Masters asleep on the ``events`` of an :class:`Idle` are woken by a
+    process of their own, beside the one granting the bus.
+
+    :param masters: ``[(path, generator)]``.
+    :param weights: ``{path: weight}``; masters not in it weigh 1.
+    """
+
+    policies = ('round-robin', 'fixed', 'weighted')
+
+    def __init__(self, bus, masters, policy='round-robin', weights=None):
+        if policy not in self.policies:
+            raise ValueError, 'Unknown arbitration policy %r' % (policy,)
+        weights = weights or {}
+        self.bus = bus
+        self.policy = policy
+        self.paths = [path for path, master in masters]
+        self.masters = [master for path, master in masters]
+        self.weights = [weights.get(path, 1) for path in self.paths]
+        self.parked = [None] * len(masters)
+        self.grants = [0] * len(masters)
+        # Toggled when a master falls asleep, so _wake waits on its events.
+        self.asleep = Signal(bool(False))
+
+        # Fixed priority tries the masters heaviest first.
+        self.order = sorted(xrange(len(masters)),
+            key=lambda i: -self.weights[i])
+
+    def _lap(self):
+        if self.policy == 'round-robin':
+            return xrange(len(self.masters))
+        elif self.policy == 'fixed':
+            return self.order
+        return [i for i in xrange(len(self.masters))
+            for n in xrange(self.weights[i])]
+
+    def run(self):
+        yield join(self._grant(), self._wake())
+
+    def _wake(self):
+        parked = self.parked
+        while True:
+            events = [self.asleep]
+            for idle in parked:
+                if idle is not None and idle.events is not None:
+                    events.extend(idle.events)
+            yield tuple(events)
+            for i, idle in enumerate(parked):
+                if idle is not None and idle.events is not None and \
+                        idle.ready():
+                    parked[i] = None
+
+    def _grant(self):
+        from myhdl import now
+        bus = self.bus
+        masters = self.masters
+        parked = self.parked
+        grants = self.grants
+        paths = self.paths
+        # A fixed priority lap ends with its first grant.
+        first = self.policy == 'fixed'
+        while True:
+            start = now()
+            for i in self._lap():
+                idle = parked[i]
+                if idle is not None:
+                    if idle.events is not None or not idle.ready():
+                        continue
+                    parked[i] = None
+                request = masters[i].next()
+                if type(request) is Idle:
+                    if request.events is None:
+                        parked[i] = request
+                    elif not request.ready():
+                        parked[i] = request
+                        self.asleep.next = not self.asleep
+                    continue
+                grants[i] += 1
+                bus.granted = paths[i]
+                yield request
+                while bus.locked:
+                    yield masters[i].next()
+                if first:
+                    break
+            if now() == start:
+                yield bus.delay(1)
+
+class BusRecorder(object):
+    """Records the transactions of a :class:`BusMatrix`.
+
+    Each row of :attr:`records` is one access: when the master was
+    granted the bus and when the access was done, which master it was and
+    which slave it hit, the address, the data or first word of a block,
+    whether it was a write, how many words it moved and how many wait
+    states the slave added.  Wait states are the bus cycles between grant
+    and completion beyond the :attr:`transfer_cycles` each word takes at
+    least.  Masters and slaves are indexes into :attr:`masters` and
+    :attr:`slaves`.  Rows go into preallocated numpy arrays of ``chunk``
+    rows, a new one each time the last is full.
+
+    :param cycle: The bus clock period in ns.
+    """
+
+    dtype = [('grant', 'u8'), ('done', 'u8'), ('master', 'u2'),
+        ('slave', 'u2'), ('addr', 'u4'), ('data', 'u4'), ('write', 'u1'),
+        ('words', 'u4'), ('wait', 'u4')]
+
+    # The fewest bus cycles a word takes, so the bus is busy that long even
+    # for a behavioral slave that answers in no simulated time.
+    transfer_cycles = 1
+
+    def __init__(self, bus, cycle=100, chunk=4096):
+        import numpy as np
+        self.np = np
+        self.bus = bus
+        self.cycle = cycle
+        self.chunk = chunk
+        self.masters = []
+        self.master_index = {}
+        self.slaves = bus.address_map.paths
+        self.chunks = []
+        self._grow()
+
+    def _grow(self):
+        self.current = self.np.zeros(self.chunk, self.dtype)
+        self.chunks.append(self.current)
+        self.n = 0
+
+    def add(self, grant, master, addr, data, write, n):
+        """Record an access granted at ``grant`` and done now."""
+        i = self.master_index.get(master)
+        if i is None:
+            i = self.master_index[master] = len(self.masters)
+            self.masters.append(master)
+        if self.n == self.chunk:
+            self._grow()
+        done = now()
+        wait = (done - grant) // self.cycle - n * self.transfer_cycles
+        self.current[self.n] = (grant, done, i,
+            self.bus.address_map.find(addr), addr, int(data) & 0xffffffff,
+            write, n, max(wait, 0))
+        self.n += 1
+
+    @property
+    def records(self):
+        """Every row recorded so far, as one array."""
+        return self.np.concatenate(self.chunks[:-1] + [self.current[:self.n]])
+
+    def bandwidth(self, elapsed=None):
+        """``{master: bytes per second}`` over ``elapsed`` ns, by default
+        the simulated time so far."""
+        np = self.np
+        records = self.records
+        elapsed = elapsed or now()
+        moved = np.bincount(records['master'], 4 * records['words'],
+            len(self.masters))
+        return dict((master, moved[i] * 1e9 / elapsed)
+            for i, master in enumerate(self.masters))
+
+    def latency_histograms(self):
+        """``{slave: (counts, edges)}``; the wait states of the accesses
+        to each slave in bins ``[0, 1, 2, 4, 8, ...)``."""
+        np = self.np
+        records = self.records
+        top = int(records['wait'].max()) if len(records) else 0
+        edges = [0, 1]
+        while edges[-1] <= top:
+            edges.append(2 * edges[-1])
+        histograms = {}
+        for i, slave in enumerate(self.slaves):
+            waits = records['wait'][records['slave'] == i]
+            if len(waits):
+                histograms[slave] = np.histogram(waits, edges)
+        return histograms
+
+    def utilization(self, window, elapsed=None):
+        """The fraction of each ``window`` ns the bus was busy, up to
+        ``elapsed`` ns.  An access keeps the bus from its grant until it
+        is done, and for at least its words' :attr:`transfer_cycles`."""
+        np = self.np
+        records = self.records
+        elapsed = elapsed or now()
+        grants = records['grant'].astype('f8')
+        least = self.cycle * self.transfer_cycles * records['words']
+        starts = np.sort(grants)
+        ends = np.sort(grants + np.maximum(records['done'] - grants, least))
+
+        # The bus was busy before t for as long as it has been since every
+        # start before t, less as long as it has been since every end.
+        def since(times, t):
+            before = np.searchsorted(times, t)
+            return before * t - np.concatenate([[0], np.cumsum(times)])[before]
+        busy = lambda t: since(starts, t) - since(ends, t)
+        edges = np.arange(0, elapsed + window, window, dtype='f8')
+        # Accesses granted in one arbiter lap overlap; the bus serves them
+        # one after another, but can't be more than busy.
+        return np.minimum(np.diff(busy(edges)) / window, 1)
+
+    def report(self, f, window=10000):
+        """Write the summaries to ``f``; utilization in ``window`` ns."""
+        np = self.np
+        records = self.records
+        elapsed = now()
+        if not len(records) or not elapsed:
+            return
+        f.write('%-28s %8s %10s %12s %12s\n' % ('master', 'count', 'bytes',
+            'bytes/s', 'wait states'))
+        bandwidth = self.bandwidth(elapsed)
+        for i, master in enumerate(self.masters):
+            mine = records[records['master'] == i]
+            f.write('%-28s %8d %10d %12.0f %12d\n' % (master, len(mine),
+                4 * mine['words'].sum(), bandwidth[master],
+                mine['wait'].sum()))
+            for j, slave in enumerate(self.slaves):
+                theirs = mine[mine['slave'] == j]
+                if len(theirs):
+                    f.write('  %-26s %8d %10d %12s %12d\n' % (slave,
+                        len(theirs), 4 * theirs['words'].sum(), '',
+                        theirs['wait'].sum()))
+
+        f.write('\nwait states per access\n')
+        for slave, (counts, edges) in sorted(self.latency_histograms().items()):
+            f.write('  %s\n' % slave)
+            for count, low, high in zip(counts, edges, edges[1:]):
+                if count:
+                    label = '%d' % low if high == low + 1 else \
+                        '%d-%d' % (low, high - 1)
+                    f.write('    %8s %8d\n' % (label, count))
+
+        f.write('\nbus utilization per %g us\n' % (window / 1e3))
+        for k, busy in enumerate(self.utilization(window, elapsed)):
+            f.write('  %8.1f us %6.1f%%\n' % (k * window / 1e3, 100 * busy))
+
 @system.model
 class BusMatrix(object):
-    def __init__(self, resetn, clk, masters, slaves, address_mask):
+    def __init__(self, resetn, clk, masters, slaves, address_mask,
+            address_map=None, arbitration='round-robin', weights=None):
         self.resetn = resetn
         self.clk = clk
         self.masters = masters
         self.slaves = slaves
         self.address_mask = address_mask
+        self.address_map = AddressMap(slaves, address_mask, address_map)
+        self.arbitration = arbitration
+        self.weights = weights
         self.locked = False
+        self.granted = None
+        self.recorder = None
+
+    def arbiter(self):
+        """An :class:`Arbiter` for the masters of the bus."""
+        masters = self.masters
+        if type(masters) != list:
+            masters = [masters]
+        return Arbiter(self, [(m.from_node.path, iter(m()())) for m in masters],
+            self.arbitration, self.weights)
     
-    def interface(self):
+    def interface(self, master=None):
         return self
 
     def reset(self):
@@ -24,37 +465,102 @@ class BusMatrix(object):
             yield self.slaves().reset()
 
     def delay(self, n):
-        if type(self.slaves) == list:
-            for slave in self.slaves:
-                yield slave().delay(n)
-        else:
-            yield self.slaves().delay(n)
+        # Most slaves don't keep time; only wait on the ones that do.
+        for slave in self.address_map.slaves():
+            access = slave.delay(n)
+            if access is not None:
+                yield access
     
     def _lookup_slave(self, addr):
-        if type(self.slaves) == list:
-            slave_id = (addr & ~self.address_mask) >> \
-                int(ceil(log(self.address_mask + 1, 2)))
-            slave = self.slaves[slave_id]
-            return slave()
-        else:
-            return self.slaves()
+        return self.address_map.lookup(addr)
+
+    def record(self, cycle=100, chunk=4096):
+        """Record every access from now on.
+
+        :returns: The :class:`BusRecorder`.
+        """
+        self.recorder = BusRecorder(self, cycle, chunk)
+        return self.recorder
 
+    # Accesses hand back what the slave returns rather than wrapping it in
+    # another generator; a behavioral slave then costs the simulator nothing.
+    # A slave that returns a delay from receive, like a transaction level
+    # Apb3Bus, has already set its rdata; only the time is left.
     def transmit(self, addr, data):
-        slave = self._lookup_slave(addr)
-        #print 'bus.transmit', hex(addr), hex(data)
-        yield slave.transmit(addr, data)
+        access = self.address_map.lookup(addr).transmit(addr, data)
+        if self.recorder is not None:
+            return self._record(access, addr, data, True, 1)
+        return access
 
     def receive(self, addr):
-        slave = self._lookup_slave(addr)
-        yield slave.receive(addr)
+        slave = self.address_map.lookup(addr)
+        access = slave.receive(addr)
+        # A recorder needs to see the delay elapse before the access is done.
+        if access is None or type(access) is delay and self.recorder is None:
+            self.rdata = slave.rdata
+            if self.recorder is not None:
+                self.recorder.add(now(), self.granted, addr, self.rdata,
+                    False, 1)
+            return access
+        return self._complete_receive(access, slave, addr)
+
+    def _complete_receive(self, access, slave, addr):
+        grant = now()
+        yield access
         self.rdata = slave.rdata
-        #print 'bus.receive', hex(addr), hex(self.rdata)
+        if self.recorder is not None:
+            self.recorder.add(grant, self.granted, addr, self.rdata, False, 1)
+
+    def _record(self, access, addr, data, write, n):
+        if access is None:
+            self.recorder.add(now(), self.granted, addr,
+                self.rdata[0] if data is None else data, write, n)
+            return None
+        return self._recorded(access, addr, data, write, n)
+
+    def _recorded(self, access, addr, data, write, n):
+        # Reads pass no data; the first word read is recorded.
+        grant = now()
+        yield access
+        self.recorder.add(grant, self.granted, addr,
+            self.rdata[0] if data is None else data, write, n)
+
+    def transmit_block(self, addr, data, incr=4):
+        """Transmit words to addresses ``incr`` bytes apart from ``addr``;
+        an ``incr`` of 0 writes them all to one port.  The block must lie
+        within one slave.
+
+        :param data: The words; anything :func:`words` takes.
+        """
+        data = words(data)
+        access = block_transmit(self._lookup_slave(addr), addr, data, incr)
+        if self.recorder is not None and data:
+            return self._record(access, addr, data[0], True, len(data))
+        return access
+
+    def receive_block(self, addr, n, incr=4):
+        """Receive ``n`` words into ``self.rdata``, an array of unsigned
+        words, like :meth:`transmit_block`."""
+        access = block_receive(self, self._lookup_slave(addr), addr, n, incr)
+        if self.recorder is not None and n:
+            return self._record(access, addr, None, False, n)
+        return access
 
     @classmethod
-    def create(cls, parent_path, name, resetn, clk, duration, address_mask):
+    def create(cls, parent_path, name, resetn, clk, duration, address_mask,
+            arbitration='round-robin', weights=None):
+        """Create a bus matrix.
+
+        :param arbitration: The :class:`Arbiter` policy.
+        :param weights: ``{master path: weight}`` for the policy.
+        """
+        if arbitration not in Arbiter.policies:
+            raise ValueError, 'Unknown arbitration policy %r' % (arbitration,)
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'BusMatrix', {
-            'address_mask': address_mask })
+        kwargs = { 'address_mask': address_mask, 'arbitration': arbitration }
+        if weights:
+            kwargs['weights'] = weights
+        self = system.add_node(parent_path, name, 'BusMatrix', kwargs)
         system.add_edge('CallAttrEdge',
             path(resetn, 'signals_dict'),
             path(self, 'resetn'),
@@ -67,9 +573,36 @@ class BusMatrix(object):
 
 @system.model
 class Apb3Bus(object):
-    def __init__(self, resetn, clk, **kwargs):
+    """An APB3 bus.
+
+    In ``'pin'`` mode every access drives the bus signals a half clock at a
+    time, so HDL slaves see real transfers and the waveform shows them.  In
+    ``'transaction'`` mode accesses go straight to behavioral slaves such
+    as :class:`Mem` or :class:`Dma` and simulated time jumps ahead by what
+    the pin level transfer would have taken; the bus signals stay idle, so
+    HDL slaves can't be connected.
+
+    Behavioral slaves connect to ``slaves`` like they do to a
+    :class:`BusMatrix`; in pin mode they answer in the access phase.
+    """
+
+    # Its accesses take simulated time, so an AxiBus lets them.
+    keeps_time = True
+
+    # Half clock periods a transfer takes with a slave that is always ready.
+    # Block transfers take two cycles a word plus one to release the bus.
+    transmit_half_cycles = 6
+    receive_half_cycles = 7
+    block_half_cycles = 4
+
+    def __init__(self, resetn, clk, slaves=None, **kwargs):
         self.resetn = resetn
         self.clk = clk
+        self.slaves = slaves
+        self.mode = kwargs.get('mode') or 'pin'
+        self.address_map = AddressMap(slaves,
+            kwargs.get('address_mask') or 0xffff, kwargs.get('address_map'))
+        self.verbose = kwargs.get('verbose', False)
         self.paddr = Signal(intbv(0, 0, 2**32))
         self.psel = Signal(bool(0))
         self.penable = Signal(bool(0))
@@ -98,14 +631,20 @@ class Apb3Bus(object):
         sigs.update(self.clk(name='%spclk' % prefix))
         return sigs
 
-    def interface(self):
+    def interface(self, master=None):
         self.duration = int(1e9/10e6) #self.kwargs['duration']
         self.presetn = self.resetn()['presetn']
         self.pclk = self.clk()['pclk']
+        # What a transaction level access waits; a delay can be yielded
+        # any number of times.
+        self.transmit_wait = delay(self.transmit_half_cycles *
+            (self.duration // 2))
+        self.receive_wait = delay(self.receive_half_cycles *
+            (self.duration // 2))
         return self
 
     def debug(self, msg):
-        if self.kwargs.get('verbose', False):
+        if self.verbose:
             print msg
         
     def reset(self):
@@ -118,8 +657,20 @@ class Apb3Bus(object):
         yield delay(self.duration)
         self.presetn.next = True
 
+        if self.slaves is not None:
+            for slave in self._all_slaves():
+                yield slave.reset()
+
         self.debug('-- Reset --')
 
+    def _all_slaves(self):
+        if type(self.slaves) == list:
+            return [slave() for slave in self.slaves]
+        return [self.slaves()]
+
+    def _lookup_slave(self, addr):
+        return self.address_map.lookup(addr)
+
     def transmit(self, addr, data):
         """Transmit from master to slave.
         
@@ -129,6 +680,25 @@ class Apb3Bus(object):
         """
         assert not addr & 3  # Must be word aligned
 
+        if self.mode == 'transaction':
+            return self._transmit_transaction(addr, data)
+        return self._transmit_pins(addr, data)
+
+    def _transmit_transaction(self, addr, data):
+        if self.verbose:
+            self.debug('-- Transmitting addr=%s data=%s --' % (hex(addr), hex(data)))
+        access = self.address_map.lookup(addr).transmit(addr, data)
+        wait = self.transmit_wait
+        if access is None:
+            # The slave was a plain function call; only time is left.
+            return wait
+        return self._complete(access, wait)
+
+    def _complete(self, access, wait):
+        yield access
+        yield wait
+
+    def _transmit_pins(self, addr, data):
         timeout = self.kwargs.get('timeout') or 5 * self.duration
 
         self.debug('-- Transmitting addr=%s data=%s --' % (hex(addr), hex(data)))
@@ -146,6 +716,8 @@ class Apb3Bus(object):
         self.debug('TX: enable')
         self.pclk.next = True
         self.penable.next = True
+        if self.slaves is not None:
+            yield self._lookup_slave(addr).transmit(addr, data)
         yield delay(self.duration // 2)
 
         timeout_count = 0
@@ -180,6 +752,35 @@ class Apb3Bus(object):
         :raises Apb3TimeoutError: If slave doesn't set ``pready`` in time
         """
         assert not addr & 3  # Must be word aligned
+
+        if self.mode == 'transaction':
+            return self._receive_transaction(addr, assert_equals)
+        return self._receive_pins(addr, assert_equals)
+
+    def _receive_transaction(self, addr, assert_equals):
+        if self.verbose:
+            self.debug('-- Receiving addr=%s --' % (hex(addr),))
+        slave = self.address_map.lookup(addr)
+        access = slave.receive(addr)
+        wait = self.receive_wait
+        if access is None:
+            self._received(slave, assert_equals)
+            return wait
+        return self._complete_receive(access, slave, assert_equals, wait)
+
+    def _complete_receive(self, access, slave, assert_equals, wait):
+        yield access
+        self._received(slave, assert_equals)
+        yield wait
+
+    def _received(self, slave, assert_equals):
+        self.rdata = slave.rdata
+        if self.verbose:
+            self.debug('RX: data=%s' % (hex(self.rdata),))
+        if assert_equals is not None:
+            assert self.rdata == assert_equals, 'Got %s, expected %s' % (hex(self.rdata), hex(assert_equals))
+
+    def _receive_pins(self, addr, assert_equals):
         timeout = self.kwargs.get('timeout') or 5 * self.duration
 
         self.debug('-- Receiving addr=%s --' % (hex(addr),))
@@ -195,6 +796,10 @@ class Apb3Bus(object):
         self.debug('RX: enable')
         self.pclk.next = True
         self.penable.next = True
+        if self.slaves is not None:
+            slave = self._lookup_slave(addr)
+            yield slave.receive(addr)
+            self.prdata.next = slave.rdata
         yield delay(self.duration // 2)
 
         timeout_count = 0
@@ -212,8 +817,8 @@ class Apb3Bus(object):
         yield delay(self.duration // 2)
 
         self.debug('RX: data=%s' % (hex(self.prdata),))
-        rdata = self.prdata
-        self.rdata = self.prdata
+        # The value now, not the signal, which the next transfer changes.
+        self.rdata = int(self.prdata)
         if assert_equals is not None:
             assert self.prdata == assert_equals, 'Got %s, expected %s' % (hex(self.prdata), hex(assert_equals))
         yield delay(self.duration // 2)
@@ -227,8 +832,135 @@ class Apb3Bus(object):
         self.pclk.next = False
         yield delay(self.duration // 2)
 
+    def transmit_block(self, addr, data, incr=4):
+        """Transmit words as back-to-back transfers, with no idle cycle
+        between them; see :meth:`BusMatrix.transmit_block`."""
+        data = words(data)
+        assert not addr & 3 and not incr & 3  # Must be word aligned
+
+        if self.mode == 'transaction':
+            access = block_transmit(self._lookup_slave(addr), addr, data,
+                incr)
+            wait = self._block_delay(len(data))
+            if access is None:
+                return wait
+            return self._complete(access, wait)
+        return self._transmit_block_pins(addr, data, incr)
+
+    def receive_block(self, addr, n, incr=4):
+        """Receive ``n`` words as back-to-back transfers into
+        ``self.rdata``; see :meth:`BusMatrix.receive_block`."""
+        assert not addr & 3 and not incr & 3  # Must be word aligned
+
+        if self.mode == 'transaction':
+            access = block_receive(self, self._lookup_slave(addr), addr, n,
+                incr)
+            wait = self._block_delay(n)
+            if access is None:
+                return wait
+            return self._complete(access, wait)
+        return self._receive_block_pins(addr, n, incr)
+
+    def _block_delay(self, n):
+        return delay((self.block_half_cycles * n + 2) * (self.duration // 2))
+
+    def _transmit_block_pins(self, addr, data, incr):
+        slave = None
+        if self.slaves is not None:
+            slave = self._lookup_slave(addr)
+
+        self.debug('-- Transmitting %d words from addr=%s --' % (len(data),
+            hex(addr)))
+        for word in data:
+            self.pclk.next = True
+            self.paddr.next = intbv(addr)
+            self.pwrite.next = True
+            self.psel.next = True
+            self.penable.next = False
+            self.pwdata.next = intbv(word)
+            yield delay(self.duration // 2)
+
+            self.pclk.next = False
+            yield delay(self.duration // 2)
+
+            self.pclk.next = True
+            self.penable.next = True
+            if slave is not None:
+                yield slave.transmit(addr, word)
+            yield delay(self.duration // 2)
+
+            yield self._wait_ready()
+            self.pclk.next = False
+            yield delay(self.duration // 2)
+            addr += incr
+
+        yield self._release()
+
+    def _receive_block_pins(self, addr, n, incr):
+        slave = None
+        if self.slaves is not None:
+            slave = self._lookup_slave(addr)
+
+        self.debug('-- Receiving %d words from addr=%s --' % (n, hex(addr)))
+        rdata = array.array('I')
+        for i in xrange(n):
+            self.pclk.next = True
+            self.paddr.next = intbv(addr)
+            self.pwrite.next = False
+            self.psel.next = True
+            self.penable.next = False
+            yield delay(self.duration // 2)
+
+            self.pclk.next = False
+            yield delay(self.duration // 2)
+
+            self.pclk.next = True
+            self.penable.next = True
+            if slave is not None:
+                yield slave.receive(addr)
+                self.prdata.next = slave.rdata
+            yield delay(self.duration // 2)
+
+            yield self._wait_ready()
+            self.pclk.next = False
+            yield delay(self.duration // 2)
+            rdata.append(int(self.prdata))
+            addr += incr
+
+        self.rdata = rdata
+        yield self._release()
+
+    def _wait_ready(self):
+        timeout = self.kwargs.get('timeout') or 5 * self.duration
+        timeout_count = 0
+        while not self.pready:
+            self.debug('wait')
+            timeout_count += self.duration
+            if timeout_count > timeout:
+                raise Apb3TimeoutError
+            self.pclk.next = False
+            yield delay(self.duration // 2)
+            self.pclk.next = True
+            yield delay(self.duration // 2)
+
+    def _release(self):
+        self.debug('stop')
+        self.pclk.next = True
+        self.pwrite.next = False
+        self.psel.next = False
+        self.penable.next = False
+        yield delay(self.duration // 2)
+
+        self.pclk.next = False
+        yield delay(self.duration // 2)
+
     def delay(self, cycles):
         """Delay the bus a number of cycles."""
+        if self.mode == 'transaction':
+            return delay(2 * cycles * (self.duration // 2))
+        return self._delay_pins(cycles)
+
+    def _delay_pins(self, cycles):
         for i in xrange(cycles):
             self.pclk.next = True
             yield delay(self.duration // 2)
@@ -236,9 +968,22 @@ class Apb3Bus(object):
             yield delay(self.duration // 2)
     
     @classmethod
-    def create(cls, parent_path, name, master, duration=None, verbose=False):
+    def create(cls, parent_path, name, master, duration=None, verbose=False,
+            mode='pin', address_mask=0xffff, base=None, size=None):
+        """Create a bus as a slave of ``master``.
+
+        :param mode: ``'pin'`` or ``'transaction'``; see :class:`Apb3Bus`.
+        :param address_mask: The window of each behavioral slave without
+                             an address range; see :class:`AddressMap`.
+        :param base: Map the bus at ``[base, base + size)`` on ``master``.
+        :param size: Required with ``base``.
+        """
+        if mode not in ('pin', 'transaction'):
+            raise ValueError, 'Unknown bus mode %r' % (mode,)
+        if base is not None and not size > 0:
+            raise ValueError, 'A bus mapped at %#x needs a size' % base
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'Apb3Bus', {'duration': duration, 'verbose': verbose})
+        self = system.add_node(parent_path, name, 'Apb3Bus', {'duration': duration, 'verbose': verbose, 'mode': mode, 'address_mask': address_mask})
         system.add_edge('CallAttrEdge',
             path(master, 'resetn'),
             path(self, 'resetn'),
@@ -250,10 +995,16 @@ class Apb3Bus(object):
         system.add_edge('CallAttrEdge',
             path(self, 'interface'),
             path(master, 'slaves'))
+        if base is not None:
+            map_slave(master, self, base, size)
         return self
     
     @classmethod
     def connect_slave(cls, self, slave, prefix=None):
+        """Connect an HDL slave to the bus signals."""
+        if self.kwargs.get('mode') == 'transaction':
+            raise ValueError, 'HDL slave %s needs a pin level bus, not %s' % (
+                slave.path, self.path)
         path = lambda node, name: '%s#%s' % (node.path, name)
         system.add_edge('CallAttrEdge',
             path(self, 'signals_dict'),
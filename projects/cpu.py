@@ -1,9 +1,6 @@
-import numpy as np
-from myhdl import intbv, modbv
 
 from system import system
-
-from dsp import DspFlow
+from bus import Idle
 
 @system.model
 class Cpu(object):
@@ -31,55 +28,98 @@ class Cpu(object):
 
 @system.model
 class MemFifoDspNet(object):
+    """A ring of ``depth`` bytes of ``width`` bit samples in memory, with
+    one producer and one consumer.
+
+    The producer asks for room with :meth:`acquire_write`, fills the
+    arrays it gets and hands them over with :meth:`commit_write`; the
+    consumer gets them with :meth:`acquire_read` and gives the room back
+    with :meth:`release_read`.  The arrays are views of the :class:`Mem`
+    the ring is in, so the CPU works on samples in place, without bus
+    accesses, and a DMA reads what was written.  Where the ring wraps they
+    come in two parts.
+
+    Counts are in words; :attr:`wrptr` and :attr:`rdptr` are the bus
+    addresses writing and reading are at.
+    """
+
     def __init__(self, name, width, depth, os):
         self.name = name
         self.width = width
         self.depth = depth
         self.os = os
+        self.words = depth // (width >> 3)
+        # Words committed and released since the start; their difference
+        # is what the ring holds, so a full ring isn't an empty one.
+        self.committed = 0
+        self.released = 0
 
     def interface(self):
         return self
 
     def mem(self):
         if not hasattr(self, '_mem'):
-            self._mem = self.os().alloc(self.name, (self.width >> 2) * self.depth)
-            self._wrptr = 0
-            self._rdptr = 0
+            os = self.os()
+            self._mem = os.alloc(self.name, self.depth)
+            self._ring = os.buffer(self._mem, self.depth).view(
+                '<i%d' % (self.width >> 3))
         return self._mem
 
     @property
     def wrptr(self):
-        self.mem()
-        return self._mem + self._wrptr
-
-    @property
-    def wrcnt(self):
-        return (self.depth - self.rdcnt)
-
-    def write(self, cnt):
-        self._wrptr = modbv(self._wrptr + cnt, min=0, max=self.depth)
-        #print 'net-wrote', cnt, 'wrcnt', self.wrcnt, 'rdcnt', self.rdcnt
+        return self.mem() + (self.committed % self.words) * (self.width >> 3)
 
     @property
     def rdptr(self):
-        self.mem()
-        return self._mem + self._rdptr
+        return self.mem() + (self.released % self.words) * (self.width >> 3)
 
     @property
     def rdcnt(self):
-        return abs(self.wrptr - self.rdptr) >> 2
-    
-    def read(self, cnt):
-        self._rdptr = modbv(self._rdptr + cnt, min=0, max=self.depth)
-        #print 'net-readd cnt', cnt, 'wrcnt', self.wrcnt, 'rdcnt', self.rdcnt
+        return self.committed - self.released
+
+    @property
+    def wrcnt(self):
+        return self.words - self.rdcnt
+
+    def _segments(self, start, n):
+        self.mem()
+        i = start % self.words
+        head = min(n, self.words - i)
+        if head == n:
+            return [self._ring[i:i + n]]
+        return [self._ring[i:], self._ring[:n - head]]
+
+    def acquire_write(self, n):
+        """Room for up to ``n`` words, as one array or two where the ring
+        wraps; as many as there is room for."""
+        return self._segments(self.committed, min(n, self.wrcnt))
+
+    def commit_write(self, n):
+        """Hand the first ``n`` words acquired over to the consumer."""
+        if n > self.wrcnt:
+            raise ValueError, 'Committing %d words with room for %d' % (n,
+                self.wrcnt)
+        self.committed += n
+
+    def acquire_read(self, n):
+        """Up to ``n`` of the words written, like :meth:`acquire_write`."""
+        return self._segments(self.released, min(n, self.rdcnt))
+
+    def release_read(self, n):
+        """Give the room of the first ``n`` words read back."""
+        if n > self.rdcnt:
+            raise ValueError, 'Releasing %d words of %d' % (n, self.rdcnt)
+        self.released += n
 
     @classmethod
     def create(cls, parent_path, name, width, depth):
-        path = lambda node, name: '%s#%s' % (node.path, name)
+        parent = system.node_at_path(parent_path)
         self = system.add_node(parent_path, name, 'MemFifoDspNet', {
-            'name': name,
             'width': width,
             'depth': depth,
+            # Its memory is allocated under its path, which no other net
+            # has.
+            'name': '%s/%s' % (parent.path, name),
         })
         return self
 
@@ -113,6 +153,17 @@ class DspFlowController(object):
         for node in self.nodes:
             yield node.work(self.os)
 
+    def wait(self):
+        """What to yield between steps: sleeps until one of the interrupts
+        the nodes wait on, their ``irq_mask``, is raised, or for a lap of
+        the bus if none of them waits on any."""
+        mask = 0
+        for node in self.nodes:
+            mask |= getattr(node, 'irq_mask', 0)
+        if not mask:
+            return Idle(lambda: True)
+        return self.os.wait_irq(mask)
+
     @classmethod
     def create_and_connect(cls, parent_path, name):
         path = lambda node, name: '%s#%s' % (node.path, name)
@@ -131,13 +182,72 @@ class DspFlowController(object):
             path(dsp, 'os'))
         return dsp
 
+def quantize(x, frac_bits=31, rounding='nearest', saturate=True):
+    """``x`` as 32-bit fixed point words with ``frac_bits`` fraction bits,
+    Q(31 - frac_bits).frac_bits, in an int32 array.
+
+    :param rounding: ``'nearest'``, ``'floor'`` or ``'truncate'``, toward
+                     zero.
+    :param saturate: Clip values out of range to the largest word of their
+                     sign; otherwise they wrap like the words would.
+    """
+    import numpy as np
+    x = np.asarray(x, np.float64) * (1 << frac_bits)
+    if rounding == 'nearest':
+        x = np.rint(x)
+    elif rounding == 'floor':
+        x = np.floor(x)
+    elif rounding == 'truncate':
+        x = np.trunc(x)
+    else:
+        raise ValueError, 'Unknown rounding %r' % (rounding,)
+    if saturate:
+        return np.clip(x, -2**31, 2**31 - 1).astype(np.int32)
+    return np.fmod(x, 2**32).astype(np.int64).astype(np.int32)
+
 @system.model
 class SignalSource(object):
-    def __init__(self, out, freq, sample_rate):
+    """Writes a test signal into a net, ``block`` samples at a time.
+
+    :param waveform: ``'sine'`` at ``freq``; ``'tones'``, the sum of sines
+                     of ``tones``, ``[(freq, amplitude)]``; ``'chirp'``,
+                     from ``freq`` up to ``chirp_to`` over ``chirp_time``
+                     seconds, again and again; or ``'noise'``.
+    :param amplitude: Of the sine or chirp, full scale being 1.
+    :param noise: Standard deviation of gaussian noise added to the
+                  signal, or of the noise itself; ``seed`` seeds it.
+
+    Samples are quantized by :func:`quantize` with ``frac_bits``,
+    ``rounding`` and ``saturate``.  Each waveform keeps its phase from one
+    block to the next, even as ``freq`` changes.
+    """
+
+    waveforms = ('sine', 'tones', 'chirp', 'noise')
+
+    def __init__(self, out, freq, sample_rate, waveform='sine', amplitude=1.0,
+            tones=None, chirp_to=None, chirp_time=1e-3, noise=0.0, seed=None,
+            frac_bits=31, rounding='nearest', saturate=True, block=64):
+        if waveform not in self.waveforms:
+            raise ValueError, 'Unknown waveform %r' % (waveform,)
         self.out = out
         self.freq = freq
         self.sample_rate = sample_rate
+        self.waveform = waveform
+        self.amplitude = amplitude
+        self.tones = tones or []
+        self.chirp_to = chirp_to
+        self.chirp_time = chirp_time
+        self.noise = noise
+        self.seed = seed
+        self.frac_bits = frac_bits
+        self.rounding = rounding
+        self.saturate = saturate
+        self.block = block
         self.n = 0
+        # Phases in cycles, of the sine or chirp and of each tone.
+        self.phase = 0.0
+        self.phases = [0.0] * len(self.tones)
+        self.random = None
 
     def interface(self):
         return self
@@ -146,37 +256,94 @@ class SignalSource(object):
         print os
         #print 'SIGNAL', self.out(), 'freq', self.freq(), 'samp_rate', self.sample_rate()
 
+    def _sine(self, np, phase, freq, rate, n):
+        # n samples from phase, in cycles, on; and the phase after them.
+        step = float(freq) / rate
+        cycles = phase + step * np.arange(n)
+        return np.sin(2 * np.pi * cycles), (phase + step * n) % 1.0
+
+    def generate(self, n):
+        """The next ``n`` samples, as floats."""
+        import numpy as np
+        rate = float(self.sample_rate())
+        if self.waveform == 'sine':
+            samples, self.phase = self._sine(np, self.phase, self.freq(),
+                rate, n)
+            samples *= self.amplitude
+        elif self.waveform == 'tones':
+            samples = np.zeros(n)
+            for i, (freq, amplitude) in enumerate(self.tones):
+                tone, self.phases[i] = self._sine(np, self.phases[i], freq,
+                    rate, n)
+                samples += amplitude * tone
+        elif self.waveform == 'chirp':
+            # The frequency of each sample, sweeping linearly and starting
+            # over every chirp_time.
+            start = float(self.freq())
+            stop = self.chirp_to if self.chirp_to is not None else 2 * start
+            t = ((self.n + np.arange(n)) / rate) % self.chirp_time
+            steps = (start + (stop - start) * t / self.chirp_time) / rate
+            cycles = self.phase + np.cumsum(steps) - steps
+            samples = self.amplitude * np.sin(2 * np.pi * cycles)
+            self.phase = (cycles[-1] + steps[-1]) % 1.0 if n else self.phase
+        else:
+            samples = np.zeros(n)
+        if self.noise:
+            if self.random is None:
+                self.random = np.random.RandomState(self.seed)
+            samples += self.noise * self.random.standard_normal(n)
+        self.n += n
+        return samples
+
     def work(self, os):
         out = self.out()
         if out.wrcnt > 0 and out.rdcnt < 16:
-            N = min(out.wrcnt, 64)
-            n = np.arange(self.n, self.n + N)
-            samples = np.sin(2 * np.pi * n * (float(self.freq()) / self.sample_rate()))
-            for sample in samples:
-                s = intbv(int(sample * (2**31 - 1)))[32:]
-                #print 'sample-out', s.signed()
-                yield os.transmit(out.wrptr, s)
-                out.write(4)
-            self.n += N
-            #print 'wrote', N, 'samples'
-            #from myhdl import StopSimulation
-            #raise StopSimulation
+            N = min(out.wrcnt, self.block)
+            samples = self.generate(N)
+            # Straight into the net's memory, in two parts where it wraps.
+            i = 0
+            for block in out.acquire_write(N):
+                block[:] = quantize(samples[i:i + len(block)],
+                    self.frac_bits, self.rounding, self.saturate)
+                i += len(block)
+            out.commit_write(N)
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, dspflow, net):
+    def create_and_connect(cls, parent_path, name, dspflow, net, **kwargs):
+        """Create a source; ``kwargs`` are those of the model."""
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'SignalSource', {})
-        DspFlow.connect(dspflow, net, self, 'out', prefix='out_')
+        self = system.add_node(parent_path, name, 'SignalSource', kwargs)
+        system.models['DspFlow'].connect(dspflow, net, self, 'out',
+            prefix='out_')
         return self
 
 @system.model
 class DmaSink(object):
-    def __init__(self, in_, base, out_addr):
+    """Moves the samples of a net to ``out_addr`` with channel 0 of the
+    :class:`Dma` at ``base``.
+
+    Once the channel is done with the last of them, everything the net
+    holds is queued at once; the channel wraps at the end of the net's
+    ring, reading ``burst`` words a bus grant.  The channel is polled
+    unless ``irq`` names the interrupt line of the DMA; then it says so.
+    """
+
+    def __init__(self, in_, base, out_addr, burst=16, irq=None):
         self.in_ = in_
         self.base = base
         self.out_addr = out_addr
+        self.burst = burst
+        self.irq = irq
         self.last_cnt = 0
 
+    @property
+    def irq_mask(self):
+        """The interrupt the sink is waiting on, while a transfer is
+        queued."""
+        if self.irq is None or not self.last_cnt:
+            return 0
+        return 1 << self.irq
+
     def interface(self):
         return self
 
@@ -186,29 +353,45 @@ class DmaSink(object):
 
     def work(self, os):
         in_ = self.in_()
-        if in_.rdcnt:
+        if self.irq is not None:
+            if self.last_cnt and os.raised(1 << self.irq):
+                yield os.transmit(self.base + 0x28, 1) # STATUS
+                yield os.ack_irq(self.irq)
+                in_.release_read(self.last_cnt)
+                self.last_cnt = 0
+            if in_.rdcnt and not self.last_cnt:
+                yield self._queue(os, in_, 0x400)
+        elif in_.rdcnt:
             yield os.receive(self.base + 0x10) # CNT
             if os.rdata == 0:
-                yield in_.read(self.last_cnt << 2)
-                if self.last_cnt > 0:
-                    #raise StopSimulation
-                    pass
-
-                yield os.transmit(self.base + 0x00, in_.rdptr) # SRC ADDR
-                yield os.transmit(self.base + 0x04, in_.width >> 3) # SRC INCR
-                yield os.transmit(self.base + 0x08, self.out_addr) # DEST ADDR
-                yield os.transmit(self.base + 0x0c, 0) # DEST INCR
-                cnt = min(in_.rdcnt, 64)
-                self.last_cnt = cnt
-                #print 'dma transfer', cnt
-                yield os.transmit(self.base + 0x10, cnt)
+                in_.release_read(self.last_cnt)
+                yield self._queue(os, in_, 0)
+
+    def _queue(self, os, in_, ctrl):
+        cnt = in_.rdcnt
+        self.last_cnt = cnt
+        return os.transmit_block(self.base, [
+            in_.rdptr,                  # SRC
+            in_.width >> 3,             # SRC INCR
+            self.out_addr,              # DEST
+            0,                          # DEST INCR
+            cnt,                        # CNT
+            self.burst << 16 | ctrl,    # CTRL
+            0,                          # NEXT
+            in_.mem(),                  # RING BASE
+            in_.depth,                  # RING SIZE
+        ])
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, dspflow, net):
+    def create_and_connect(cls, parent_path, name, dspflow, net, irq=None):
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'DmaSink', {
+        kwargs = {
             'base': 0x00020000,
             'out_addr': 0x00000050,
-        })
-        DspFlow.connect(dspflow, net, self, 'in_', prefix='in_')
+        }
+        if irq is not None:
+            kwargs['irq'] = irq
+        self = system.add_node(parent_path, name, 'DmaSink', kwargs)
+        system.models['DspFlow'].connect(dspflow, net, self, 'in_',
+            prefix='in_')
         return self
@@ -1,7 +1,4 @@
-import numpy as np
-from matplotlib import pyplot as plt
-from scipy import signal
-
+import array
 from myhdl import *
 
 from system import system
@@ -81,9 +78,8 @@ class DspFlow(object):
     @classmethod
     def connect(cls, self, net, node, to, width=32, depth=1, prefix=None):  # TODO
         net_class = system.models[self.kwargs['net_class']]
-        if net in self.children:
-            net_node = self.children[net]
-        else:
+        net_node = system.nodes.get('%s/%s' % (self.path, net))
+        if net_node is None:
             net_node = DspFlow.create_net(self, net, width)
         net_class.connect(net_node, node, to, prefix)
         path = lambda node, name: '%s#%s' % (node.path, name)
@@ -144,30 +140,285 @@ class FifoSource(object):
         DspFlow.connect(dspflow, net, self, 'out', prefix='out_')
         return self
 
-def scope_sink(clearn, clk, in_valid, in_data, samples):
+class Capture(object):
+    """The samples a scope keeps.
+
+    The sampler writes every sample straight into a preallocated array,
+    which numpy then works on in place.  Every ``decimation``-th sample is
+    kept; until the trigger only the last ``pretrigger`` of those are.
+    From the trigger on every sample is kept, in an array that grows as it
+    needs to, or in the ``.npy`` file ``spill`` names.
+
+    Given a ``capacity``, the samples are kept in a ring of that many
+    instead.  Without a trigger the ring keeps the newest of them and
+    overwrites the oldest, so it drops samples; with one it stops once it
+    is full, so the trigger stays in view.  Without a trigger or
+    decimation the sampler's array is the ring itself, and a sample costs
+    one store.  Otherwise the array holds ``chunk`` samples, taken in
+    together when it is full: decimation and the trigger are worked out
+    for the whole chunk at once.
+
+    :param trigger: None to capture from the start; ``'level'`` for the
+                    first sample at or above ``level``, or ``'rising'`` or
+                    ``'falling'`` for the first that crossed it.
+    """
+
+    triggers = (None, 'level', 'rising', 'falling')
+
+    # The header of a spill file is rewritten as it grows, so it takes the
+    # same room whatever the shape.
+    header_bytes = 128
+
+    def __init__(self, capacity=None, pretrigger=0, trigger=None,
+            level=0, decimation=1, spill=None, dtype='<i4', chunk=4096):
+        import numpy as np
+        if trigger not in self.triggers:
+            raise ValueError, 'Unknown trigger %r' % (trigger,)
+        if pretrigger < 0 or capacity is not None and pretrigger > capacity:
+            raise ValueError, 'Pretrigger %d is more than capacity %d' % (
+                pretrigger, capacity)
+        if capacity is not None and spill:
+            raise ValueError, 'A capture spilled to a file has no capacity'
+        self.np = np
+        self.capacity = capacity
+        self.pretrigger = pretrigger
+        self.trigger = trigger
+        self.level = level
+        self.decimation = decimation
+        self.spill = spill
+        # The sampler's array is an array.array, which takes a store for
+        # less than numpy; numpy sees the same memory.
+        self.dtype = np.dtype(dtype).newbyteorder('=')
+        self.chunk = chunk
+        self.ring = capacity is not None
+        self.direct = self.ring and trigger is None and decimation == 1
+        self.raw = array.array(self.dtype.char, [0]) * (
+            capacity if self.direct else chunk)
+        self.raw_view = np.frombuffer(self.raw, self.dtype)
+        # Where the next sample goes in raw; a list the sampler shares, which
+        # is quicker to it than an attribute.
+        self.cursor = [0]
+        if self.direct:
+            self.buffer = self.raw_view
+        elif self.ring:
+            self.buffer = np.empty(capacity, self.dtype)
+        self.file = None
+        self.clear()
+
+    def clear(self):
+        """Start over, armed."""
+        # The samples kept end at head in buffer.
+        self.cursor[0] = 0
+        self.head = 0
+        self.count = 0
+        self.seen = 0
+        self.last = None
+        self.triggered = self.trigger is None
+        self.mapped = None
+        if not self.ring:
+            # The ring of the samples before the trigger; those after it
+            # go to the file, or replace it with an array that grows.
+            self.buffer = self.np.empty(self.pretrigger, self.dtype)
+        if self.spill:
+            if self.file is None:
+                self.file = open(self.spill, 'w+b')
+            self.file.seek(0)
+            self.file.truncate()
+            self._write_header()
+
+    def add(self, sample):
+        """Add a sample; the sampler does this for every valid one."""
+        cursor = self.cursor
+        n = cursor[0]
+        self.raw[n] = sample
+        cursor[0] = n = n + 1
+        if n == len(self.raw):
+            self.flush()
+
+    def flush(self):
+        """Take in the samples added since the last flush."""
+        n = self.cursor[0]
+        if self.direct:
+            # The samples are where they belong; only the count is left.
+            if n == self.capacity:
+                self.cursor[0] = n = 0
+                self.count = self.capacity
+            self.head = n
+            self.count = max(self.count, n)
+            return
+        if not n:
+            return
+        self.cursor[0] = 0
+        if self.done:
+            return
+        x = self.raw_view[:n]
+        if self.decimation > 1:
+            start = -self.seen % self.decimation
+            self.seen += n
+            x = x[start::self.decimation]
+            if not len(x):
+                return
+        if not self.triggered:
+            i = self._find_trigger(x)
+            if i is None:
+                self._keep(x, self.pretrigger)
+                self.last = x[-1]
+                return
+            self.triggered = True
+            self._keep(x[:i], self.pretrigger)
+            x = x[i:]
+            if not self.ring:
+                before = self._ordered()
+                self.head = self.count = 0
+                if not self.spill:
+                    self.buffer = self.np.empty(len(before) + len(x),
+                        self.dtype)
+                self._store(before)
+        if not self.ring:
+            self._store(x)
+        elif self.trigger is not None:
+            self._keep(x[:self.capacity - self.count], self.capacity)
+        else:
+            self._keep(x, self.capacity)
+
+    @property
+    def done(self):
+        """Whether a triggered ring is full."""
+        return self.ring and self.trigger is not None and \
+            self.triggered and self.count == self.capacity
+
+    def _find_trigger(self, x):
+        level = self.level
+        if self.trigger == 'level':
+            hits = x >= level
+        else:
+            previous = self.np.empty(len(x), self.dtype)
+            previous[1:] = x[:-1]
+            previous[0] = self.last if self.last is not None else x[0]
+            if self.trigger == 'rising':
+                hits = (previous < level) & (x >= level)
+            else:
+                hits = (previous > level) & (x <= level)
+            if self.last is None:
+                hits[0] = False
+        i = hits.argmax()
+        return i if hits[i] else None
+
+    def _keep(self, x, limit):
+        # Into the ring, of which the newest limit samples count.
+        buffer = self.buffer
+        size = len(buffer)
+        if not size or not len(x):
+            return
+        x = x[-size:]
+        head = self.head
+        k = min(len(x), size - head)
+        buffer[head:head + k] = x[:k]
+        buffer[:len(x) - k] = x[k:]
+        self.head = (head + len(x)) % size
+        self.count = min(self.count + len(x), limit)
+
+    def _ordered(self):
+        # The samples kept, oldest first; a copy only if they wrap.
+        buffer = self.buffer
+        start = self.head - self.count
+        if start >= 0:
+            return buffer[start:self.head]
+        return self.np.concatenate((buffer[start:], buffer[:self.head]))
+
+    def _store(self, x):
+        # After the samples kept so far, in the file or the array.
+        n = len(x)
+        if self.spill:
+            self.file.seek(0, 2)
+            x.tofile(self.file)
+            self.count += n
+            return
+        if self.count + n > len(self.buffer):
+            # Doubled, so a sample is copied a few times at most; arrays
+            # data handed out before still see the old one.
+            grown = self.np.empty(max(2 * len(self.buffer), self.count + n,
+                self.chunk), self.dtype)
+            grown[:self.count] = self.buffer[:self.count]
+            self.buffer = grown
+        self.buffer[self.count:self.count + n] = x
+        self.count += n
+        self.head = self.count
+
+    def _write_header(self):
+        header = repr({'descr': self.dtype.str, 'fortran_order': False,
+            'shape': (self.count,)})
+        header = header.ljust(self.header_bytes - 11) + '\n'
+        self.file.seek(0)
+        self.file.write('\x93NUMPY\x01\x00' +
+            chr(len(header) & 0xff) + chr(len(header) >> 8) + header)
+
+    @property
+    def data(self):
+        """The samples captured, oldest first, as an array that shares
+        their memory unless a ring has wrapped; a memmap of the spill
+        file if there is one."""
+        self.flush()
+        if not self.spill:
+            return self._ordered()
+        if self.mapped is None or len(self.mapped) != self.count:
+            self._write_header()
+            self.file.flush()
+            self.mapped = self.np.load(self.spill, mmap_mode='r') \
+                if self.count else self.np.empty(0, self.dtype)
+        return self.mapped
+
+    def __len__(self):
+        self.flush()
+        return self.count
+
+def scope_sink(clearn, clk, in_valid, in_data, capture):
+    # Capture.add, inlined; raw and cursor are the same for good.
+    raw = capture.raw
+    cursor = capture.cursor
+    size = len(raw)
+    # Whether the capture was cleared since clearn fell; it is cleared once
+    # as it falls, not on every clock it stays low.
+    cleared = [False]
+
     @always(clk.posedge)
     def sampler():
         if not clearn:
-            del samples[:]
+            if not cleared[0]:
+                capture.clear()
+                cleared[0] = True
+        else:
+            cleared[0] = False
         if in_valid:
-            samples.append(int(in_data.signed()))
+            n = cursor[0]
+            raw[n] = int(in_data.signed())
+            cursor[0] = n = n + 1
+            if n == size:
+                capture.flush()
 
     return sampler
 
 @system.model
 class ScopeSink(object):
-    def __init__(self, clearn, clk, signal):
+    """Captures the samples of a net; see :class:`Capture` for the
+    kwargs."""
+
+    def __init__(self, clearn, clk, signal, **kwargs):
         self.clearn = clearn
         self.clk = clk
         self.signal = signal
-        self.samples = []
+        self.capture = Capture(**kwargs)
+
+    @property
+    def samples(self):
+        return self.capture.data
 
     @property
     def sim_instance(self):
         return scope_sink
 
     def signals_dict(self):
-        signals = { 'samples': self.samples }
+        signals = { 'capture': self.capture }
         print self.clearn(), self.clk(), self.signal()
         signals.update(self.clearn())
         signals.update(self.clk())
@@ -175,22 +426,25 @@ class ScopeSink(object):
         return signals
 
     def plot(self):
-        n = np.arange(len(self.samples))
-        print self.samples
-        y = np.array([s for s in self.samples])
-        plt.plot(n, y)
-        plt.xlim(0, len(self.samples) - 1)
+        import numpy as np
+        from matplotlib import pyplot as plt
+        y = self.samples
+        plt.plot(np.arange(len(y)) * self.capture.decimation, y)
+        plt.xlim(0, max(len(y) - 1, 1) * self.capture.decimation)
 
     def show(self):
+        from matplotlib import pyplot as plt
         plt.show()
 
     def savefig(self, fname, **kwargs):
+        from matplotlib import pyplot as plt
         plt.savefig(fname, **kwargs)
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, clearn, clk, dspflow, net):
+    def create_and_connect(cls, parent_path, name, clearn, clk, dspflow, net,
+            **kwargs):
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'ScopeSink', {})
+        self = system.add_node(parent_path, name, 'ScopeSink', kwargs)
         system.add_edge('CallAttrEdge',
             path(clearn, 'out'),
             path(self, 'clearn'),
@@ -206,6 +460,7 @@ class ScopeSink(object):
 class Fir(object):
     @classmethod
     def design_low_pass(cls, sample_rate, cutoff_hz, width_hz, ripple_db):
+        from scipy import signal
         nyq_rate = sample_rate / 2.0
         N, beta = signal.kaiserord(ripple_db, width_hz / nyq_rate)
         taps = signal.firwin(N, cutoff_hz / nyq_rate, window=('kaiser', beta))
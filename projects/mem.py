@@ -1,14 +1,101 @@
+import mmap
+import os
+import re
+from collections import deque
+
 from myhdl import *
 
 from system import system
 
+image_formats = ('hex', 'bin', 'npy')
+
+def _word_dtype(width):
+    if width not in (8, 16, 32, 64):
+        raise ValueError, 'No binary image format for %d bit words' % width
+    return '<u%d' % (width // 8)
+
+def read_image(path, width, fmt='hex'):
+    """The words of an image file as a numpy array.
+
+    ``'bin'`` images are little endian words and ``'npy'`` ones numpy
+    arrays; both are mapped copy on write rather than read, so the array
+    costs nothing until it is written.  ``'hex'`` images are what
+    ``$readmemh`` reads: hex words, ``//`` comments and ``@`` word
+    addresses.
+    """
+    import numpy as np
+    if fmt == 'bin':
+        if not os.path.getsize(path):
+            return np.zeros(0, _word_dtype(width))
+        return np.memmap(path, _word_dtype(width), 'c')
+    elif fmt == 'npy':
+        return np.load(path, mmap_mode='c')
+    elif fmt != 'hex':
+        raise ValueError, 'Unknown image format %r' % (fmt,)
+
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return np.zeros(0, np.uint64)
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            tokens = re.sub(r'//[^\n]*', '', text[:]).split()
+        finally:
+            text.close()
+    dtype = np.uint64 if width <= 64 else object
+    if not any(t.startswith('@') for t in tokens):
+        return np.array([int(t, 16) for t in tokens], dtype)
+    chunks = []
+    addr = 0
+    for t in tokens:
+        if t.startswith('@'):
+            addr = int(t[1:], 16)
+        else:
+            chunks.append((addr, int(t, 16)))
+            addr += 1
+    data = np.zeros(max(a for a, w in chunks) + 1 if chunks else 0, dtype)
+    for a, w in chunks:
+        data[a] = w
+    return data
+
+def write_image(path, data, width, fmt='hex'):
+    """Write words to an image file that :func:`read_image` reads back.
+    ``'bin'`` images are written through a mapping of the file."""
+    import numpy as np
+    if fmt == 'bin':
+        dtype = _word_dtype(width)
+        if not len(data):
+            open(path, 'wb').close()
+            return
+        out = np.memmap(path, dtype, 'w+', shape=(len(data),))
+        out[:] = data
+        out.flush()
+        del out
+    elif fmt == 'npy':
+        np.save(path, np.asarray(data))
+    elif fmt == 'hex':
+        digits = (width + 3) // 4
+        with open(path, 'w') as f:
+            for w in data:
+                f.write('%0*x\n' % (digits, w))
+    else:
+        raise ValueError, 'Unknown image format %r' % (fmt,)
+
+
 def ram(reset,
         addra, dina, pipea, wmodea, blka, wena, clka, douta,
         addrb, dinb, pipeb, wmodeb, blkb, wenb, clkb, doutb,
         width, depth, **kwargs):
-    """A ram block."""
+    """A ram block.
+
+    :param init: The initial words; the converted HDL gets them from the
+                 ``$readmemh`` file the ``.v`` view writes instead.
+    """
     delay = kwargs.get('delay', 3)
-    ram = [Signal(intbv(0, min=0, max=2**width-1), delay=delay) for i in xrange(depth)]
+    init = kwargs.get('init')
+    if init is None:
+        ram = [Signal(intbv(0, min=0, max=2**width-1), delay=delay) for i in xrange(depth)]
+    else:
+        ram = [Signal(intbv(int(w), min=0, max=2**width-1), delay=delay) for w in init]
 
     ba = len(douta)
     bb = len(doutb)
@@ -53,6 +140,91 @@ def ram(reset,
         instances = instances + (portb_pipe, )
     return instances
 
+def ram_model(reset,
+        addra, dina, pipea, wmodea, blka, wena, clka, douta,
+        addrb, dinb, pipeb, wmodeb, blkb, wenb, clkb, doutb,
+        width, depth, **kwargs):
+    """A behavioral model of :func:`ram` for simulation.
+
+    The words are one numpy array instead of a signal each, so a deep ram
+    costs no more to build or to write than a shallow one.  The ports
+    behave the same, cycle for cycle: a write lands ``delay`` after the
+    clock edge and the outputs follow the addressed words.
+
+    :param init: The array to keep the words in, which writes update.
+    """
+    import numpy as np
+    delay_ = kwargs.get('delay', 3)
+    mem = kwargs.get('init')
+    if mem is None:
+        mem = np.zeros(depth, np.uint64 if width <= 64 else object)
+
+    ba = len(douta)
+    bb = len(doutb)
+
+    if pipea:
+        da = Signal(intbv(0, min=0, max=2**ba))
+    else:
+        da = douta
+
+    if pipeb:
+        db = Signal(intbv(0, min=0, max=2**bb))
+    else:
+        db = doutb
+
+    @always(addra, addrb)
+    def reader():
+        da.next = int(mem[addra])
+        db.next = int(mem[addrb])
+
+    # Writes wait here, in the order they land, for their delay to pass; a
+    # port takes the next one on its next edge meanwhile, however soon.
+    writes = deque()
+    queued = Signal(bool(0))
+
+    @always(clka.posedge)
+    def porta():
+        if not blka and not wena:
+            writes.append((now() + delay_, int(addra), int(dina)))
+            queued.next = not queued
+
+    @always(clkb.posedge)
+    def portb():
+        if not blkb and not wenb:
+            writes.append((now() + delay_, int(addrb), int(dinb)))
+            queued.next = not queued
+
+    @instance
+    def writer():
+        while True:
+            if not writes:
+                yield queued
+                continue
+            due, addr, data = writes[0]
+            if due > now():
+                yield delay(due - now())
+            writes.popleft()
+            mem[addr] = data
+            if addr == addra:
+                da.next = data
+            if addr == addrb:
+                db.next = data
+
+    @always(clka.posedge)
+    def porta_pipe():
+        douta.next = da
+
+    @always(clkb.posedge)
+    def portb_pipe():
+        doutb.next = db
+
+    instances = (reader, porta, portb, writer)
+    if pipea:
+        instances = instances + (porta_pipe, )
+    if pipeb:
+        instances = instances + (portb_pipe, )
+    return instances
+
 @system.model
 class Ram(object):
     def __init__(self, resetn, clka, clkb, width, depth, **kwargs):
@@ -63,7 +235,9 @@ class Ram(object):
         self.depth = depth
         pipe = kwargs.get('pipe', True)
         pipe = 1 if pipe else 0
+        self.behavioral = kwargs.get('behavioral', True)
         self.kwargs = kwargs
+        self.mem = None
         #self.resetn = resetn.signal
         self.addra = Signal(intbv(0)[depth:])
         self.dina = Signal(intbv(0)[width:])
@@ -104,11 +278,51 @@ class Ram(object):
                 width=self.width,
                 depth=self.depth,
         )
+        if not system.converting and (self.behavioral or
+                self.mem is not None):
+            signals['init'] = self.memory()
         signals.update(self._resetn(name='reset'))
         signals.update(self._clka(name='clka'))
         signals.update(self._clkb(name='clkb'))
         return signals
 
+    def memory(self):
+        """The words, as a numpy array; the behavioral model writes to
+        it."""
+        if self.mem is None:
+            import numpy as np
+            self.mem = np.zeros(self.depth,
+                np.uint64 if self.width <= 64 else object)
+        return self.mem
+
+    def load_image(self, path, fmt='hex', offset=0):
+        """Preload the words from an image file; see :func:`read_image`.
+
+        An image filling the whole ram of a simulation not built yet is
+        used as it is mapped, so it is not copied until the simulation
+        writes to it; other images are copied into the words.
+
+        :param offset: The byte address to load it at.
+        """
+        image = read_image(path, self.width, fmt)
+        start = offset // (self.width // 8)
+        if start + len(image) > self.depth:
+            raise ValueError, '%d word image at word %d overflows %d words' % (
+                len(image), start, self.depth)
+        if self.mem is None and start == 0 and len(image) == self.depth \
+                and self.width <= 64:
+            self.mem = image
+        else:
+            self.memory()[start:start + len(image)] = image
+        system.touch(self)
+
+    def dump_image(self, path, fmt='hex', offset=0, count=None):
+        """Write ``count`` words from byte address ``offset``, by default
+        the rest of the ram, to an image file."""
+        start = offset // (self.width // 8)
+        end = self.depth if count is None else start + count
+        write_image(path, self.memory()[start:end], self.width, fmt)
+
     def port_a(self, prefix=None, d=None):
         if d:
             return dict([(theirs, getattr(self, mine))
@@ -140,12 +354,20 @@ class Ram(object):
 
     @property
     def instance(self):
+        # Simulations get the behavioral model; the HDL is what converts.
+        if self.behavioral and not system.converting:
+            return ram_model
         return ram
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, resetn, clka, clkb, width, depth, pipe=True):
+    def create_and_connect(cls, parent_path, name, resetn, clka, clkb, width, depth, pipe=True, behavioral=True):
+        """Create a ram.
+
+        :param behavioral: Simulate it with :func:`ram_model` rather than
+                           a signal per word.
+        """
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'Ram', { 'width': width, 'depth': depth, 'pipe': pipe })
+        self = system.add_node(parent_path, name, 'Ram', { 'width': width, 'depth': depth, 'pipe': pipe, 'behavioral': behavioral })
         system.add_edge('CallAttrEdge',
             path(resetn, 'signals_dict'),
             path(self, 'resetn'))
@@ -166,6 +388,7 @@ def fifo(resetn,
 
     wptr = Signal(modbv(0, min=0, max=depth))
     rptr = Signal(modbv(0, min=0, max=depth))
+    level = Signal(modbv(0, min=0, max=depth))
 
     @always_comb
     def assignments():
@@ -187,9 +410,14 @@ def fifo(resetn,
         #wrcnt.next = modbv(depth - (wptr - rptr), min=0, max=depth)
         #rdcnt.next = modbv(wptr - rptr, min=0, max=depth)
 
-        #afull.next = wrcnt >= afval
-        #aempty.next = rdcnt <= aeval
+        # The thresholds of the fifo's interrupts.
+        afull.next = level >= afval
+        aempty.next = level <= aeval
 
+    # The words in the fifo; the difference wraps like the pointers.
+    @always_comb
+    def levels():
+        level.next = wptr - rptr
 
     @always_seq(wclk.posedge, reset=resetn)
     def writer():
@@ -222,11 +450,20 @@ def fifo(resetn,
             dvld.next = False
             underflow.next = False
 
-    return assignments, writer, reader
+    return assignments, levels, writer, reader
 
 @system.model
 class Fifo(object):
-    def __init__(self, resetn, write_port, read_port, width, depth):
+    """A fifo of ``depth`` words ``width`` bits wide.
+
+    ``afull`` is high while it holds ``afull_level`` words or more, and
+    ``aempty`` while it holds ``aempty_level`` or fewer; by default three
+    quarters and a quarter of its depth.  Those, ``full`` and ``empty``
+    can be the lines of an :class:`InterruptController`, see :meth:`irq`.
+    """
+
+    def __init__(self, resetn, write_port, read_port, width, depth,
+            afull_level=None, aempty_level=None):
         self._resetn = resetn
         self._write_port = write_port
         self._read_port = read_port
@@ -243,8 +480,12 @@ class Fifo(object):
         self.afull = Signal(bool(False))
         self.empty = Signal(bool(True))
         self.aempty = Signal(bool(True))
-        self.afval = Signal(intbv(0, min=0, max=depth))
-        self.aeval = Signal(intbv(0, min=0, max=depth))
+        if afull_level is None:
+            afull_level = 3 * depth // 4
+        if aempty_level is None:
+            aempty_level = depth // 4
+        self.afval = Signal(intbv(afull_level, min=0, max=depth))
+        self.aeval = Signal(intbv(aempty_level, min=0, max=depth))
         self.wack = Signal(bool(False))
         self.dvld = Signal(bool(False))
         self.overflow = Signal(bool(False))
@@ -309,15 +550,27 @@ class Fifo(object):
         signals.update(self._read_port())
         return signals
     
+    def irq(self, name, event='afull'):
+        """``{name: signal}`` of ``event``, ``'afull'``, ``'aempty'``,
+        ``'full'`` or ``'empty'``, for an interrupt line."""
+        return { name: getattr(self, event) }
+
     @property
     def instance(self):
         return fifo
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, resetn, wclk, rclk, width, depth):
+    def create_and_connect(cls, parent_path, name, resetn, wclk, rclk, width, depth, behavioral=True,
+            afull_level=None, aempty_level=None):
+        """Create a fifo; ``behavioral`` is passed on to its :class:`Ram`."""
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'Fifo', {'width': width, 'depth': depth})
-        ram = Ram.create_and_connect(self.path, 'ram', resetn, wclk, rclk, width, depth, pipe=False)
+        kwargs = {'width': width, 'depth': depth}
+        if afull_level is not None:
+            kwargs['afull_level'] = afull_level
+        if aempty_level is not None:
+            kwargs['aempty_level'] = aempty_level
+        self = system.add_node(parent_path, name, 'Fifo', kwargs)
+        ram = Ram.create_and_connect(self.path, 'ram', resetn, wclk, rclk, width, depth, pipe=False, behavioral=behavioral)
         system.add_edge('CallAttrEdge',
             path(resetn, 'signals_dict'),
             path(self, 'resetn'))
@@ -107,7 +107,7 @@ def test_project1_hw():
 def load():
     resetn = Reset.create_and_connect('/', 'resetn', async=False)
     clk = Clock.create_and_connect('/', 'clk', int(1e9/10e6))
-    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(1e9/10e6),
+    soc = create_interconnect('/', 'soc', resetn, clk, duration=int(1e9/10e6),
             address_mask=0xff)
     pbus = Apb3Bus.create('/soc', 'pbus', soc, duration=int(1e9/10e6), verbose=True)
     status_led = Led.create_and_connect('/soc', 'status_led')
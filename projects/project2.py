@@ -4,6 +4,7 @@ from myhdl import *
 from system import *
 s = System('project2')
 from soc import *
+from dsp import *
 
 def slave(
     bus_presetn, bus_pclk, bus_paddr, bus_psel, bus_penable, bus_pwrite,
@@ -175,9 +176,8 @@ def test_project2():
     print 'sample_rate', sample_rate, 'freq', freq
     samples = np.sin(2 * np.pi * n * (freq / sample_rate))
 
-    for sample in samples:
-        s = intbv(int(sample * (2**31 - 1)))[32:]
-        yield root.transmit(0x50, s)
+    samples = (samples * (2**31 - 1)).astype(np.int32)
+    yield root.transmit_block(0x50, samples, incr=0)
 
     yield root.transmit(0x40, 0x0001)
     assert status_led.signal
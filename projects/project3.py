@@ -4,6 +4,7 @@ from myhdl import *
 from system import *
 s = System('project3')
 from soc import *
+from dsp import *
 
 def slave(
     bus_presetn, bus_pclk, bus_paddr, bus_psel, bus_penable, bus_pwrite,
@@ -169,17 +170,25 @@ def load():
     resetn = Reset.create_and_connect('/', 'resetn', async=False)
     clk = Clock.create_and_connect('/', 'clk', int(10e6))
     status_led = Led.create_and_connect('/', 'status_led')
-    soc = BusMatrix.create('/', 'soc', resetn, clk, duration=int(10e6),
+    soc = create_interconnect('/', 'soc', resetn, clk, duration=int(10e6),
         address_mask=0xffff)
     pbus = Apb3Bus.create('/soc', 'pbus', soc, duration=int(10e6), verbose=False)
     dmaready = Flag.create_and_connect('/soc', 'dmaready')
     project3 = Project3.create_and_connect('/soc/pbus', 'project3',
         resetn, clk, pbus, status_led, dmaready)
 
-    emc = Mem.create_and_connect('/soc', 'mem', soc, width=32, depth=512)
+    emc = Mem.create_and_connect('/soc', 'mem', soc, width=32, depth=512,
+        base=0x10000)
     dma = Dma.create_and_connect('/soc', 'dma', soc, dmaready)
     cpu = Cpu.create_and_connect('/soc', 'cpu', soc)
 
+    # Line 0 is the DMA, 1 and 2 the fifo running low and high.
+    intc = InterruptController.create_and_connect('/soc', 'intc', soc)
+    fifo = system.node_at_path('/soc/pbus/project3/fifo')
+    InterruptController.connect(intc, 0, dma)
+    InterruptController.connect(intc, 1, fifo, event='aempty')
+    InterruptController.connect(intc, 2, fifo, event='afull')
+
     dsp = DspFlowController.create_and_connect('/soc/cpu',
             'daemon')
     dsp_signal = DspFlow.create_net(dsp, 'signal',
@@ -193,7 +202,7 @@ def load():
     Slider.connect(audio_freq, signal_source, 'freq')
     Slider.connect(audio_sample_rate, signal_source, 'sample_rate')
     dma_sink = DmaSink.create_and_connect('/soc/cpu/daemon/dsp',
-            'dma_sink', dsp, 'signal')
+            'dma_sink', dsp, 'signal', irq=0)
 
     sim = Sim.create_and_connect('/', 'test_project3', 'test_project3',
             '/soc/pbus/project3')
@@ -205,6 +214,7 @@ def test_project3():
     conv_clk = system.node_at_path('/soc/pbus/project3/conv_clk').container
     scope = system.node_at_path('/soc/pbus/project3/dsp/scope').container
     yield root.reset()
+    yield root.enable_irq(0x1)
 
     N = 128
     sample_rate = conv_clk.freq
@@ -215,6 +225,7 @@ def test_project3():
 
     while len(scope.samples) < N - 1:
         yield daemon.step()
+        yield daemon.wait()
 
     scope.plot()
     scope.savefig('test_project3.png')
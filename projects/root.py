@@ -1,6 +1,10 @@
+import os
+
 from myhdl import *
 
 from system import system
+from bus import Idle, block_receive
+from alloc import Allocator
 
 def simulation(bus, tops):
     dut = []
@@ -12,25 +16,24 @@ def simulation(bus, tops):
         if hasattr(top, 'sim_instance'):
             sim.append(top.sim_instance(**top.sim_signals_dict()))
 
-    if type(bus.masters) == list:
-        masters = []
-        for m in bus.masters:
-            masters.append(iter(m()()))
-    else:
-        masters = [iter(bus.masters()())]
+    grants = bus.arbiter()
 
-    print 'Masters', masters
+    print 'Masters', grants.paths
 
     @instance
     def arbiter():
-        while True:
-            for master in masters:
-                yield master.next()
-                while bus.locked:
-                    #print 'locked'
-                    yield master.next()
+        yield grants.run()
+
+    # Slaves that watch signals of their own, like an InterruptController
+    # latching its lines, have a process.
+    processes = []
+    for slave in bus.address_map.slaves():
+        if hasattr(slave, 'process'):
+            process = slave.process()
+            if process is not None:
+                processes.append(process)
 
-    return dut, sim, arbiter
+    return dut, sim, arbiter, processes
 
 @system.model
 class OperatingSystem(object):
@@ -41,12 +44,23 @@ class OperatingSystem(object):
         return self
 
     def _inspect_system(self):
+        if hasattr(self, 'intc'):
+            # Every access comes through here; intc is found last.
+            return
         if not hasattr(self, 'soc'):
-            soc = system.node_at_path('/soc')
+            soc, = (system.nodes_of_class('BusMatrix') +
+                system.nodes_of_class('AxiBus'))
             self.soc = soc.container
         if not hasattr(self, 'cpu'):
-            cpu = system.node_at_path('/soc/cpu')
+            cpu, = system.nodes_of_class('Cpu')
             self.cpu = cpu.container
+        if not hasattr(self, 'intc'):
+            self.intc = self.intc_base = None
+            for intc in system.nodes_of_class('InterruptController'):
+                self.intc = intc.container
+                for base, size, path in self.soc.address_map:
+                    if path == intc.path:
+                        self.intc_base = base
 
     def simulate(self, node_paths, script, name):
         self._inspect_system()
@@ -56,36 +70,122 @@ class OperatingSystem(object):
         nodes = []
         for node in node_paths:
             nodes.append(system.node_at_path(node).container)
+        # $DCC_RECORD_BUS names a file for a report of the bus transactions.
+        record = os.environ.get('DCC_RECORD_BUS')
+        recorder = None
+        if record and hasattr(self.soc, 'record'):
+            recorder = self.soc.record()
+
         traceSignals.name = name
         t = traceSignals(simulation, self.soc, nodes)
+        system.resume_profiling()
         s = Simulation(t)
         s.run()
 
-    def alloc(self, name, size):
+        if recorder is not None:
+            with open(record, 'w') as f:
+                recorder.report(f)
+
+    @property
+    def heap(self):
+        """The :class:`Allocator` over the :class:`Mem` slaves of the
+        SoC."""
+        if not hasattr(self, '_heap'):
+            self._inspect_system()
+            regions = []
+            for base, size, path in self.soc.address_map:
+                node = system.node_at_path(path)
+                if node.cls == 'Mem':
+                    # Only the addresses both the bus and the memory have.
+                    mem = node.container
+                    start = max(base, mem.base)
+                    end = min(base + size, mem.base + mem.size)
+                    if start < end:
+                        regions.append((start, end - start))
+            self._heap = Allocator(regions)
+        return self._heap
+
+    def buffer(self, addr, nbytes):
+        """The memory at ``addr`` as a numpy array the CPU reads and writes
+        without going through the bus; see :meth:`Mem.buffer`.
+
+        :raises ValueError: If there is no :class:`Mem` there.
+        """
         self._inspect_system()
-        return 0x00010000
+        mem = self.soc.address_map.lookup(addr)
+        if not hasattr(mem, 'buffer'):
+            raise ValueError, 'No memory the CPU can map at %#x' % addr
+        return mem.buffer(addr, nbytes)
+
+    def alloc(self, name, size, align=None):
+        """Allocate ``size`` bytes of memory as ``name``; see
+        :meth:`Allocator.alloc`."""
+        return self.heap.alloc(name, size, align)
 
     def free(self, name):
-        self._inspect_system()
-        pass
+        self.heap.free(name)
 
     def reset(self):
         self._inspect_system()
         yield self.soc.reset()
 
+    def raised(self, mask=0xffffffff):
+        """The enabled interrupt lines among ``mask`` that are pending, as
+        the CPU sees them without a bus access; 0 if there is no
+        :class:`InterruptController`."""
+        self._inspect_system()
+        if self.intc is None:
+            return 0
+        return self.intc.raised(mask)
+
+    def wait_irq(self, mask=0xffffffff):
+        """What the firmware yields to sleep until one of the lines in
+        ``mask`` is raised, leaving the bus to the other masters."""
+        self._inspect_system()
+        return self.intc.wait(mask)
+
+    def ack_irq(self, line):
+        """Acknowledge interrupt ``line`` at the controller."""
+        self._inspect_system()
+        return self.transmit(self.intc_base, 1 << line)
+
+    def enable_irq(self, mask):
+        """Let the lines in ``mask``, and only those, interrupt the CPU."""
+        self._inspect_system()
+        return self.transmit(self.intc_base + 0x04, mask)
+
     def delay(self, cnt):
         self._inspect_system()
         yield self.soc.delay(cnt)
 
     def transmit(self, addr, data):
         self._inspect_system()
-        yield self.soc.transmit(addr, data)
+        return self.soc.transmit(addr, data)
 
     def receive(self, addr):
         self._inspect_system()
-        yield self.soc.receive(addr)
+        access = self.soc.receive(addr)
+        if access is None or type(access) is delay:
+            # Only time is left; see BusMatrix.receive.
+            self.rdata = self.soc.rdata
+            return access
+        return self._complete_receive(access)
+
+    def _complete_receive(self, access):
+        yield access
         self.rdata = self.soc.rdata
 
+    def transmit_block(self, addr, data, incr=4):
+        """Transmit a block of words; see :meth:`BusMatrix.transmit_block`."""
+        self._inspect_system()
+        return self.soc.transmit_block(addr, data, incr)
+
+    def receive_block(self, addr, n, incr=4):
+        """Receive ``n`` words into ``self.rdata``; see
+        :meth:`BusMatrix.receive_block`."""
+        self._inspect_system()
+        return block_receive(self, self.soc, addr, n, incr)
+
     @classmethod
     def create_and_connect(cls, parent_path, name, soc):
         path = lambda node, name: '%s#%s' % (node.path, name)
@@ -1,58 +1,85 @@
+import array
+from collections import defaultdict
+from math import log, ceil
 from myhdl import *
 
 from system import *
 from root import *
 from bus import *
+from axi import *
 from mem import *
 from cpu import *
-from dsp import *
 from viz import *
 from hci import *
 
+# The DSP models are only needed by designs with a DSP flowgraph, which
+# import dsp themselves; anything else that names them loads it then.
+system.lazy_model('dsp', 'DspNet', 'DspFlow', 'FifoSource', 'ScopeSink', 'Fir')
+
 @system.model
 class CallAttrEdge(object):
+    __slots__ = ('from_node', 'from_attr', 'to_node', 'to_attr', 'kwargs',
+        'cache', 'hits', 'misses')
+
     def __init__(self, system, fr, to, kwargs):
         from_path, from_attr = fr.split('#')
         to_path, to_attr = to.split('#')
         from_node = system.node_at_path(from_path)
         to_node = system.node_at_path(to_path)
-        self.system = system
         self.from_node = from_node
-        self.from_attr = from_attr
+        self.from_attr = intern(from_attr)
         self.to_node = to_node
-        self.to_attr = to_attr
+        self.to_attr = intern(to_attr)
         self.kwargs = kwargs
 
-        # This block starts by lazily creating edges as scalar values;
-        # then if a second cone is added, it turns the edge into a list;
-        # Subsequent edges are added to the list.
-        if from_attr in from_node.outputs:
-            if type(from_node.outputs[from_attr]) == list:
-                from_node.outputs[from_attr].append(self)
-            else:
-                from_node.outputs[from_attr] = [
-                    from_node.outputs[from_attr],
-                    self
-                ]
-        else:
-            from_node.outputs[from_attr] = self
+        # Results by call kwargs, and how often they were reused.
+        self.cache = None
+        self.hits = 0
+        self.misses = 0
 
-        # Same for inputs.
-        if to_attr in to_node.inputs:
-            if type(to_node.inputs[to_attr]) == list:
-                to_node.inputs[to_attr].append(self)
-            else:
-                to_node.inputs[to_attr] = [
-                    to_node.inputs[to_attr],
-                    self
-                ]
-        else:
-            to_node.inputs[to_attr] = self
+    @classmethod
+    def between(cls, from_node, from_attr, to_node, to_attr, kwargs):
+        """An edge between nodes that are already at hand, as a snapshot
+        restores them; the attrs must be interned."""
+        self = cls.__new__(cls)
+        self.from_node = from_node
+        self.from_attr = from_attr
+        self.to_node = to_node
+        self.to_attr = to_attr
+        self.kwargs = kwargs
+        self.cache = None
+        self.hits = 0
+        self.misses = 0
+        return self
 
     def __call__(self, **kwargs):
-        kw = dict(self.kwargs)
-        kw.update(kwargs)
-        return getattr(self.from_node.container, self.from_attr)(**kw)
+        """Call the attribute on the producer's container.
+
+        Results are cached by the call's kwargs until :meth:`invalidate`.
+        A cached dict is handed out as a copy, since consumers update the
+        signal dicts they get back.
+        """
+        key = tuple(sorted(kwargs.iteritems()))
+        try:
+            result = self.cache[key]
+            self.hits += 1
+        except (TypeError, KeyError):
+            self.misses += 1
+            kw = dict(self.kwargs)
+            kw.update(kwargs)
+            result = getattr(self.from_node.container, self.from_attr)(**kw)
+            try:
+                if self.cache is None:
+                    self.cache = {}
+                self.cache[key] = result
+            except TypeError:
+                pass
+        if type(result) == dict:
+            return dict(result)
+        return result
+
+    def invalidate(self):
+        self.cache = None
 
     def __getstate__(self):
         state = {
@@ -60,8 +87,7 @@ class CallAttrEdge(object):
             'from': '%s#%s' % (self.from_node.path, self.from_attr),
             'to': '%s#%s' % (self.to_node.path, self.to_attr),
         }
-        state.update(self.kwargs)
-        return state
+        return merge_kwargs(state, self.kwargs)
 
 def clock(clk, duration):
     @instance
@@ -160,40 +186,288 @@ class Synchronize(object):
 
 @system.model
 class Mem(object):
-    def __init__(self, width, depth):
+    """A sparse memory of ``depth`` words ``width`` bits wide.
+
+    The words live in numpy pages of ``2**page_bits`` bytes, allocated the
+    first time one of their words is written; reading a page that never
+    was gives zeros.  So a memory can span the whole 32-bit space and cost
+    only the pages in use.  :attr:`page_accesses` counts the words read or
+    written in each page.
+
+    The memory holds the addresses ``[base, base + size)``.  A memory of
+    ``2**30`` words at base 0 covers the whole 32-bit space.
+
+    :raises ValueError: On an access outside the memory.
+    """
+
+    page_bits = 12
+
+    def __init__(self, width, depth, base=0):
+        import numpy as np
+        if width not in (8, 16, 32, 64):
+            raise ValueError, 'No %d bit memory' % width
+        self.np = np
         self.width = width
         self.lg2width = int(ceil(log(width / 8, 2)))
         self.depth = depth
-        self.mem = [0 for i in xrange(depth)]
+        self.size = depth << self.lg2width
+        self.base = base
+        self.dtype = np.dtype('<u%d' % (width // 8))
+        self.word_max = (1 << width) - 1
+        self.word_bits = self.page_bits - self.lg2width
+        self.page_words = 1 << self.word_bits
+        self.page_mask = (1 << self.page_bits) - 1
+        self.zeros = np.zeros(self.page_words, self.dtype)
+        self.zeros.flags.writeable = False
+
+        # Pages loaded from images, which reset goes back to.  The pages
+        # being used are those until a word of them is written; then they
+        # are copied and the copy is written.
+        self.initial = {}
+        # Pages that arrays from buffer are views of.
+        self.mapped = {}
+        self.reset()
 
     def interface(self):
         return self
 
     def reset(self):
-        for i in xrange(self.depth):
-            self.mem[i] = 0
+        self.pages = dict(self.initial)
+        self.written = set()
+        # Mapped pages stay, back to what they started as.
+        for p, page in self.mapped.iteritems():
+            page[:] = self.initial.get(p, self.zeros)
+            self.pages[p] = page
+            self.written.add(p)
+        self.page_accesses = defaultdict(int)
 
     def delay(self, n):
         pass
 
-    def transmit(self, addr, data):
-        self.mem[(addr & 0xffff) >> self.lg2width] = data
-        #print 'write', hex(addr), hex(self.mem[(addr & 0xffff) >> self.lg2width])
+    def _index(self, addr):
+        offset = addr - self.base
+        if not 0 <= offset < self.size:
+            raise ValueError, 'Address %#x is outside the %d byte memory' % (
+                addr, self.size)
+        return offset >> self.lg2width
+
+    def _count(self, p, n):
+        self.page_accesses[p] += n
+
+    def _writable(self, p):
+        page = self.pages.get(p, self.zeros)
+        if p not in self.written:
+            page = self.pages[p] = page.copy()
+            self.written.add(p)
+        return page
+
+    def _spans(self, i, n, step):
+        """(page, words in the page, words of the block) for ``n`` words
+        ``step`` apart from word ``i``."""
+        k = 0
+        while k < n:
+            w = i + k * step
+            p = w >> self.word_bits
+            j = w & (self.page_words - 1)
+            m = min(n - k, (self.page_words - 1 - j) // step + 1)
+            yield p, slice(j, j + (m - 1) * step + 1, step), slice(k, k + m)
+            k += m
+
+    def _array(self, data):
+        # Blocks as numpy words; bus words are 32 bits.
+        np = self.np
+        if hasattr(data, 'astype'):
+            return data.astype(self.dtype)
+        if self.width == 32:
+            return np.frombuffer(words(data), np.uint32)
+        return np.array([int(w) & self.word_max for w in data], self.dtype)
+
+    # Single words are the common case, so the address check and page
+    # lookup are inlined.
+    def transmit(self, addr, data, strobe=None):
+        """Write a word.
+
+        :param strobe: Write only the bytes of the word whose bit is set
+                       in this mask, bit 0 for the lowest address.
+        """
+        offset = addr - self.base
+        if not 0 <= offset < self.size:
+            self._index(addr)
+        p = offset >> self.page_bits
+        page = self.pages[p] if p in self.written else self._writable(p)
+        j = (offset & self.page_mask) >> self.lg2width
+        if type(data) is not int:
+            data = int(data)
+        if strobe is None:
+            page[j] = data & self.word_max
+        else:
+            # The bytes of a word are little endian.
+            old = page.item(j)
+            for k in xrange(self.width // 8):
+                if strobe >> k & 1:
+                    byte = 0xff << 8 * k
+                    old = old & ~byte | data & byte
+            page[j] = old
+        self.page_accesses[p] += 1
 
     def receive(self, addr):
-        self.rdata = self.mem[(addr & 0xffff) >> self.lg2width]
-        #print 'read', hex(addr), hex(self.rdata)
+        offset = addr - self.base
+        if not 0 <= offset < self.size:
+            self._index(addr)
+        p = offset >> self.page_bits
+        self.rdata = int(self.pages.get(p, self.zeros).item(
+            (offset & self.page_mask) >> self.lg2width))
+        self.page_accesses[p] += 1
+
+    def transmit_block(self, addr, data, incr=4):
+        data = self._array(data)
+        n = len(data)
+        if not n:
+            return
+        step = incr >> self.lg2width
+        if not step:
+            self.transmit(addr, data[-1])
+            return
+        i = self._index(addr)
+        self._index(addr + (n - 1) * incr)
+        for p, words_, block in self._spans(i, n, step):
+            self._writable(p)[words_] = data[block]
+            self._count(p, block.stop - block.start)
+
+    def receive_block(self, addr, n, incr=4):
+        step = incr >> self.lg2width
+        if not step:
+            self.receive(addr)
+            block = self.np.empty(n, self.dtype)
+            block.fill(self.rdata)
+        else:
+            block = self._read(self._index(addr), n, step)
+            if n:
+                self._index(addr + (n - 1) * incr)
+        self.rdata = words(block) if self.width == 32 else block
+
+    def _read(self, i, n, step):
+        block = self.np.empty(n, self.dtype)
+        for p, words_, part in self._spans(i, n, step):
+            block[part] = self.pages.get(p, self.zeros)[words_]
+            self._count(p, part.stop - part.start)
+        return block
+
+    def buffer(self, addr, nbytes):
+        """The ``nbytes`` from ``addr`` as a numpy array of words that is
+        the memory itself: what is written to it is what the bus reads, and
+        the other way around.
+
+        Pages the range spans become views of one new array, so a range is
+        best mapped after any images are loaded.  A range over several pages
+        can only be mapped again as part of the same array.
+
+        :raises ValueError: If the range spans several pages and some of
+                            them are already mapped apart.
+        """
+        i = self._index(addr)
+        self._index(addr + nbytes - 1)
+        n = nbytes >> self.lg2width
+        first = i >> self.word_bits
+        last = (i + n - 1) >> self.word_bits
+        if first == last:
+            block = self._writable(first)
+            self.mapped[first] = block
+        elif any(p in self.mapped for p in xrange(first, last + 1)):
+            # Giving those pages new memory would leave the arrays already
+            # handed out behind; only a range within one array can share it.
+            block = self._mapped_block(first, last)
+            if block is None:
+                raise ValueError, ('%d bytes at %#x span pages mapped apart'
+                    % (nbytes, addr))
+        else:
+            block = self.np.empty((last - first + 1) << self.word_bits,
+                self.dtype)
+            for k, p in enumerate(xrange(first, last + 1)):
+                page = block[k << self.word_bits:(k + 1) << self.word_bits]
+                page[:] = self.pages.get(p, self.zeros)
+                self.pages[p] = self.mapped[p] = page
+                self.written.add(p)
+        j = i - (first << self.word_bits)
+        return block[j:j + n]
+
+    def _mapped_block(self, first, last):
+        # Pages first to last as one array, if they are all mapped and lie
+        # one after the other in the same one.
+        pages = [self.mapped.get(p) for p in xrange(first, last + 1)]
+        base = pages[0].base if pages[0] is not None else None
+        if base is None:
+            return None
+        start = pages[0].__array_interface__['data'][0]
+        for k, page in enumerate(pages):
+            if page is None or page.base is not base or \
+                    page.__array_interface__['data'][0] != \
+                    start + k * page.nbytes:
+                return None
+        j = (start - base.__array_interface__['data'][0]) // base.itemsize
+        return base[j:j + len(pages) * self.page_words]
+
+    def load_image(self, path, fmt='hex', offset=0):
+        """Preload words from an image file at byte ``offset`` into the
+        memory; see :func:`read_image`.  Whole pages of a ``'bin'`` or
+        ``'npy'`` image are used as they are mapped, without copying.  The
+        memory resets to what was loaded."""
+        image = read_image(path, self.width, fmt)
+        if image.dtype != self.dtype:
+            image = image.astype(self.dtype)
+        start = offset >> self.lg2width
+        if start + len(image) > self.depth:
+            raise ValueError, '%d word image at word %d overflows %d words' % (
+                len(image), start, self.depth)
+        for p, words_, part in self._spans(start, len(image), 1):
+            if part.stop - part.start == self.page_words:
+                page = image[part]
+            else:
+                page = self.initial.get(p, self.zeros).copy()
+                page[words_] = image[part]
+            page.flags.writeable = False
+            self.initial[p] = page
+        self.reset()
+        system.touch(self)
+
+    def dump_image(self, path, fmt='hex', offset=0, count=None):
+        """Write ``count`` words from byte ``offset``, by default the rest
+        of the memory, to an image file."""
+        start = offset >> self.lg2width
+        n = self.depth - start if count is None else count
+        accesses = self.page_accesses.copy()
+        write_image(path, self._read(start, n, 1), self.width, fmt)
+        self.page_accesses = accesses
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, bus, width, depth):
+    def create_and_connect(cls, parent_path, name, bus, width, depth,
+            base=None):
+        """Create a memory.  One with a ``base`` holds the addresses from
+        there and is mapped at them on ``bus``; one without holds those
+        from 0 and is in whatever window of ``bus`` it falls in."""
         path = lambda node, name: '%s#%s' % (node.path, name)
-        self = system.add_node(parent_path, name, 'Mem', { 'width': width, 'depth': depth })
+        kwargs = { 'width': width, 'depth': depth }
+        if base is not None:
+            kwargs['base'] = base
+        self = system.add_node(parent_path, name, 'Mem', kwargs)
         system.add_edge('CallAttrEdge',
             path(self, 'interface'),
             path(bus, 'slaves'))
+        if base is not None:
+            map_slave(bus, self, base, depth * width // 8)
+        return self
 
 class DmaChannel(object):
-    def __init__(self, ready):
+    """A channel of a :class:`Dma`: its registers and the words it has read
+    and not yet written."""
+
+    # The registers by address; a descriptor is the first seven of them.
+    registers = ('src_addr', 'src_incr', 'dest_addr', 'dest_incr', 'count',
+        'ctrl', 'next', 'ring_base', 'ring_size', 'done', 'status')
+    descriptor_words = 7
+
+    def __init__(self, index, ready):
+        self.index = index
         self.ready = ready
         self.reset()
 
@@ -203,74 +477,258 @@ class DmaChannel(object):
         self.dest_addr = 0
         self.dest_incr = 0
         self.count = 0
+        self.ctrl = 0
+        self.next = 0
+        self.ring_base = 0
+        self.ring_size = 0
+        self.done = 0
+        self.status = 0
+        self.buffer = []
+        # What an auto-reload goes back to, once the channel has started.
+        self.start = None
+
+    @property
+    def priority(self):
+        return self.ctrl & 0xff
+
+    @property
+    def reload(self):
+        return bool(self.ctrl & 0x100)
+
+    @property
+    def paced(self):
+        return self.ready is not None and not self.ctrl & 0x200
+
+    @property
+    def interrupt(self):
+        return bool(self.ctrl & 0x400)
+
+    @property
+    def burst(self):
+        return (self.ctrl >> 16 & 0xff) or 1
+
+    @property
+    def busy(self):
+        return bool(self.count or self.next or self.buffer)
+
+    @property
+    def pending(self):
+        return self.busy and (not self.paced or bool(self.ready))
+
+    def load(self, descriptor):
+        (self.src_addr, self.src_incr, self.dest_addr, self.dest_incr,
+            self.count, self.ctrl, self.next) = descriptor
+
+    def span(self, addr, incr):
+        """How many words ``incr`` bytes apart from ``addr`` fit before the
+        ring, if ``addr`` is in it, wraps; None for no limit."""
+        end = self.ring_base + self.ring_size
+        if incr <= 0 or not self.ring_base <= addr < end:
+            return None
+        return (end - addr + incr - 1) // incr
+
+    def advance(self, addr, incr, n):
+        """``addr`` moved on by ``n`` words, wrapping at the end of the
+        ring."""
+        end = self.ring_base + self.ring_size
+        inside = self.ring_base <= addr < end
+        addr += incr * n
+        if inside and addr >= end:
+            addr -= self.ring_size
+        return addr
 
 @system.model
 class Dma(object):
-    def __init__(self, bus, ready):
+    """A DMA engine with ``channels`` channels.
+
+    Each channel has ``0x40`` bytes of registers, channel ``c`` at
+    ``c * 0x40``:
+
+    ======  ==========  ==============================================
+    offset  register
+    ======  ==========  ==============================================
+    0x00    SRC         Source address.
+    0x04    SRC_INCR    Bytes between source words; 0 reads one address.
+    0x08    DEST        Destination address.
+    0x0c    DEST_INCR   Bytes between destination words.
+    0x10    CNT         Words left to write; 0 when the channel is done.
+    0x14    CTRL        Bits 0-7 priority, highest first; bit 8 RELOAD;
+                        bit 9 UNPACED; bit 10 IRQ; bits 16-23 burst
+                        length in words, 0 for one.
+    0x18    NEXT        Address of the descriptor loaded once CNT runs
+                        out; 0 ends the chain.
+    0x1c    RING_BASE   Start of a ring buffer.
+    0x20    RING_SIZE   Bytes in the ring; 0 for none.
+    0x24    DONE        Words written since reset; read only.
+    0x28    STATUS      Bit 0 is set when CNT runs out with IRQ set;
+                        write 1 to clear it.
+    ======  ==========  ==============================================
+
+    A channel runs while CNT or NEXT isn't 0, so writing CNT starts a
+    transfer and writing NEXT with CNT 0 starts a descriptor chain.  A
+    descriptor is seven words in memory, the values of SRC to NEXT.
+    Addresses inside the ring wrap at its end, so a channel can copy out
+    of a ring buffer across its end.  With RELOAD set, a channel that runs
+    out starts over from the registers, or the first descriptor, it
+    started from.
+
+    Each bus grant, the highest priority channel with work, round robin
+    among equals, reads up to a burst of words and writes them.  Unless
+    UNPACED, a channel writes only while ``ready`` is true; it is checked
+    at the grant and before every word after the first, and the words not
+    written wait for the next grant.
+
+    The ``irq`` signal is high while the STATUS of a channel is set; it can
+    be a line of an :class:`InterruptController`.
+    """
+
+    stride = 0x40
+
+    def __init__(self, bus, ready=None, channels=4):
         self.bus = bus()
-        self.channel = DmaChannel(ready()['ready'])
+        ready = ready()['ready'] if ready is not None else None
+        self.channels = [DmaChannel(i, ready) for i in xrange(channels)]
+        self.last = -1
+        self.irq_signal = Signal(bool(False))
 
     def execute(self):
         def dma_master():
+            pending = lambda: any(c.pending for c in self.channels)
             while True:
-                channel = self.channel
-                if channel.ready and channel.count > 0:
-                    #print 'locking'
-                    self.bus.locked = True
-                    #print 'locked?', self.bus.locked
-                    yield self.bus.receive(channel.src_addr)
-                    val = self.bus.rdata
-                    self.bus.locked = False
-                    #print 'VAL', val
-                    # TODO: okay so the mess is that another master runs between the last yield statement and this; so I should create a Transaction object for each receive or lock the bus; and that's why using cpu.load() will be better; if I can figure it out!
-                    yield self.bus.transmit(channel.dest_addr, val)
-                    #print 'dma ready', channel.ready, 'src', hex(channel.src_addr), 'dest', hex(channel.dest_addr), 'val', hex(val), channel.src_incr
-                    channel.src_addr += channel.src_incr
-                    channel.dest_addr += channel.dest_incr
-                    channel.count -= 1
-                else:
-                    yield self.bus.delay(1)
+                channel = self._next_channel()
+                if channel is None:
+                    yield Idle(pending)
+                    continue
+                # A step of a channel is one grant of the bus; no other
+                # master can run in it.
+                yield self._transfer(channel)
         return dma_master
 
+    def _next_channel(self):
+        channels = self.channels
+        n = len(channels)
+        best = None
+        for k in xrange(1, n + 1):
+            channel = channels[(self.last + k) % n]
+            if channel.pending and (best is None or
+                    channel.priority > best.priority):
+                best = channel
+        if best is not None:
+            self.last = best.index
+        return best
+
+    def _transfer(self, channel):
+        bus = self.bus
+        if channel.start is None:
+            channel.start = (channel.src_addr, channel.dest_addr,
+                channel.count, channel.next)
+        if not channel.buffer:
+            if not channel.count:
+                if channel.next:
+                    yield bus.receive_block(channel.next,
+                        channel.descriptor_words)
+                    channel.load(bus.rdata)
+                return
+            n = min(channel.count, channel.burst)
+            for span in (channel.span(channel.src_addr, channel.src_incr),
+                    channel.span(channel.dest_addr, channel.dest_incr)):
+                if span is not None:
+                    n = min(n, span)
+            if n == 1:
+                yield bus.receive(channel.src_addr)
+                channel.buffer = [bus.rdata]
+            else:
+                yield bus.receive_block(channel.src_addr, n, channel.src_incr)
+                channel.buffer = list(bus.rdata)
+            channel.src_addr = channel.advance(channel.src_addr,
+                channel.src_incr, n)
+
+        data = channel.buffer
+        if channel.paced:
+            n = 0
+            while n < len(data) and (not n or channel.ready):
+                yield bus.transmit(
+                    channel.dest_addr + n * channel.dest_incr, data[n])
+                n += 1
+        else:
+            n = len(data)
+            if n == 1:
+                yield bus.transmit(channel.dest_addr, data[0])
+            else:
+                yield bus.transmit_block(channel.dest_addr, data,
+                    channel.dest_incr)
+        channel.buffer = data[n:]
+        channel.dest_addr = channel.advance(channel.dest_addr,
+            channel.dest_incr, n)
+        channel.count -= n
+        channel.done += n
+        if not channel.count and not channel.buffer and channel.interrupt:
+            channel.status = 1
+            self._update_irq()
+        if not channel.busy:
+            if channel.reload:
+                (channel.src_addr, channel.dest_addr, channel.count,
+                    channel.next) = channel.start
+            else:
+                channel.start = None
+
     def interface(self):
         return self
 
     def reset(self):
-        channel = self.channel
-        channel.reset()
+        for channel in self.channels:
+            channel.reset()
+        self.last = -1
+        self._update_irq()
+
+    def irq(self, name):
+        return { name: self.irq_signal }
+
+    def _update_irq(self):
+        self.irq_signal.next = any(c.status for c in self.channels)
 
     def delay(self, n):
         pass
 
+    def _register(self, addr):
+        offset = addr % (self.stride * len(self.channels))
+        i = (offset & (self.stride - 1)) >> 2
+        if i >= len(DmaChannel.registers):
+            return None, None
+        return self.channels[offset // self.stride], DmaChannel.registers[i]
+
     def transmit(self, addr, data):
-        channel = self.channel
-        if addr & 0x1f == 0x00:
-            channel.src_addr = data
-        elif addr & 0x1f == 0x04:
-            channel.src_incr = data
-        elif addr & 0x1f == 0x08:
-            channel.dest_addr = data
-        elif addr & 0x1f == 0x0c:
-            channel.dest_incr = data
-        elif addr & 0x1f == 0x10:
-            channel.count = data
+        channel, name = self._register(addr)
+        if name == 'status':
+            channel.status &= ~data
+            self._update_irq()
+        elif name is not None and name != 'done':
+            setattr(channel, name, data)
 
     def receive(self, addr):
-        channel = self.channel
-        if addr & 0x1f == 0x00:
-            self.rdata = channel.src_addr
-        elif addr & 0x1f == 0x04:
-            self.rdata = channel.src_incr
-        elif addr & 0x1f == 0x08:
-            self.rdata = channel.dest_addr
-        elif addr & 0x1f == 0x0c:
-            self.rdata = channel.dest_incr
-        elif addr & 0x1f == 0x10:
-            self.rdata = channel.count
+        channel, name = self._register(addr)
+        self.rdata = getattr(channel, name) if name is not None else 0
+
+    def transmit_block(self, addr, data, incr=4):
+        for word in words(data):
+            self.transmit(addr, word)
+            addr += incr
+
+    def receive_block(self, addr, n, incr=4):
+        rdata = array.array('I')
+        for i in xrange(n):
+            self.receive(addr)
+            rdata.append(self.rdata)
+            addr += incr
+        self.rdata = rdata
 
     @classmethod
-    def create_and_connect(cls, parent_path, name, bus, ready):
-        self = system.add_node(parent_path, name, 'Dma')
+    def create_and_connect(cls, parent_path, name, bus, ready=None,
+            base=None, channels=4):
+        """Create a DMA engine; without ``ready`` its channels never wait
+        for their destination."""
+        self = system.add_node(parent_path, name, 'Dma',
+            {'channels': channels})
         path = lambda node, name: '%s#%s' % (node.path, name)
         system.add_edge('CallAttrEdge',
             path(self, 'execute'),
@@ -280,11 +738,174 @@ class Dma(object):
             path(bus, 'slaves'))
         system.add_edge('CallAttrEdge',
             path(bus, 'interface'),
-            path(self, 'bus'))
+            path(self, 'bus'),
+            dict(master=self.path))
+        if ready is not None:
+            system.add_edge('CallAttrEdge',
+                path(ready, 'signals_dict'),
+                path(self, 'ready'),
+                dict(name='ready'))
+        if base is not None:
+            map_slave(bus, self, base, cls.stride * channels)
+        return self
+
+@system.model
+class InterruptController(object):
+    """Gathers interrupt lines into one for the CPU.
+
+    A line is a signal, high while its source wants attention; sources
+    connect with :meth:`connect`.  Registers:
+
+    ======  ==========  ==============================================
+    offset  register
+    ======  ==========  ==============================================
+    0x00    PENDING     Lines seen high since they were last
+                        acknowledged; write 1s to acknowledge them.  A
+                        line still high stays pending.
+    0x04    ENABLE      Lines that interrupt the CPU.
+    0x08    CLAIM       The enabled pending line of the highest
+                        priority, the lowest of equals; 0xffffffff for
+                        none.  Read only.
+    0x80    PRIORITY    A word for each line, line ``n`` at
+                        ``0x80 + 4 * n``.
+    ======  ==========  ==============================================
+
+    The CPU sees the enabled pending lines without a bus access, through
+    :meth:`raised`, and blocks until one of them with :meth:`wait`.  A
+    line is latched by :meth:`process` as it rises, so a pulse between two
+    looks at the controller is pending all the same.
+    """
+
+    lines = 32
+
+    def __init__(self, sources=None):
+        if sources is None:
+            sources = []
+        elif type(sources) != list:
+            sources = [sources]
+        self.sources = sources
+        self.signals = None
+        self.reset()
+
+    def interface(self):
+        return self
+
+    def _lines(self):
+        # {line: signal}; the sources are only asked once the simulation
+        # needs them, when their models all exist.
+        if self.signals is None:
+            self.signals = {}
+            for edge in self.sources:
+                name, signal = edge().items()[0]
+                self.signals[int(name[3:])] = signal
+        return self.signals
+
+    def process(self):
+        """The simulation process latching the lines into PENDING on their
+        rising edges, or None without any."""
+        lines = self._lines()
+        if not lines:
+            return None
+        edges = tuple(signal.posedge for signal in lines.itervalues())
+
+        @instance
+        def latch():
+            while True:
+                yield edges
+                self._sample()
+        return latch
+
+    def _sample(self):
+        for line, signal in self._lines().iteritems():
+            if signal:
+                self.pending |= 1 << line
+        return self.pending
+
+    def raised(self, mask=0xffffffff):
+        """The enabled pending lines among ``mask``, as a mask."""
+        return self._sample() & self.enable & mask
+
+    def claim(self):
+        """The line the CLAIM register gives, or None."""
+        raised = self.raised()
+        if not raised:
+            return None
+        return max((line for line in xrange(self.lines) if raised >> line & 1),
+            key=lambda line: (self.priority[line], -line))
+
+    def wait(self, mask=0xffffffff):
+        """What a bus master yields to block until one of the lines in
+        ``mask`` is raised; the other masters have the bus meanwhile.  It
+        sleeps until one of those lines changes."""
+        lines = [signal for line, signal in self._lines().iteritems()
+            if mask >> line & 1]
+        return Idle(lambda: self.raised(mask), lines)
+
+    def reset(self):
+        self.pending = 0
+        self.enable = 0
+        self.priority = [0] * self.lines
+
+    def delay(self, n):
+        pass
+
+    def transmit(self, addr, data):
+        offset = addr & 0xff
+        if offset == 0x00:
+            self.pending &= ~data
+        elif offset == 0x04:
+            self.enable = data
+        elif offset >= 0x80:
+            self.priority[(offset - 0x80) >> 2] = data
+
+    def receive(self, addr):
+        offset = addr & 0xff
+        if offset == 0x00:
+            self.rdata = self._sample()
+        elif offset == 0x04:
+            self.rdata = self.enable
+        elif offset == 0x08:
+            line = self.claim()
+            self.rdata = 0xffffffff if line is None else line
+        elif offset >= 0x80:
+            self.rdata = self.priority[(offset - 0x80) >> 2]
+        else:
+            self.rdata = 0
+
+    def transmit_block(self, addr, data, incr=4):
+        for word in words(data):
+            self.transmit(addr, word)
+            addr += incr
+
+    def receive_block(self, addr, n, incr=4):
+        rdata = array.array('I')
+        for i in xrange(n):
+            self.receive(addr)
+            rdata.append(self.rdata)
+            addr += incr
+        self.rdata = rdata
+
+    @classmethod
+    def create_and_connect(cls, parent_path, name, bus, base=None):
+        self = system.add_node(parent_path, name, 'InterruptController')
+        path = lambda node, name: '%s#%s' % (node.path, name)
+        system.add_edge('CallAttrEdge',
+            path(self, 'interface'),
+            path(bus, 'slaves'))
+        if base is not None:
+            map_slave(bus, self, base, 0x100)
+        return self
+
+    @classmethod
+    def connect(cls, self, line, source, attr='irq', **kwargs):
+        """Make ``attr`` of ``source``, which returns ``{name: signal}``
+        for the ``name`` it is given, interrupt line ``line``."""
+        path = lambda node, name: '%s#%s' % (node.path, name)
+        kwargs['name'] = 'irq%d' % line
         system.add_edge('CallAttrEdge',
-            path(ready, 'signals_dict'),
-            path(self, 'ready'),
-            dict(name='ready'))
+            path(source, attr),
+            path(self, 'sources'),
+            kwargs)
 
 @system.model
 class Sim(object):
@@ -312,22 +933,17 @@ def toplevel_sim(instances):
 class ToplevelMixin():
     def instances(self):
         instances = []
-        def make_instances(n):
-            print n.path, hasattr(n.container, 'instance')
-            if hasattr(n.container, 'instance'):
-                c = n.container
-                instances.append((c.instance, c.signals_dict()))
-        system.traverse(self.root, make_instances, include_root=False)
+        for n in system.nodes_with('instance', self.root, include_root=False):
+            c = n.container
+            instances.append((c.instance, c.signals_dict()))
         return instances
 
     def sim_instances(self):
         instances = []
-        def make_instances(n):
-            print n.path, hasattr(n.container, 'sim_instance')
-            if hasattr(n.container, 'sim_instance'):
-                c = n.container
-                instances.append((c.sim_instance, c.signals_dict()))
-        system.traverse(self.root, make_instances, include_root=False)
+        for n in system.nodes_with('sim_instance', self.root,
+                include_root=False):
+            c = n.container
+            instances.append((c.sim_instance, c.signals_dict()))
         return instances
 
     def sim_signals_dict(self):
@@ -337,12 +953,31 @@ class ToplevelMixin():
     def sim_instance(self):
         return toplevel_sim
 
-@system.view(r'^(?P<node_path>.*)\.v$')
+@system.view(r'^(?P<node_path>.*)\.v$', cache=True)
 def hdl_view(node_path):
     print node_path
     node = system.node_at_path(node_path)
     print node
     hdl = node.container
-    print hdl, hdl.signals_dict()
     from myhdl import toVerilog
-    return toVerilog(hdl.instance, **hdl.signals_dict())
+    system.converting = True
+    try:
+        signals = hdl.signals_dict()
+        print hdl, signals
+        result = toVerilog(hdl.instance, **signals)
+    finally:
+        system.converting = False
+    # The files toVerilog wrote, to be written again from the cache.
+    name = toVerilog.name or hdl.instance.func_name
+    system.artifact('%s.v' % name)
+    if signals and not toVerilog.no_testbench:
+        system.artifact('tb_%s.v' % name)
+
+    # Preloaded rams get their words in $readmemh files beside the Verilog.
+    for ram in system.nodes_of_class('Ram', node_path):
+        if ram.container.mem is not None:
+            name = '%s.hex' % ram.path.strip('/').replace('/', '_')
+            ram.container.dump_image(name, 'hex')
+            system.artifact(name)
+            print 'Wrote %s for $readmemh' % name
+    return result
@@ -1,41 +1,220 @@
+import bisect
+import gc
+import hashlib
 import json
+import mmap
+import operator
 import os.path
+import re
+import resource
+import struct
+import sys
+import thread
+import threading
+import time
+
+from collections import deque
+from itertools import izip
+from contextlib import contextmanager
+
+# Keys the dump format reserves in node and edge rows.  Kwargs that collide
+# with them are nested under '__kwargs__' so they survive a round trip.
+NODE_KEYS = ('__class__', 'name', 'parent')
+EDGE_KEYS = ('__class__', 'from', 'to')
+
+def merge_kwargs(row, kwargs):
+    """Add ``kwargs`` to a dump row without clobbering its reserved keys."""
+    for k, v in kwargs.iteritems():
+        if k in row:
+            row.setdefault('__kwargs__', {})[k] = v
+        else:
+            row[k] = v
+    return row
+
+def split_kwargs(row, keys):
+    """The inverse of :func:`merge_kwargs`."""
+    kwargs = dict((k, v) for k, v in row.iteritems()
+        if k not in keys and k != '__kwargs__')
+    kwargs.update(row.get('__kwargs__', {}))
+    return kwargs
+
+def _native(obj):
+    """Turn the unicode strings json hands back into plain strings."""
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeError:
+            return obj
+    elif isinstance(obj, list):
+        return [_native(i) for i in obj]
+    elif isinstance(obj, dict):
+        return dict((_native(k), _native(v)) for k, v in obj.iteritems())
+    return obj
+
+def _native_decoder():
+    """A json decode function that does what :func:`_native` does as it
+    goes.  Rows repeat the same keys and classes over and over, so every
+    string is converted once."""
+    strings = {}
+    def native(u):
+        s = strings.get(u)
+        if s is None:
+            s = strings[u] = _native(u)
+        return s
+    def pairs(items):
+        d = {}
+        for k, v in items:
+            t = type(v)
+            if t is unicode:
+                v = native(v)
+            elif t is list:
+                v = _native(v)
+            d[native(k)] = v
+        return d
+    # The scanner itself, without decode's checks for surrounding space;
+    # it stops at the end of the first value.
+    scan = json.JSONDecoder(object_pairs_hook=pairs).scan_once
+    return lambda line: scan(line, 0)[0]
+
+# A snapshot is this header, the string table offsets and blob (padded to a
+# word), then (parent, name, class, kwargs) for every node in preorder and
+# (class, from node, from attr, to node, to attr, kwargs) for every edge.
+# Names, classes, attrs and JSON encoded kwargs are all string table indexes.
+SNAPSHOT_MAGIC = 'DCCSNAP1'
+_snapshot_header = struct.Struct('<8sIII')
+
+def _cpu_time():
+    """User and system CPU seconds of this process, all threads included."""
+    t = os.times()
+    return t[0] + t[1]
+
+def _peak_rss():
+    """The most memory this process has held resident so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _object_census():
+    """Count the objects the collector tracks by type name."""
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def _intern(s):
+    # Only plain strings can be interned; unicode names are kept as is.
+    if type(s) is str:
+        return intern(s)
+    return s
 
-from collections import OrderedDict
 class SystemNode(object):
+    __slots__ = ('_container', '_created', 'cls', 'kwargs', 'name', 'parent',
+        'path', 'depth', 'order', 'end', 'children', 'inputs', 'outputs')
+
     def __init__(self, system, cls, kwargs, name, parent):
         self._container = None
         self._created = False
-        self.cls = cls
+        self.cls = _intern(cls)
         self.kwargs = kwargs or {}
-        self.name = name
+        self.name = _intern(name)
         self.parent = parent
-        self.children = OrderedDict()
-        self.inputs = OrderedDict()
-        self.outputs = OrderedDict()
+        if parent is None:
+            self.path = name
+            self.depth = 0
+        else:
+            self.path = '%s/%s' % (parent.path, name)
+            self.depth = parent.depth + 1
+        # The node's position in a preorder of the whole tree, and the
+        # position just past its last descendant; see System.number.
+        self.order = self.end = 0
+        # The child nodes, and the edges into and out of this node, in the
+        # order they were added.  They share the empty tuple until the
+        # system appends the first one.
+        self.children = ()
+        self.inputs = ()
+        self.outputs = ()
 
     @property
     def container(self):
         if not self._created:
-            self._created = True
-            if self.cls == 'NoneType':
-                self._container = None
-            else:
-                cls = system.models[self.cls]
-                callargs = dict(self.inputs)
-                callargs.update(self.kwargs)
-                print cls, callargs
-                self._container = cls(**callargs)
+            return system._build(self)
         return self._container
 
-    @property
-    def path(self):
-        path = [self.name]
-        parent = self.parent
-        while parent:
-            path.insert(0, parent.name)
-            parent = parent.parent
-        return '/'.join(path)
+    def _construct(self):
+        if self.cls == 'NoneType':
+            return None
+        cls = system.models[self.cls]
+        # Models get a single edge into an attribute as the edge itself and
+        # several as a list of them.
+        callargs = {}
+        for e in self.inputs:
+            other = callargs.get(e.to_attr)
+            if other is None:
+                callargs[e.to_attr] = e
+            elif type(other) == list:
+                other.append(e)
+            else:
+                callargs[e.to_attr] = [other, e]
+        callargs.update(self.kwargs)
+        print cls, callargs
+        return cls(**callargs)
+
+class ModelRegistry(dict):
+    """The models of a system by name.
+
+    A model can be registered lazily by naming the module that defines it;
+    the module is then only imported the first time the model is looked up,
+    which is usually the first add_node of that class.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.lazy = {}
+
+    def __missing__(self, name):
+        module = self.lazy.pop(name, None)
+        if module is None:
+            raise KeyError(name)
+        __import__(module)
+        return self[name]
+
+class NodeIndex(object):
+    """A set of nodes kept in tree preorder, so that the nodes in any
+    subtree form one contiguous range.
+
+    Nodes are appended as they are added and only sorted when the index is
+    next read after the tree was renumbered, so building a tree in any
+    order stays linear.
+    """
+    def __init__(self, system):
+        self.system = system
+        self.keys = []
+        self.nodes = []
+        self.numbering = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        self._sort()
+        return iter(self.nodes)
+
+    def add(self, node):
+        self.nodes.append(node)
+
+    def _sort(self):
+        numbering = self.system.number()
+        if self.numbering != numbering:
+            self.nodes.sort(key=operator.attrgetter('order'))
+            self.keys = [n.order for n in self.nodes]
+            self.numbering = numbering
+
+    def subtree(self, root, include_root=True):
+        """The indexed nodes at or below ``root``, in preorder."""
+        self._sort()
+        lo = bisect.bisect_left(self.keys,
+            root.order if include_root else root.order + 1)
+        hi = bisect.bisect_left(self.keys, root.end, lo)
+        return self.nodes[lo:hi]
 
 system = None
 
@@ -49,27 +228,90 @@ class System(object):
     # The type of class that makes up the system tree.
     node_class = SystemNode
 
+    # Attributes of a model class that nodes are indexed by.
+    capabilities = ('instance', 'sim_instance', 'execute')
+
     def __init__(self, name):
         global system
         system = self
         self.name = name
 
         # Models are objects stored in a dict.
-        self.models = {}
+        self.models = ModelRegistry()
 
-        # Views are tuples of (regular expression object, view method, and
-        # default kwargs.
+        # Views are tuples of (regular expression object, view method,
+        # default kwargs, and whether results are cached).
         self.views = []
 
+        # All the views' expressions as one; see dispatch.
+        self._matcher = None
+
+        # Cached view results by URI: the subtree_hash they are for, the
+        # result, and the (path, contents) of the files the view wrote.
+        self.view_cache = {}
+
+        # The files written by the views being dispatched, innermost last;
+        # see artifact.
+        self._artifacts = []
+
+        # Handed out by touch, so no two changes share a version.
+        self.state_version = 0
+
         # Methods to load system.
         self.load_list = []
 
         # Methods to execute the system.
         self.execute_list = []
 
+        # (kind, name, depth, wall, cpu, peak rss, rss growth) for every
+        # measured phase and dispatched view, in the order they started.
+        self.measurements = []
+        self._measure_depth = 0
+
+        # The running cProfile profiler, and where profiling writes the
+        # allocations after each phase.
+        self._profiler = None
+        self._memory_trace = None
+        self._tracemalloc = None
+        self._census = {}
+
+        # True while HDL is converted; models with a behavioral model for
+        # simulation hand out their HDL instead.
+        self.converting = False
+
+        self.clear()
+
+    def clear(self):
+        """Drop every node and edge, leaving only a fresh root."""
         # This is the database.
         self.root = self.node_class(self, 'OperatingSystem', None, '', None)
 
+        # Every node in the database, keyed by its normalized path.
+        self.nodes = { self.root.path: self.root }
+
+        # Seconds spent building each container; see elaborate.
+        self.elaboration_times = {}
+
+        # The nodes whose containers are being built, with the lock their
+        # builder holds and its thread; see _build.
+        self._building = {}
+        # The node each thread waits for another thread to build.
+        self._waiting = {}
+        self._building_lock = threading.Lock()
+
+        # Kwargs shared by edges; see add_edge.
+        self.edge_kwargs = {}
+
+        # Nodes by model class name and by capability.
+        self.by_class = {}
+        self.by_capability = dict((c, NodeIndex(self))
+            for c in self.capabilities)
+
+        # Bumped whenever the nodes are renumbered; None while nodes were
+        # added since.
+        self.numbering = None
+        self._numberings = 0
+
     def model(self, cls, name=None):
         """Register a model with the system."""
         if name is None:
@@ -77,47 +319,822 @@ class System(object):
         self.models[name] = cls
         return cls
 
-    def node_at_path(self, path):
-        paths = path.split('/')
-        i = self.root
-        for p in paths:
+    def lazy_model(self, module, *names):
+        """Register models that ``module`` defines without importing it
+        until one of them is first used."""
+        for name in names:
+            if name not in self.models:
+                self.models.lazy[name] = module
+
+    def normalize_path(self, path):
+        """Resolve ``.``, ``..`` and duplicate slashes in a path.
+
+        Paths are always relative to the root; the root itself is ``''``.
+        """
+        parts = []
+        for p in path.split('/'):
             if p == '' or p == '.':
                 continue
             elif p == '..':
-                i = i.parent
+                if not parts:
+                    raise KeyError(path)
+                parts.pop()
             else:
-                i = i.children[p]
-        return i
+                parts.append(p)
+        if not parts:
+            return ''
+        return '/' + '/'.join(parts)
+
+    def node_at_path(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            node = self.nodes[self.normalize_path(path)]
+        return node
+
+    def walk(self, root_path='/', order='pre', prune=None,
+            include_root=True):
+        """Iterate over the nodes at or below ``root_path``.
+
+        The walk keeps its own stack, so it works on trees of any depth, and
+        the caller may stop early by breaking out of the loop.
+
+        :param order: ``'pre'`` or ``'post'`` for depth first, parents
+                      before or after their children, or ``'bfs'`` for
+                      breadth first.
+        :param prune: If given, called with each node; when it returns
+                      true that node is still visited but its children
+                      are not.
+        :param include_root: Whether to visit the root node itself.
+        """
+        root = self.node_at_path(root_path)
+        if order == 'pre':
+            stack = [iter((root,))]
+            while stack:
+                for node in stack[-1]:
+                    if include_root or node is not root:
+                        yield node
+                    if node.children and not (prune and prune(node)):
+                        stack.append(iter(node.children))
+                    break
+                else:
+                    stack.pop()
+        elif order == 'post':
+            nodes = [root]
+            stack = [iter(root.children)]
+            if prune and prune(root):
+                stack[0] = iter(())
+            while stack:
+                for node in stack[-1]:
+                    nodes.append(node)
+                    if prune and prune(node):
+                        stack.append(iter(()))
+                    else:
+                        stack.append(iter(node.children))
+                    break
+                else:
+                    stack.pop()
+                    node = nodes.pop()
+                    if include_root or node is not root:
+                        yield node
+        elif order == 'bfs':
+            queue = deque((root,))
+            while queue:
+                node = queue.popleft()
+                if include_root or node is not root:
+                    yield node
+                if node.children and not (prune and prune(node)):
+                    queue.extend(node.children)
+        else:
+            raise ValueError, 'Unknown walk order %r' % order
 
     def traverse(self, root_path, f, include_root=True):
-        def _traverse(n, f, call_on):
-            if call_on:
-                f(n)
-            for c in n.children.itervalues():
-                _traverse(c, f, True)
-        n = self.node_at_path(root_path)
-        _traverse(n, f, include_root)
+        for n in self.walk(root_path, include_root=include_root):
+            f(n)
+
+    def edges(self, root_path='/'):
+        """Iterate over the edges into every node at or below
+        ``root_path``."""
+        for node in self.walk(root_path):
+            for e in node.inputs:
+                yield e
+
+    def number(self):
+        """Give every node its preorder :attr:`SystemNode.order` and
+        :attr:`SystemNode.end` if nodes were added since the last time.
+
+        :returns: The current numbering; indexes sorted under an older one
+                  sort again.
+        """
+        if self.numbering is None:
+            nodes = list(self.walk())
+            for i, node in enumerate(nodes):
+                node.order = i
+            # A node's subtree ends where its last child's does.
+            for node in reversed(nodes):
+                node.end = node.children[-1].end if node.children else \
+                    node.order + 1
+            self._numberings += 1
+            self.numbering = self._numberings
+        return self.numbering
 
     def add_node(self, parent_path, name, cls, d=None):
         parent = self.node_at_path(parent_path)
+        return self._add_child(parent, name, cls, d)
+
+    def _add_child(self, parent, name, cls, d):
         container_cls = self.models[cls]
         node = self.node_class(self, cls, d, name, parent)
-        parent.children[name] = node
+        if node.path in self.nodes:
+            raise ValueError, '%s already exists' % node.path
+        if parent.children:
+            parent.children.append(node)
+        else:
+            parent.children = [node]
+        self.nodes[node.path] = node
+        self.numbering = None
+        self._index(node, container_cls)
         return node
+
+    def _index(self, node, container_cls):
+        index = self._class_index(node.cls, container_cls)
+        index.add(node)
+        for capability in index.capabilities:
+            capability.add(node)
+
+    def _class_index(self, cls, container_cls):
+        index = self.by_class.get(cls)
+        if index is None:
+            index = self.by_class[cls] = NodeIndex(self)
+            # Capabilities are looked up on the class so that no container
+            # has to be built to find out what it can do.
+            index.capabilities = [self.by_capability[c]
+                for c in self.capabilities if hasattr(container_cls, c)]
+        return index
+
+    def _build(self, node):
+        """Build ``node``'s container, or wait for the thread building it.
+
+        A container is only marked built once its constructor returned, so
+        no other thread sees it half made; one whose constructor raised is
+        built again on next use.  A constructor that comes back round to
+        its own node, through a dependency cycle, gets None, as it would
+        from a container that isn't there yet.  So does one that would
+        wait for a thread that is, through other threads or not, waiting
+        for this one: the constructors being run on both sides of a cycle.
+        """
+        me = thread.get_ident()
+        with self._building_lock:
+            if node._created:
+                return node._container
+            building = self._building.get(node)
+            if building is None:
+                lock = threading.Lock()
+                lock.acquire()
+                self._building[node] = (lock, me)
+            elif self._waits_for(building[1], me):
+                return None
+            else:
+                self._waiting[me] = node
+        if building is not None:
+            # Another thread is at it; once it's done the container is
+            # there, or its constructor raised and this thread tries.
+            lock = building[0]
+            try:
+                with lock:
+                    pass
+            finally:
+                with self._building_lock:
+                    del self._waiting[me]
+            return node.container
+        try:
+            node._container = node._construct()
+            node._created = True
+        finally:
+            with self._building_lock:
+                del self._building[node]
+            lock.release()
+        return node._container
+
+    def _waits_for(self, builder, me):
+        # Whether the thread builder is me, or waits for me through the
+        # nodes the threads in between wait for.  Called with the building
+        # lock held; a waiting thread has a builder to wait on until it
+        # wakes, unless its builder finished and it has yet to notice.
+        seen = set()
+        while builder != me:
+            if builder in seen:
+                return False
+            seen.add(builder)
+            building = self._building.get(self._waiting.get(builder))
+            if building is None:
+                return False
+            builder = building[1]
+        return True
+
+    def update_kwargs(self, path, **kwargs):
+        """Change the kwargs a node's container is built with."""
+        node = self.node_at_path(path)
+        # Copied rather than updated in place; restored nodes share theirs.
+        node.kwargs = dict(node.kwargs, **kwargs)
+        self.invalidate(node)
+
+    def invalidate(self, node):
+        """Drop ``node``'s container and everything built from it.
+
+        Downstream containers may have kept what they got from this one,
+        so every node reachable through output edges is rebuilt on next use
+        and those edges forget their cached results.
+        """
+        stack = [node]
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            node._created = False
+            node._container = None
+            for e in node.outputs:
+                e.invalidate()
+                stack.append(e.to_node)
+
+    def dependencies(self, root_path='/'):
+        """Map every node at or below ``root_path``, and every node those
+        take input from, to the nodes it takes input from."""
+        deps = {}
+        stack = list(self.walk(root_path))
+        while stack:
+            node = stack.pop()
+            if node in deps:
+                continue
+            needs = []
+            for e in node.inputs:
+                if e.from_node is not node and e.from_node not in needs:
+                    needs.append(e.from_node)
+                    stack.append(e.from_node)
+            deps[node] = needs
+        return deps
+
+    def build_order(self, deps):
+        """Group the nodes in ``deps`` into the strongly connected
+        components of the dependency graph, dependencies first.
+
+        Returns a list of levels; each level is a list of components and
+        each component a list of nodes.  No component needs another in its
+        own level or a later one, so the components of one level can be
+        built in any order.
+        """
+        # Tarjan's algorithm with an explicit stack.  Components come out
+        # with everything they need already emitted.
+        self.number()
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for start in deps:
+            if start in index:
+                continue
+            work = [(start, iter(deps[start]))]
+            index[start] = lowlink[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            while work:
+                node, needs = work[-1]
+                for other in needs:
+                    if other not in index:
+                        index[other] = lowlink[other] = len(index)
+                        stack.append(other)
+                        on_stack.add(other)
+                        work.append((other, iter(deps[other])))
+                        break
+                    elif other in on_stack:
+                        lowlink[node] = min(lowlink[node], index[other])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            other = stack.pop()
+                            on_stack.discard(other)
+                            component.append(other)
+                            if other is node:
+                                break
+                        components.append(component)
+
+        level_of = {}
+        levels = []
+        for component in components:
+            level = 0
+            for node in component:
+                for other in deps[node]:
+                    if level_of.get(other, -1) >= level:
+                        level = level_of[other] + 1
+            # Within a component, build in tree order.
+            component.sort(key=operator.attrgetter('order'))
+            for node in component:
+                level_of[node] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(component)
+        return levels
+
+    def find_cycle(self, deps, component):
+        """The paths of a cycle through ``component``, each node needing
+        the next and the last being the first again."""
+        start = component[0]
+        members = set(component)
+        prev = {start: None}
+        queue = deque((start,))
+        while queue:
+            node = queue.popleft()
+            for other in deps[node]:
+                if other is start:
+                    cycle = [start.path]
+                    while node is not start:
+                        cycle.append(node.path)
+                        node = prev[node]
+                    cycle.append(start.path)
+                    cycle[1:-1] = reversed(cycle[1:-1])
+                    return cycle
+                if other in members and other not in prev:
+                    prev[other] = node
+                    queue.append(other)
+
+    def elaborate(self, root_path='/', workers=1, strict=False):
+        """Build the containers at or below ``root_path``, and the ones
+        they take input from, with every node's inputs built before it.
+
+        Containers are normally built the first time something touches
+        them, in whatever order that happens.  This builds them up front,
+        ``workers`` threads at a time for containers that don't depend on
+        each other, and records how long each took in
+        :attr:`elaboration_times`.
+
+        Edges are called lazily, so dependency cycles, like a bus and the
+        slaves that keep a reference back to it, are legal.  Each cycle is
+        built serially, in tree order.
+
+        The workers are threads rather than processes: containers share
+        signals and keep references to each other, which would not survive
+        being pickled back from another process.
+
+        :param strict: Raise a ValueError on the first cycle instead.
+        :returns: The cycles found, as from :meth:`find_cycle`.
+        """
+        deps = self.dependencies(root_path)
+        levels = self.build_order(deps)
+
+        cycles = []
+        for level in levels:
+            for component in level:
+                if len(component) > 1:
+                    cycle = self.find_cycle(deps, component)
+                    if strict:
+                        raise ValueError, 'Dependency cycle: %s' % \
+                            ' -> '.join(cycle)
+                    cycles.append(cycle)
+
+        times = self.elaboration_times = {}
+        def build(component):
+            for node in component:
+                start = time.time()
+                node.container
+                times[node.path] = time.time() - start
+
+        pool = None
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+        try:
+            for level in levels:
+                if pool and len(level) > 1:
+                    pool.map(build, level)
+                else:
+                    for component in level:
+                        build(component)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return cycles
+
+    def elaboration_stats(self, f, top=10):
+        """Write the total build time and the ``top`` slowest containers
+        from the last :meth:`elaborate`."""
+        times = sorted(((t, path) for path, t in
+            self.elaboration_times.iteritems()), reverse=True)
+        print >>f, '%d containers built in %.3f s' % (len(times),
+            sum(t for t, path in times))
+        for t, path in times[:top]:
+            print >>f, '%10.6f s  %s' % (t, path or '/')
+
+    @contextmanager
+    def measure(self, kind, name):
+        """Record the wall time, CPU time and peak memory of the block in
+        :attr:`measurements`.  Measurements nest; a view's time is also
+        part of the phase that dispatched it."""
+        index = len(self.measurements)
+        self.measurements.append(None)
+        depth = self._measure_depth
+        self._measure_depth += 1
+        wall, cpu, peak = time.time(), _cpu_time(), _peak_rss()
+        try:
+            yield
+        finally:
+            self._measure_depth = depth
+            end = _peak_rss()
+            self.measurements[index] = (kind, name, depth, time.time() - wall,
+                _cpu_time() - cpu, end, end - peak)
+            self.resume_profiling()
+            if self._memory_trace and kind == 'phase':
+                self._trace_memory(name)
+
+    @contextmanager
+    def profiling(self, profile=None, trace_memory=None):
+        """Profile the block.
+
+        :param profile: Write cProfile stats for the block to this file; read
+                        them back with :mod:`pstats`.
+        :param trace_memory: Write the largest allocation sites, or on
+                             interpreters without :mod:`tracemalloc` the
+                             most common live objects, after every measured
+                             phase to this file.
+        """
+        if profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+        if trace_memory:
+            self._memory_trace = open(trace_memory, 'w')
+            self._census = {}
+            try:
+                import tracemalloc
+            except ImportError:
+                pass
+            else:
+                tracemalloc.start()
+                self._tracemalloc = tracemalloc
+        if self._profiler:
+            self._profiler.enable()
+        try:
+            yield
+        finally:
+            if self._profiler:
+                self._profiler.disable()
+                self._profiler.dump_stats(profile)
+                self._profiler = None
+            if trace_memory:
+                if self._tracemalloc:
+                    self._tracemalloc.stop()
+                    self._tracemalloc = None
+                self._memory_trace.close()
+                self._memory_trace = None
+
+    def resume_profiling(self):
+        """Turn cProfile back on after MyHDL's hierarchy extraction, which
+        toVerilog and traceSignals run by taking over sys.setprofile."""
+        if self._profiler:
+            self._profiler.enable()
+
+    def _trace_memory(self, phase, top=20):
+        f = self._memory_trace
+        print >>f, '== %s' % phase
+        if self._tracemalloc:
+            snapshot = self._tracemalloc.take_snapshot()
+            for stat in snapshot.statistics('lineno')[:top]:
+                print >>f, stat
+        else:
+            census = _object_census()
+            counts = sorted(((n, self._census.get(name, 0), name)
+                for name, n in census.iteritems()), reverse=True)
+            for n, before, name in counts[:top]:
+                print >>f, '%10d %+10d  %s' % (n, n - before, name)
+            self._census = census
+        f.flush()
+
+    def measurement_stats(self, f):
+        """Write every :meth:`measure` so far, nested blocks indented under
+        the block they ran in."""
+        print >>f, '%10s %10s %10s %10s' % ('wall s', 'cpu s', 'peak MB',
+            'grown MB')
+        for row in self.measurements:
+            if row is None:
+                # Still running; this is being called from inside it.
+                continue
+            kind, name, depth, wall, cpu, peak, grown = row
+            print >>f, '%10.3f %10.3f %10.1f %10.1f  %s%s %s' % (wall, cpu,
+                peak / 2.0**20, grown / 2.0**20, '  ' * depth, kind, name)
+
+    def edge_stats(self, f, top=10):
+        """Write edge cache hits and misses, in total and for the ``top``
+        most reused edges."""
+        edges = [e for e in self.edges() if e.hits or e.misses]
+        hits = sum(e.hits for e in edges)
+        misses = sum(e.misses for e in edges)
+        print >>f, '%d edge calls, %d cached (%d edges)' % (
+            hits + misses, hits, len(edges))
+        edges.sort(key=lambda e: e.hits, reverse=True)
+        for e in edges[:top]:
+            print >>f, '%6d hits %6d misses  %s#%s -> %s#%s' % (e.hits,
+                e.misses, e.from_node.path, e.from_attr, e.to_node.path,
+                e.to_attr)
+
+    def nodes_of_class(self, cls, root_path='/', include_root=True):
+        """The nodes of model class ``cls`` at or below ``root_path``, in
+        preorder."""
+        index = self.by_class.get(cls)
+        if index is None:
+            return []
+        return index.subtree(self.node_at_path(root_path), include_root)
+
+    def nodes_with(self, capability, root_path='/', include_root=True):
+        """The nodes whose model class has the attribute ``capability``
+        (one of :attr:`capabilities`) at or below ``root_path``, in
+        preorder."""
+        return self.by_capability[capability].subtree(
+            self.node_at_path(root_path), include_root)
     
     def add_edge(self, cls, f, to, d=None):
-        d = d or {}
+        d = self._shared_kwargs(d or {})
         edge_cls = self.models[cls]
+        return self._add_edge(edge_cls, f, to, d)
+
+    def _add_edge(self, edge_cls, f, to, d):
         edge = edge_cls(self, f, to, d)
+        self._link(edge)
         return edge
+
+    def _shared_kwargs(self, d):
+        # Edges never change their kwargs, and most edges carry one of a
+        # handful of them, so equal kwargs are stored once.
+        try:
+            key = tuple(sorted((k, type(v), v) for k, v in d.iteritems()))
+            return self.edge_kwargs.setdefault(key, d)
+        except TypeError:
+            return d
+
+    def _link(self, edge):
+        # The edge table is just these two indexes: every node lists the
+        # edges out of it and into it.
+        node = edge.from_node
+        if node.outputs:
+            node.outputs.append(edge)
+        else:
+            node.outputs = [edge]
+        node = edge.to_node
+        if node.inputs:
+            node.inputs.append(edge)
+        else:
+            node.inputs = [edge]
     
     def register_load(self, func):
         self.load_list.append(func)
         return func
 
+    @contextmanager
+    def _elaborating(self):
+        # Elaboration only allocates; the cyclic collector would rescan the
+        # whole growing tree on every generation-0 threshold for nothing.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if enabled:
+                gc.enable()
+
     def load(self): 
-        for f in self.load_list:
-            f()
+        with self._elaborating():
+            for f in self.load_list:
+                f()
+
+    def dump(self, f):
+        """Write the system to ``f`` as JSON lines; an ``['n', row]`` for
+        every node followed by an ``['e', row]`` for every edge."""
+        for node in self.walk(include_root=False):
+            row = {
+                '__class__': node.cls,
+                'name': node.name,
+                'parent': node.parent.path,
+            }
+            merge_kwargs(row, node.kwargs)
+            print >>f, json.dumps(['n', row])
+
+        for e in self.edges():
+            print >>f, json.dumps(['e', e.__getstate__()])
+
+    def load_dump(self, path):
+        """Rebuild the nodes and edges written by :meth:`dump` without
+        running the load functions.
+
+        The file is read a line at a time; lines that aren't node or edge
+        rows, like everything else :func:`run` prints, are skipped.
+        """
+        with self._elaborating():
+            decode = _native_decoder()
+            with open(path) as f:
+                for line in f:
+                    if not line.startswith('["'):
+                        continue
+                    kind, row = decode(line)
+                    # What's left of the row once the reserved keys are
+                    # taken out are the kwargs, as split_kwargs has them.
+                    cls = row.pop('__class__')
+                    if kind == 'n':
+                        name = row.pop('name')
+                        parent = self.node_at_path(row.pop('parent'))
+                        if '__kwargs__' in row:
+                            row.update(row.pop('__kwargs__'))
+                        self._add_child(parent, name, cls, row)
+                    elif kind == 'e':
+                        fr = row.pop('from')
+                        to = row.pop('to')
+                        if '__kwargs__' in row:
+                            row.update(row.pop('__kwargs__'))
+                        self.add_edge(cls, fr, to, row)
+
+    def save_snapshot(self, path):
+        """Write the system to ``path`` in the binary snapshot format."""
+        strings = []
+        index = {}
+        def intern(s):
+            i = index.get(s)
+            if i is None:
+                i = index[s] = len(strings)
+                strings.append(s)
+            return i
+
+        # Most nodes share a handful of kwargs, so only encode each once.
+        encoded = {}
+        def intern_kwargs(kwargs):
+            try:
+                key = tuple(sorted((k, type(v), v)
+                    for k, v in kwargs.iteritems()))
+                i = encoded.get(key)
+            except TypeError:
+                key = i = None
+            if i is None:
+                i = intern(json.dumps(kwargs))
+                if key is not None:
+                    encoded[key] = i
+            return i
+
+        node_index = {}
+        nodes = []
+        edges = []
+        with self._elaborating():
+            for node in self.walk():
+                node_index[node.path] = len(node_index)
+                parent = node_index[node.parent.path] if node.parent else -1
+                nodes.extend((parent, intern(node.name), intern(node.cls),
+                    intern_kwargs(node.kwargs)))
+
+            for e in self.edges():
+                state = e.__getstate__()
+                from_path, from_attr = state['from'].split('#')
+                to_path, to_attr = state['to'].split('#')
+                edges.extend((intern(state['__class__']),
+                    node_index[from_path], intern(from_attr),
+                    node_index[to_path], intern(to_attr),
+                    intern_kwargs(split_kwargs(state, EDGE_KEYS))))
+
+        blob = []
+        offsets = [0]
+        for s in strings:
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            blob.append(s)
+            offsets.append(offsets[-1] + len(s))
+        blob.append('\0' * (-offsets[-1] % 4))
+
+        with open(path, 'wb') as f:
+            f.write(_snapshot_header.pack(SNAPSHOT_MAGIC,
+                len(strings), len(nodes) // 4, len(edges) // 6))
+            f.write(struct.pack('<%dI' % len(offsets), *offsets))
+            f.write(''.join(blob))
+            f.write(struct.pack('<%di' % len(nodes), *nodes))
+            f.write(struct.pack('<%di' % len(edges), *edges))
+
+    def load_snapshot(self, path):
+        """Rebuild the nodes and edges saved by :meth:`save_snapshot`.
+
+        The file is memory mapped and each table is unpacked in one call;
+        only the node and edge objects themselves are allocated.
+        """
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, nstrings, nnodes, nedges = \
+                _snapshot_header.unpack_from(m, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError, '%s is not a system snapshot' % path
+            offset = _snapshot_header.size
+            offsets = struct.unpack_from('<%dI' % (nstrings + 1), m, offset)
+            offset += 4 * (nstrings + 1)
+            strings = [m[offset + offsets[i]:offset + offsets[i + 1]]
+                for i in xrange(nstrings)]
+            offset += offsets[-1] + (-offsets[-1] % 4)
+            nodes = struct.unpack_from('<%di' % (4 * nnodes), m, offset)
+            offset += 16 * nnodes
+            edges = struct.unpack_from('<%di' % (6 * nedges), m, offset)
+        finally:
+            m.close()
+
+        # Strings are interned once here rather than per node, and the
+        # nodes with the same kwargs share one dict, decoded once.
+        strings = [_intern(s) for s in strings]
+        decoded = {}
+        for kw in set(nodes[3::4]):
+            decoded[kw] = _native(json.loads(strings[kw]))
+        shared = {}
+        for kw in set(edges[5::6]):
+            shared[kw] = self._shared_kwargs(_native(json.loads(strings[kw])))
+
+        with self._elaborating():
+            fresh = len(self.nodes) == 1
+            # The nodes are built in place rather than through _add_child:
+            # they come in preorder, so every parent is already there, their
+            # numbering is their position, and each index gets them sorted.
+            node_class = self.node_class
+            new = node_class.__new__
+            all_nodes = self.nodes
+            by_class = {}
+            table = [self.root]
+            append = table.append
+            order = 0
+            for parent, name, cls, kw in izip(nodes[4::4], nodes[5::4],
+                    nodes[6::4], nodes[7::4]):
+                parent = table[parent]
+                name = strings[name]
+                cls = strings[cls]
+                path = '%s/%s' % (parent.path, name)
+                if path in all_nodes:
+                    raise ValueError, '%s already exists' % path
+                order += 1
+                node = new(node_class)
+                node._container = None
+                node._created = False
+                node.cls = cls
+                node.kwargs = decoded[kw]
+                node.name = name
+                node.parent = parent
+                node.path = path
+                node.depth = parent.depth + 1
+                node.order = order
+                node.children = node.inputs = node.outputs = ()
+                all_nodes[path] = node
+                if parent.children:
+                    parent.children.append(node)
+                else:
+                    parent.children = [node]
+                members = by_class.get(cls)
+                if members is None:
+                    members = by_class[cls] = []
+                members.append(node)
+                append(node)
+
+            for cls, members in by_class.iteritems():
+                index = self._class_index(cls, self.models[cls])
+                index.nodes.extend(members)
+                for capability in index.capabilities:
+                    capability.nodes.extend(members)
+            self.numbering = None
+            if fresh:
+                for node in reversed(table):
+                    node.end = node.children[-1].end if node.children \
+                        else node.order + 1
+                self._numberings += 1
+                self.numbering = self._numberings
+
+            # Edge classes that can be built from the nodes themselves
+            # skip looking their paths up again; see CallAttrEdge.between.
+            betweens = {}
+            for cls in set(edges[0::6]):
+                edge_cls = self.models[strings[cls]]
+                betweens[cls] = getattr(edge_cls, 'between', None)
+            for cls, fn, fa, tn, ta, kw in izip(edges[0::6], edges[1::6],
+                    edges[2::6], edges[3::6], edges[4::6], edges[5::6]):
+                between = betweens[cls]
+                if between is None:
+                    self._add_edge(self.models[strings[cls]],
+                        '%s#%s' % (table[fn].path, strings[fa]),
+                        '%s#%s' % (table[tn].path, strings[ta]), shared[kw])
+                    continue
+                from_node = table[fn]
+                to_node = table[tn]
+                edge = between(from_node, strings[fa], to_node, strings[ta],
+                    shared[kw])
+                if from_node.outputs:
+                    from_node.outputs.append(edge)
+                else:
+                    from_node.outputs = [edge]
+                if to_node.inputs:
+                    to_node.inputs.append(edge)
+                else:
+                    to_node.inputs = [edge]
 
     def register_execute(self, func):
         self.execute_list.append(func)
@@ -127,86 +1144,188 @@ class System(object):
         for f in self.execute_list:
             f()
 
-    def view(self, regexp, **kwargs):
-        """Register a view and controller with the system."""
-        import re
+    def view(self, regexp, cache=False, **kwargs):
+        """Register a view and controller with the system.
+
+        :param cache: Keep the view's result and return it again for the
+                      same URI until the design under its ``node_path``
+                      group, or the whole design if it has none, changes.
+                      The files the view notes with :meth:`artifact` are
+                      kept too, and written again.
+        """
         def decorator(func):
-            self.views.append((re.compile(regexp), func, kwargs))
+            self.views.append((re.compile(regexp), func, kwargs, cache))
+            self._matcher = None
+            return func
         return decorator
 
+    def _compile_views(self):
+        # One alternative per view, tried in the order they were
+        # registered.  Each is prefixed with a lazy match-anything so that
+        # matching the whole pattern at the start of a URI is the same as
+        # searching it with that view's expression.  Group names get a
+        # per-view prefix since they may repeat between views.
+        alternatives = []
+        for i, (regexp, func, kwargs, cache) in enumerate(self.views):
+            pattern = re.sub(r'\(\?P([<=])(\w+)',
+                r'(?P\1_v%d_\2' % i, regexp.pattern)
+            alternatives.append('(?P<_v%d>[\s\S]*?(?:%s))' % (i, pattern))
+        matcher = re.compile('(?:%s)' % '|'.join(alternatives))
+        groups = []
+        for i, view in enumerate(self.views):
+            prefix = '_v%d_' % i
+            groups.append(dict((name[len(prefix):], index)
+                for name, index in matcher.groupindex.iteritems()
+                if name.startswith(prefix)))
+        self._views_by_group = dict((matcher.groupindex['_v%d' % i],
+            (view, groups[i])) for i, view in enumerate(self.views))
+        self._matcher = matcher
+
     def dispatch(self, uri):
-        for regexp, func, kwargs in self.views:
-            m = regexp.search(uri)
-            if m:
-                callkwargs = kwargs
-                callkwargs.update(m.groupdict())
-                return func(**callkwargs)
-        raise NotImplementedError, 'Unknown view for %s' % uri
-
-def run():
+        with self.measure('view', uri):
+            return self._dispatch(uri)
+
+    def _dispatch(self, uri):
+        if self._matcher is None:
+            self._compile_views()
+        m = self._matcher.match(uri)
+        if not m:
+            raise NotImplementedError, 'Unknown view for %s' % uri
+        # The view's own group is the outermost, so it closes last.
+        (regexp, func, kwargs, cache), groups = \
+            self._views_by_group[m.lastindex]
+        callkwargs = dict(kwargs)
+        for name, index in groups.iteritems():
+            callkwargs[name] = m.group(index)
+        if not cache:
+            return func(**callkwargs)
+
+        digest = self.subtree_hash(callkwargs.get('node_path') or '/')
+        cached = self.view_cache.get(uri)
+        if cached and cached[0] == digest:
+            for path, contents in cached[2]:
+                with open(path, 'wb') as f:
+                    f.write(contents)
+                self.artifact(path)
+            return cached[1]
+        self._artifacts.append([])
+        try:
+            result = func(**callkwargs)
+        finally:
+            written = self._artifacts.pop()
+        artifacts = []
+        for path in written:
+            with open(path, 'rb') as f:
+                artifacts.append((path, f.read()))
+            self.artifact(path)
+        self.view_cache[uri] = (digest, result, artifacts)
+        return result
+
+    def artifact(self, path):
+        """Note that the view being dispatched wrote the file ``path``.
+
+        A cached view writes the files it noted again when it returns its
+        kept result, as do the cached views that dispatched it.
+        """
+        if self._artifacts:
+            self._artifacts[-1].append(path)
+
+    def touch(self, container):
+        """Note that ``container`` changed other than through its kwargs,
+        as when it loads an image, so cached views of it are redone."""
+        self.state_version += 1
+        container.state_version = self.state_version
+
+    def subtree_hash(self, root_path='/'):
+        """A digest of the nodes at or below ``root_path`` and all the
+        nodes they take input from: their classes, kwargs, edges and the
+        state versions :meth:`touch` gave their containers."""
+        h = hashlib.sha1()
+        deps = self.dependencies(root_path)
+        self.number()
+        for node in sorted(deps, key=operator.attrgetter('order')):
+            h.update(repr((node.path, node.cls, sorted(node.kwargs.items()),
+                getattr(node._container, 'state_version', 0))))
+            for e in node.inputs:
+                h.update(repr(sorted(e.__getstate__().items())))
+        return h.hexdigest()
+
+def run(snapshot=None, workers=1, profile=None, trace_memory=None):
+    """Load, elaborate, execute and store the system, then print how long
+    each phase and view took.
+
+    :param snapshot: If this names an existing snapshot file the system is
+                     restored from it instead of running the load functions;
+                     otherwise the loaded system is saved there.
+    :param workers: The number of threads building containers.
+    :param profile: Write cProfile stats for the whole run to this file;
+                    defaults to $DCC_PROFILE.
+    :param trace_memory: Write the allocations after every phase to this
+                         file; defaults to $DCC_TRACE_MEMORY.  See
+                         :meth:`System.profiling`.
+    """
+    profile = profile or os.environ.get('DCC_PROFILE')
+    trace_memory = trace_memory or os.environ.get('DCC_TRACE_MEMORY')
+    with system.profiling(profile, trace_memory):
+        _run(snapshot, workers)
+
+    print
+    print "----------------"
+    print 'Timings'
+    print
+
+    system.measurement_stats(sys.stdout)
+
+def _run(snapshot, workers):
     print
     print 'Loading the system'
     print
 
-    system.load()
+    with system.measure('phase', 'load'):
+        if snapshot and os.path.exists(snapshot):
+            system.load_snapshot(snapshot)
+        else:
+            system.load()
+            if snapshot:
+                system.save_snapshot(snapshot)
+
+    print
+    print '-----------------'
+    print 'Elaborating the system'
+    print
+
+    with system.measure('phase', 'elaborate'):
+        cycles = system.elaborate(workers=workers)
+    for cycle in cycles:
+        print 'cycle:', ' -> '.join(cycle)
+    system.elaboration_stats(sys.stdout)
 
     print
     print '-----------------'
     print 'Dumping the system'
     print
 
-    def print_it(x):
-        if x.path == '':
-            return
-        try:
-            print x.path#, x.container
-        except:
-            print 'can\'t make %s' % x.path
-            raise
-
-    def print_inputs(x):
-        for n, i in x.inputs.iteritems():
-            if type(i) == list:
-                for j in i:
-                    print x.path, n, j.from_node.path, '->', j.to_node.path, j.kwargs
-            else:
-                print x.path, n, i.from_node.path, '->', i.to_node.path, i.kwargs
+    with system.measure('phase', 'dump'):
+        for x in system.walk(include_root=False):
+            print x.path
 
-    def traverse(n, f):
-        f(n)
-        for c in n.children.itervalues():
-            traverse(c, f)
+        for e in system.edges():
+            print e.to_node.path, e.to_attr, e.from_node.path, '->', e.to_node.path, e.kwargs
 
-    traverse(system.root, print_it)
-    traverse(system.root, print_inputs)
+    with system.measure('phase', 'execute'):
+        system.execute()
 
-    system.execute()
+    print
+    print "----------------"
+    print 'Edge cache'
+    print
+
+    system.edge_stats(sys.stdout)
 
     print
     print "----------------"
     print 'Storing the system'
     print
 
-    def store_node(node):
-        if node.path == '':
-            return
-        row = {
-            '__class__': node.cls,
-            'name': node.name,
-            'parent': node.parent.path,
-        }
-        row.update(node.kwargs)
-        print json.dumps(['n', row])
-
-    def store_edges(node):
-        for n, e in node.inputs.iteritems():
-            if type(e) == list:
-                for i in e:
-                    row = i.__getstate__()
-                    print json.dumps(['e', row])
-            else:
-                row = e.__getstate__()
-                print json.dumps(['e', row])
-
-    traverse(system.root, store_node)
-    traverse(system.root, store_edges)
+    with system.measure('phase', 'store'):
+        system.dump(sys.stdout)
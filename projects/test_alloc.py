@@ -0,0 +1,67 @@
+"""Tests of the buddy allocator; run them with ``make test``."""
+import unittest
+
+from alloc import Allocator
+
+class AllocatorTest(unittest.TestCase):
+    def free_blocks(self, heap):
+        return sorted((addr, 1 << order)
+            for addr, order in heap.free_blocks.iteritems())
+
+    def test_split_and_merge(self):
+        heap = Allocator([(0, 0x1000)])
+        self.assertEqual(heap.alloc('a', 16), 0)
+        # The upper halves of every split stay free.
+        self.assertEqual(self.free_blocks(heap), [(1 << k, 1 << k)
+            for k in xrange(4, 12)])
+        self.assertEqual(heap.alloc('b', 100), 0x80)
+        self.assertEqual(heap.alloc('c', 16), 0x10)
+        heap.free('a')
+        heap.free('c')
+        heap.free('b')
+        self.assertEqual(self.free_blocks(heap), [(0, 0x1000)])
+        self.assertEqual(heap.stats()['allocated'], 0)
+
+    def test_regions_cut_into_aligned_blocks(self):
+        heap = Allocator([(0x3000, 0x3000)])
+        self.assertEqual(self.free_blocks(heap), [(0x3000, 0x1000),
+            (0x4000, 0x2000)])
+        self.assertEqual(heap.alloc('a', 0x2000), 0x4000)
+        self.assertRaises(ValueError, heap.alloc, 'b', 0x2000)
+
+    def test_no_merge_across_regions(self):
+        # Adjacent, and buddies by address, but in regions of their own.
+        heap = Allocator([(0, 0x1000), (0x1000, 0x1000)])
+        a = heap.alloc('a', 0x1000)
+        b = heap.alloc('b', 0x1000)
+        self.assertEqual(sorted((a, b)), [0, 0x1000])
+        heap.free('a')
+        heap.free('b')
+        self.assertEqual(self.free_blocks(heap), [(0, 0x1000),
+            (0x1000, 0x1000)])
+        self.assertEqual(heap.largest_free, 0x1000)
+        self.assertRaises(ValueError, heap.alloc, 'c', 0x2000)
+
+    def test_split_keeps_region(self):
+        heap = Allocator([(0, 0x1000), (0x1000, 0x1000)])
+        heap.alloc('a', 0x1000)
+        self.assertEqual(heap.alloc('b', 16), 0x1000)
+        heap.free('a')
+        heap.free('b')
+        self.assertEqual(self.free_blocks(heap), [(0, 0x1000),
+            (0x1000, 0x1000)])
+
+    def test_align(self):
+        heap = Allocator([(0, 0x1000)])
+        heap.alloc('a', 16)
+        self.assertEqual(heap.alloc('b', 16, align=0x100), 0x100)
+
+    def test_errors(self):
+        heap = Allocator([(0, 0x100)])
+        heap.alloc('a', 16)
+        self.assertRaises(ValueError, heap.alloc, 'a', 16)
+        self.assertRaises(ValueError, heap.alloc, 'b', 0x100)
+        self.assertRaises(KeyError, heap.free, 'b')
+
+if __name__ == '__main__':
+    unittest.main()
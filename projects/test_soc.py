@@ -0,0 +1,188 @@
+"""Tests of the bus, memory, DMA and ring models; run them with
+``make test``."""
+import os
+import sys
+import tempfile
+import unittest
+
+from system import *
+s = System('test')
+from soc import *
+from dsp import Capture
+from myhdl import Simulation, StopSimulation
+from root import simulation
+
+def run(firmware):
+    """Simulate the SoC with its CPU running ``firmware``."""
+    system.node_at_path('/soc/cpu').container.program(firmware)
+    bus = system.node_at_path('/soc').container
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            Simulation(simulation(bus, [])).run(quiet=1)
+        finally:
+            sys.stdout = stdout
+
+class SocTest(unittest.TestCase):
+    def setUp(self):
+        system.clear()
+        resetn = Reset.create_and_connect('/', 'resetn', async=False)
+        clk = Clock.create_and_connect('/', 'clk', int(10e6))
+        self.soc = BusMatrix.create('/', 'soc', resetn, clk,
+            duration=int(10e6), address_mask=0xffff)
+        Cpu.create_and_connect('/soc', 'cpu', self.soc)
+
+    def tearDown(self):
+        system.clear()
+
+class AddressMapTest(SocTest):
+    def test_boundaries(self):
+        # Adjacent in one 4 KiB page, then a gap, then one at the top.
+        for name, base, depth in (('a', 0, 64), ('b', 0x100, 32),
+                ('c', 0x1000, 16), ('d', 0xfffffff0, 4)):
+            Mem.create_and_connect('/soc', name, self.soc, width=32,
+                depth=depth, base=base)
+        address_map = self.soc.container.address_map
+        paths = address_map.paths
+        # Twice, so the second time the decoded pages are used.
+        for attempt in xrange(2):
+            for addr, path in ((0, '/soc/a'), (0xff, '/soc/a'),
+                    (0x100, '/soc/b'), (0x17f, '/soc/b'),
+                    (0x1000, '/soc/c'), (0x103f, '/soc/c'),
+                    (0xfffffff0, '/soc/d'), (0xffffffff, '/soc/d')):
+                self.assertEqual(paths[address_map.find(addr)], path)
+                self.assertIs(address_map.lookup(addr),
+                    system.node_at_path(path).container)
+            for addr in (0x180, 0xfff, 0x1040, 0xffffffef):
+                self.assertRaises(ValueError, address_map.find, addr)
+                self.assertRaises(ValueError, address_map.lookup, addr)
+
+    def test_overlap(self):
+        Mem.create_and_connect('/soc', 'a', self.soc, width=32, depth=64,
+            base=0)
+        Mem.create_and_connect('/soc', 'b', self.soc, width=32, depth=64,
+            base=0xfc)
+        self.assertRaises(ValueError, lambda: self.soc.container)
+
+class MemTest(unittest.TestCase):
+    def test_out_of_range(self):
+        mem = Mem(32, 16, base=0x1000)
+        mem.transmit(0x1000, 1)
+        mem.transmit(0x103c, 2)
+        for addr in (0xffc, 0x1040, 0):
+            self.assertRaises(ValueError, mem.transmit, addr, 3)
+            self.assertRaises(ValueError, mem.receive, addr)
+        self.assertRaises(ValueError, mem.receive_block, 0x1038, 3)
+        self.assertRaises(ValueError, mem.buffer, 0x1038, 16)
+        # A block running off the end writes nothing.
+        self.assertRaises(ValueError, mem.transmit_block, 0x1038, [4, 5, 6])
+        mem.receive_block(0x1038, 2)
+        self.assertEqual(list(mem.rdata), [0, 2])
+        with tempfile.NamedTemporaryFile() as image:
+            image.write('\0' * 8)
+            image.flush()
+            mem.load_image(image.name, 'bin', 0x38)
+            self.assertRaises(ValueError, mem.load_image, image.name, 'bin',
+                0x3c)
+
+class DmaTest(SocTest):
+    def setUp(self):
+        SocTest.setUp(self)
+        soc = self.soc
+        # The memories are behind a bus that keeps time, so the DMA takes
+        # some.
+        pbus = Apb3Bus.create('/soc', 'pbus', soc, mode='transaction',
+            base=0, size=0x40000)
+        for name, base in (('src', 0), ('dest', 0x10000),
+                ('descriptors', 0x20000)):
+            Mem.create_and_connect(pbus.path, name, pbus, width=32, depth=64,
+                base=base)
+        dma = Dma.create_and_connect('/soc', 'dma', soc, base=0x40000)
+        intc = InterruptController.create_and_connect('/soc', 'intc', soc,
+            base=0x50000)
+        InterruptController.connect(intc, 0, dma)
+
+    def test_descriptor_ring_irq(self):
+        dma = 0x40000
+        # The first descriptor copies across the end of the 16 word ring
+        # at 0 and goes on to the second, which raises the interrupt.
+        descriptors = [
+            [0x30, 4, 0x10000, 4, 8, 4 << 16, 0x20000 + 28],
+            [0x10, 4, 0x10020, 4, 4, 4 << 16 | 0x400, 0],
+        ]
+        seen = {}
+
+        def firmware():
+            root = system.root.container
+            yield root.reset()
+            yield root.transmit_block(0, range(100, 116))
+            yield root.enable_irq(1)
+            for i, descriptor in enumerate(descriptors):
+                yield root.transmit_block(0x20000 + 28 * i, descriptor)
+            yield root.transmit_block(dma + 0x1c, [0, 0x40])
+            yield root.transmit(dma + 0x18, 0x20000)
+            yield root.wait_irq(1)
+            yield root.receive(dma + 0x24)
+            seen['done'] = root.rdata
+            yield root.receive(dma + 0x28)
+            seen['status'] = root.rdata
+            yield root.receive(0x50000)
+            seen['pending'] = root.rdata
+            yield root.transmit(dma + 0x28, 1)
+            yield root.ack_irq(0)
+            yield root.delay(1)
+            seen['raised'] = root.raised()
+            raise StopSimulation
+
+        run(firmware)
+        dest = system.node_at_path('/soc/pbus/dest').container
+        dest.receive_block(0x10000, 12)
+        self.assertEqual(list(dest.rdata), range(112, 116) +
+            range(100, 108))
+        self.assertEqual(seen, dict(done=12, status=1, pending=1, raised=0))
+
+class RingTest(SocTest):
+    def setUp(self):
+        SocTest.setUp(self)
+        Mem.create_and_connect('/soc', 'mem', self.soc, width=32, depth=64,
+            base=0x10000)
+
+    def test_mem_fifo_wrap(self):
+        net = MemFifoDspNet('/soc/net', 32, 64, lambda: system.root.container)
+        base = net.mem()
+        block, = net.acquire_write(12)
+        block[:] = range(12)
+        net.commit_write(12)
+        net.release_read(10)
+        # 14 words of room: the 4 at the end of the ring, then 10 at the
+        # start, of which 6 are asked for.
+        head, tail = net.acquire_write(10)
+        self.assertEqual((len(head), len(tail)), (4, 6))
+        head[:] = range(12, 16)
+        tail[:] = range(16, 22)
+        net.commit_write(10)
+        self.assertEqual(net.wrptr, base + 6 * 4)
+        self.assertEqual(net.rdptr, base + 10 * 4)
+        self.assertEqual([list(a) for a in net.acquire_read(20)],
+            [range(10, 16), range(16, 22)])
+        # The arrays are the memory the bus sees.
+        mem = system.node_at_path('/soc/mem').container
+        mem.receive(base)
+        self.assertEqual(mem.rdata, 16)
+        self.assertRaises(ValueError, net.commit_write, 5)
+        net.release_read(12)
+        self.assertRaises(ValueError, net.release_read, 1)
+        self.assertEqual((net.rdcnt, net.wrcnt), (0, 16))
+
+    def test_capture_wrap(self):
+        capture = Capture(capacity=8)
+        for sample in xrange(20):
+            capture.add(sample)
+        self.assertEqual(list(capture.data), range(12, 20))
+        capture = Capture(chunk=8)
+        for sample in xrange(20):
+            capture.add(sample)
+        self.assertEqual(list(capture.data), range(20))
+
+if __name__ == '__main__':
+    unittest.main()
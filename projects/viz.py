@@ -1,14 +1,22 @@
 from system import system
 
-@system.view(r'^(?P<node_path>.*)\/resource-tree.latex$')
+@system.view(r'^(?P<node_path>.*)\/resource-tree.latex$', cache=True)
 def resource_tree(node_path):
     node = system.node_at_path(node_path)
-    with open(system.name + '-resource-tree.latex', 'w') as f:
+    path = system.name + '-resource-tree.latex'
+    system.artifact(path)
+    with open(path, 'w') as f:
         node_name = node.name or 'root'
         print >>f, '\\begin{tikzpicture}[align=center]'
         print >>f, '\\tikzstyle{every node} = [draw];'
         print >>f,  '\\node (%(name)s) {%(name_newline)s} [edge from parent fork down]' % { 'name': node_name, 'name_newline': node_name.replace('_', '\\\\') }
-        def print_it(i, n):
+        depth = node.depth
+        # Depths of the nodes whose child braces are still open.
+        opened = []
+        for n in system.walk(node.path, include_root=False):
+            i = n.depth - depth
+            while opened and opened[-1] >= i:
+                print >>f, '    '*opened.pop(), '}'
             d = {
                 'name': n.name,
                 'name_newline': n.name.replace('_', '\\\\'),
@@ -17,13 +25,8 @@ def resource_tree(node_path):
                 print >>f, '    '*i, 'child { node (%(name)s) {%(name_newline)s} }' % d
             else:
                 print >>f, '    '*i, 'child { node (%(name)s) {%(name_newline)s}' % d
-            for child in n.children.itervalues():
-                print_it(i + 1, child)
-
-            if len(n.children) > 0:
-                print >>f, '    '*i, '}'
-
-        for child in node.children.itervalues():
-            print_it(1, child)
+                opened.append(i)
+        while opened:
+            print >>f, '    '*opened.pop(), '}'
         print >>f, ';'
         print >>f, '\\end{tikzpicture}'